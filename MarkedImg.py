@@ -16,8 +16,10 @@ You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import threading
 import numpy as np
 import gc
+from collections import OrderedDict
 
 from PySide2.QtCore import Qt, QDataStream, QFile, QIODevice, QSize, QPoint
 
@@ -38,10 +40,14 @@ from bLUeGui.dialog import dlgWarn
 from time import time
 
 from lutUtils import LUT3DIdentity
+from bLUeCore.bLUeLUT3D import haldArray, LUT3D
+from bLUeCore.demosaicing import demosaic
 from bLUeGui.baseSignal import  baseSignal_bool, baseSignal_Int2
-from utils import qColorToRGB
+from utils import qColorToRGB, isGUIThread, formSnapshot
 
 from versatileImg import vImage
+from renderThread import renderScheduler
+from settings import USE_VIEWPORT, VIEWPORT_TILE_SIZE, FUSE_POINTWISE_LAYERS
 
 class ColorSpace:
     notSpecified = -1; sRGB = 1
@@ -55,6 +61,17 @@ class mImage(vImage):
     To correctly render a mImage, widgets should override their
     paint event handler.
     """
+    ###############
+    # viewport rendering (cf. renderViewport()) :
+    # tile size (current image pixels) and
+    # width of the band rendered around tiles,
+    # for neighborhood filters (current image pixels).
+    ###############
+    viewportTileSize = VIEWPORT_TILE_SIZE
+    viewportGuard = 16
+    # max count of fused LUTs (cf. fusedLUT()) kept in memory
+    fusedLUTCacheSize = 4
+
     @classmethod
     def restoreMeta(cls, srcFile, destFile, defaultorientation=True, thumbfile=None):
         """
@@ -82,6 +99,18 @@ class mImage(vImage):
         self.layersStack = []
         # link back to QLayerView window
         self.layerView = None
+        # background renders (cf. QLayer.applyToStackAsync)
+        self.scheduler = None
+        # called (GUI thread) when an intermediate render is available
+        self.onRenderProgress = lambda: 0
+        # viewport rendering : visible region (full size coordinates)
+        # set by the paint event handler, and valid tiles, by render mode.
+        self.useViewport = USE_VIEWPORT
+        self.viewportRect = None
+        self.viewportTiles = {}
+        # layer fusion (cf. renderFused()) : fused LUTs, by run key
+        self.useFusion = FUSE_POINTWISE_LAYERS
+        self.fusedLUTs = OrderedDict()
         super().__init__(*args, **kwargs)  # must be done before prLayer init.
         # add background layer
         bgLayer = QLayer.fromImage(self, parentImage=self)
@@ -101,6 +130,44 @@ class mImage(vImage):
         self.isModified = False
         # rawpy object
         self.rawImage = None
+        # raw sensor data are unpacked on demand (cf. unpackRaw())
+        self.rawUnpacked = False
+        # Bayer demosaic buffer of raw images, built on demand (cf. demosaic)
+        self.__demosaic = None
+
+    def unpackRaw(self):
+        """
+        Unpacks the sensor data of rawImage, if it is not done yet.
+        Unpacking is deferred until the first development (cf. rawProcessing.rawPostProcess)
+        or the first use of the demosaic buffer, so that opening a raw file
+        only reads its metadata and its embedded preview.
+        """
+        if self.rawImage is not None and not self.rawUnpacked:
+            self.rawImage.unpack()
+            self.rawUnpacked = True
+
+    @property
+    def demosaic(self):
+        """
+        16 bits Bayer demosaic buffer of the raw sensor data, with
+        black levels, built on first access. We need it to calculate
+        the multipliers corresponding to a user white point, and we cannot
+        access the native rawpy demosaic buffer from the RawPy instance.
+        @return:
+        @rtype: ndarray, shape (h, w, 3)
+        """
+        if self.__demosaic is None and self.rawImage is not None:
+            self.unpackRaw()
+            rawImage = self.rawImage
+            buf = demosaic(rawImage.raw_image_visible, rawImage.raw_colors_visible, rawImage.black_level_per_channel)
+            # correct orientation (libraw flip values)
+            flip = rawImage.sizes.flip
+            if flip == 6:  # 90°
+                buf = np.swapaxes(buf, 0, 1)
+            elif flip == 5:  # 270°
+                buf = np.swapaxes(buf, 0, 1)[:, ::-1, :]
+            self.__demosaic = buf
+        return self.__demosaic
 
     def bTransformed(self, transformation):
         """
@@ -116,6 +183,7 @@ class mImage(vImage):
         img.onImageChanged = self.onImageChanged
         img.useThumb = self.useThumb
         img.useHald = self.useHald
+        img.pyramidLevel = self.pyramidLevel
         stack = []
         for layer in self.layersStack:
             tLayer = layer.bTransformed(transformation, img)
@@ -207,6 +275,191 @@ class mImage(vImage):
         for layer in self.layersStack:
             layer.cacheInvalidate()  # As Qlayer doesn't inherit from mImage, we call vImage.cacheInvalidate(layer)
 
+    def getRenderStats(self):
+        """
+        Returns the rendering statistics of the stack layers
+        (cf. QLayer.applyToStack).
+        @return: list of (layer name, stats) pairs, from bottom to top
+        @rtype: list
+        """
+        return [(layer.name, dict(layer.renderStats)) for layer in self.layersStack]
+
+    def waitForRender(self):
+        """
+        Waits for the completion of background renders
+        (cf. QLayer.applyToStackAsync). Must be called from the GUI thread before
+        modifying or reading the stack. In the render thread, the method returns immediately.
+        """
+        if self.scheduler is not None and isGUIThread():
+            self.scheduler.wait()
+
+    def renderViewport(self, layer, cancel=None):
+        """
+        Viewport rendering : renders the region of the stack
+        covered by viewportRect only, at the current pyramid level.
+        The region is split into square tiles. The tiles computed since the last
+        modification of the stack are reused, so panning renders the newly
+        exposed tiles only.
+        Viewport renders use their own render modes ('viewport/' + renderMode()). As
+        layer outputs are partial, the regular fingerprints of the rendered layers
+        are reset, and the next regular render (e.g. for export) is full frame.
+        @param layer: lowest modified layer
+        @type layer: QLayer
+        @param cancel: cancellation flag
+        @type cancel: threading.Event
+        @return: True if the render was completed, False if it was cancelled
+        @rtype: boolean
+        """
+        viewport = self.viewportRect
+        stack = self.layersStack
+        base = layer.renderMode()
+        mode = 'viewport/' + base
+        # tile size, full size coordinates
+        s = self.width() / stack[0].getCurrentImage().width()
+        t = max(int(self.viewportTileSize * s), 1)
+        tiles = {(i, j) for i in range(viewport.left() // t, viewport.right() // t + 1)
+                        for j in range(viewport.top() // t, viewport.bottom() // t + 1)}
+        if not tiles:
+            return True
+        valid = self.viewportTiles.get(mode, set())
+        # lowest modified layer : its output and the outputs
+        # of upper layers must be computed over all tiles
+        ind = len(stack)
+        for i, l in enumerate(stack):
+            if l.visible and l.renderFingerprints.get(mode) != l.renderFingerprint(mode):
+                ind = i
+                break
+        imgRect = QRect(0, 0, self.width(), self.height())
+        guard = int(self.viewportGuard * s)
+
+        def region(tileSet):
+            if not tileSet:
+                return None
+            rect = QRect()
+            for i, j in tileSet:
+                rect = rect.united(QRect(i * t, j * t, t, t))
+            return rect.adjusted(-guard, -guard, guard, guard).intersected(imgRect)
+
+        lowRegion, highRegion = region(tiles - valid), region(tiles)
+        if lowRegion is None and ind == len(stack):
+            return True
+        rendered = []
+        for i, l in enumerate(stack):
+            if not l.visible:
+                continue
+            rect = highRegion if i >= ind else lowRegion
+            if rect is None:
+                continue
+            if cancel is not None and cancel.is_set():
+                # the next render must start at the lowest modified layer
+                for r in rendered:
+                    if r.getStackIndex() >= ind:
+                        r.renderFingerprints.pop(mode, None)
+                return False
+            start = time()
+            l.render(mode, rect=rect, force=True)
+            elapsed = time() - start
+            l.renderFingerprints.pop(base, None)
+            l.renderStats['executed'] += 1
+            l.renderStats['time'] += elapsed
+            rendered.append(l)
+        self.viewportTiles[mode] = tiles if ind < len(stack) else valid | tiles
+        # presentation layer
+        prLayer = self.prLayer
+        prLayer.inputDirtyRect = highRegion if ind < len(stack) else lowRegion
+        try:
+            prLayer.execute(l=None, pool=None)
+        finally:
+            prLayer.inputDirtyRect = None
+        return True
+
+    def fusibleRun(self, layers, mode):
+        """
+        Returns the longest run of fusible layers (cf. QLayer.isFusible())
+        starting at layers[0].
+        @param layers: consecutive visible layers
+        @type layers: list of QLayer
+        @param mode: render mode
+        @type mode: str
+        @return:
+        @rtype: list of QLayer
+        """
+        if not self.useFusion or mode == 'hald' or mode.startswith('viewport'):
+            return []
+        run = []
+        for layer in layers:
+            if not layer.isFusible():
+                break
+            run.append(layer)
+        return run
+
+    def fusedLUT(self, run):
+        """
+        Returns the 3D LUT equivalent to a run of fusible layers. It is
+        built by applying the layers in turn to an identity hald image
+        (cf. QLayer.evaluateOnHald()). LUTs are cached, so changing
+        the parameters of the layers above or below the run does not rebuild it.
+        @param run: consecutive fusible layers, from bottom to top
+        @type run: list of QLayer
+        @return: LUT, BGR order
+        @rtype: LUT3D
+        """
+        key = tuple((id(l), l.paramsVersion, id(l.execute)) for l in run)
+        lut = self.fusedLUTs.get(key)
+        if lut is not None:
+            self.fusedLUTs.move_to_end(key)
+            return lut
+        s = int((LUT3DIdentity.size) ** (3.0 / 2.0)) + 1
+        hald = QImage(QSize(s, s), QImage.Format_ARGB32)
+        buf = QImageBuffer(hald)
+        buf[:, :, :3] = LUT3DIdentity.toHaldArray(s, s).haldBuffer
+        buf[:, :, 3] = 255
+
+        def haldLayer():
+            layer = QLayer.fromImage(hald, parentImage=self)
+            # the current image of a hald is the hald itself, even in preview
+            # or pyramid mode : the color space buffers of the input (cf. vImage.getHSVBuffer())
+            # are computed from it.
+            layer.getCurrentImage = lambda: layer
+            return layer
+
+        img = haldLayer()
+        for layer in run:
+            img = layer.evaluateOnHald(img, haldLayer())
+        lut = LUT3D.HaldBuffer2LUT3D(haldArray(QImageBuffer(img), LUT3DIdentity.size))
+        self.fusedLUTs[key] = lut
+        while len(self.fusedLUTs) > self.fusedLUTCacheSize:
+            self.fusedLUTs.popitem(last=False)
+        return lut
+
+    def renderFused(self, run, mode):
+        """
+        Renders a run of fusible layers as a single 3D LUT (cf. fusedLUT()), applied
+        to the input of the run. The top layer of the run gets the result, and
+        the other layers forward their input (cf. QLayer.forwardInput()). Their
+        fingerprints are recorded as ('fused', fingerprint) : they are up to date, but
+        a render starting inside the run starts at its bottom (cf. QLayer.renderStack()).
+        @param run: consecutive fusible layers, from bottom to top
+        @type run: list of QLayer
+        @param mode: render mode
+        @type mode: str
+        """
+        lut = self.fusedLUT(run)
+        inputImage = run[0].inputImg()
+        for layer in run[:-1]:
+            layer.forwarded[layer.renderMode()] = inputImage
+            layer.rPixmap, layer.rImage = None, None
+            layer.pixmapMode = layer.renderMode()
+            layer.cacheInvalidate()
+            layer.renderFingerprints[mode] = ('fused', layer.renderFingerprint(mode))
+        top = run[-1]
+        top.forwarded.pop(top.renderMode(), None)
+        # fused LUTs are not reused enough to be baked
+        top.apply3DLUT(lut.LUT3DArray, lut.step, options={'use selection': False, 'keep alpha': True},
+                       inputImage=inputImage)
+        top.cacheInvalidate()
+        top.renderFingerprints[mode] = top.renderFingerprint(mode)
+
     def setThumbMode(self, value):
         if value == self.useThumb:
             return
@@ -245,6 +498,7 @@ class mImage(vImage):
         @return: the layer added
         @rtype: QLayer
         """
+        self.waitForRender()
         # build a unique name
         usedNames = [l.name for l in self.layersStack]
         a = 1
@@ -274,6 +528,7 @@ class mImage(vImage):
     def removeLayer(self, index=None):
         if index is None:
             return
+        self.waitForRender()
         self.layersStack.pop(index)
 
     def addAdjustmentLayer(self, layerType=None, name='', role='', index=None, sourceImg=None):
@@ -316,7 +571,7 @@ class mImage(vImage):
         if role in ['CONTRAST', 'RAW']:
             layer.autoSpline = True
         # init thumb
-        if layer.parentImage.useThumb:
+        if layer.thumbMode():
             layer.thumb = layer.inputImg().copy()
         group = self.layersStack[index].group
         if group:
@@ -402,6 +657,11 @@ class mImage(vImage):
         # don't save thumbnails
         if self.useThumb:
             return None
+        self.waitForRender()
+        # viewport renders leave partial outputs : render the full frame
+        if self.useViewport:
+            self.pyramidLevel = 0
+            self.layersStack[0].applyToStack(dirty=False)
         # get the final image from the presentation layer.
         # This image is NOT color managed (prLayer.qPixmap
         # only is color managed)
@@ -513,6 +773,7 @@ class imImage(mImage) :
         img.onImageChanged = self.onImageChanged
         img.useThumb = self.useThumb
         img.useHald = self.useHald
+        img.pyramidLevel = self.pyramidLevel
         stack = []
         # apply transformation to the stack. Note that
         # the presentation layer is automatically rebuilt
@@ -594,6 +855,9 @@ class QLayer(vImage):
     """
     Base class for image layers
     """
+    # max count of preview outputs kept by the render cache of each layer
+    renderCacheSize = 2
+
     @classmethod
     def fromImage(cls, mImg, parentImage=None):
         """
@@ -660,6 +924,8 @@ class QLayer(vImage):
         # getCurrentMaskedImage. Their type is QLayer
         self.maskedImageContainer = None
         self.maskedThumbContainer = None
+        # thumbnail containers of all pyramid levels
+        self.thumbContainers = {}
         # consecutive layers can be grouped.
         # A group is a list of QLayer objects
         self.group = []
@@ -669,6 +935,29 @@ class QLayer(vImage):
         # clone dup layer shift and zoom  relative to current layer
         self.xAltOffset, self.yAltOffset = 0, 0
         self.AltZoom_coeff = 1.0
+        # render graph : applyToStack skips the layers whose
+        # fingerprint (parameters and input) did not change.
+        # paramsVersion is incremented each time the layer parameters change.
+        self.paramsVersion = 0
+        # fingerprints of the current outputs, by render mode
+        self.renderFingerprints = {}
+        # pass-through outputs, by render mode (cf. forwardInput())
+        self.forwarded = {}
+        # masked image built by a background render, waiting
+        # for its conversion to rPixmap in the GUI thread (cf. syncPixmap())
+        self.rImage = None
+        # render mode of rPixmap and rImage : layers up to date in several
+        # modes keep a single pixmap, rebuilt on mode change (cf. refreshPixmap())
+        self.pixmapMode = None
+        # values of the graphics form, recorded for background renders (cf. snapshotForm())
+        self.formValues = None
+        # fingerprints of recent preview outputs (LRU order).
+        # Outputs are kept in the tile store (cf. vImage.getTileStore())
+        self.renderCache = OrderedDict()
+        self.renderStats = {'executed': 0, 'skipped': 0, 'restored': 0, 'fused': 0, 'time': 0.0}
+        # returns True if execute() is a color only, point-wise, transformation,
+        # which can be evaluated on a hald image (cf. mImage.renderFused())
+        self.pointWise = lambda: False
         super().__init__(*args, **kwargs)
         self.updatePixmap()
 
@@ -683,6 +972,31 @@ class QLayer(vImage):
             return self.view.widget()
         return None
 
+    def snapshotForm(self):
+        """
+        Records the values of the graphics form, read by
+        background renders instead of the form (cf. getFormValues()).
+        Must be called from the GUI thread.
+        """
+        form = self.getGraphicsForm()
+        snapshot = None if form is None else formSnapshot(form)
+        self.formValues = snapshot
+        if self.tLayer is not self:
+            self.tLayer.formValues = snapshot
+
+    def getFormValues(self):
+        """
+        Returns the parameter values of the graphics form (cf. utils.formSnapshot).
+        In the GUI thread, they are read from the form. Background renders get
+        the snapshot taken when the render was requested (cf. applyToStackAsync()).
+        @return:
+        @rtype: formSnapshot
+        """
+        if isGUIThread() or self.formValues is None:
+            form = self.getGraphicsForm()
+            return None if form is None else formSnapshot(form)
+        return self.formValues
+
     def isActiveLayer(self):
         if self.parentImage.getActiveLayer() is self:
             return True
@@ -758,10 +1072,28 @@ class QLayer(vImage):
         # cut link from old layer to graphic form
         # self.view = None                        # TODO 04/12/17 validate
         tLayer.execute = self.execute
+        tLayer.pointWise = self.pointWise
         tLayer.mask = self.mask.transformed(transformation)
         tLayer.maskIsEnabled, tLayer.maskIsSelected = self.maskIsEnabled, self.maskIsSelected
         return tLayer
 
+    def getPyramidLevel(self):
+        """
+        Overrides vImage.getPyramidLevel()
+        @return:
+        @rtype: int or None
+        """
+        return self.parentImage.pyramidLevel
+
+    def thumbMode(self):
+        """
+        Overrides vImage.thumbMode()
+        @return:
+        @rtype: boolean
+        """
+        level = self.parentImage.pyramidLevel
+        return self.parentImage.useThumb if level is None else level > 0
+
     def initThumb(self):
         """
         Override vImage.initThumb, to set the parentImage attribute
@@ -810,21 +1142,43 @@ class QLayer(vImage):
         @return: current image
         @rtype: QLayer
         """
+        if self.forwarded:
+            forwarded = self.forwarded.get(self.renderMode())
+            if forwarded is not None:
+                return forwarded
         if self.parentImage.useHald:
             return self.getHald()
-        if self.parentImage.useThumb:
+        if self.thumbMode():
             return self.getThumb()
         else:
             return self
 
+    def forwardInput(self):
+        """
+        Pass through : the layer output becomes a reference to
+        the layer input, for the current render mode, and no buffer is copied.
+        The reference is dropped when the layer is executed again (cf. render()),
+        so the layer buffers are written only when the layer produces different pixels.
+        Must be called by execute() only.
+        """
+        self.forwarded[self.renderMode()] = self.inputImg()
+        self.outputDirtyRect = self.inputDirtyRect
+        if self.maskIsEnabled or self.xOffset != 0 or self.yOffset != 0:
+            self.updatePixmap()
+        else:
+            # the input is drawn by getCurrentMaskedImage()
+            self.rPixmap, self.rImage = None, None
+            self.pixmapMode = self.renderMode()
+            self.setModified(True)
+
     def inputImg(self):
         """
-        Updates and returns maskedImageContainer and maskedThumbContainer
+        Updates and returns maskedImageContainer and maskedThumbContainer.
+        During rendering, only the input dirty rectangle of the layer is updated.
         @return:
         @rtype: Qlayer
         """
-        # TODO 29/05/18 optimize to avoid useless updates of containers (add a valid flag to each container and invalidate it in cacheInvalidate())
-        return self.parentImage.layersStack[self.getLowerVisibleStackIndex()].getCurrentMaskedImage()
+        return self.parentImage.layersStack[self.getLowerVisibleStackIndex()].getCurrentMaskedImage(rect=self.inputDirtyRect)
 
     def full2CurrentXY(self, x, y):
         """
@@ -837,13 +1191,13 @@ class QLayer(vImage):
         @return:
         @rtype: 2uple of int
         """
-        if self.parentImage.useThumb:
+        if self.thumbMode():
             currentImg = self.getThumb()
             x = (x * currentImg.width()) / self.width()
             y = (y * currentImg.height()) / self.height()
         return int(x), int(y)
 
-    def getCurrentMaskedImage(self):
+    def getCurrentMaskedImage(self, rect=None):
         """
         Reduces the layer stack up to self (included),
         taking into account the masks. if self.isClipping is True
@@ -852,87 +1206,398 @@ class QLayer(vImage):
         For convenience, mainly to be able to use its color space buffers,
         the built image is of type QLayer. It is drawn on a container image,
         created only once.
+        Compositing is incremental : the container is built from the
+        container of the next lower visible layer, brought up to date first,
+        and from the contribution of self only. It is not redrawn if neither of them
+        changed since the last call.
+        If rect is not None, only rect is redrawn, unless the lower
+        container was fully redrawn since the last call.
+        @param rect: changed region (full size coordinates)
+        @type rect: QRect
         @return: masked image
         @rtype: QLayer
         """
+        # GUI thread : wait for the background renders writing the containers
+        self.parentImage.waitForRender()
         # init containers if needed
         if self.parentImage.useHald:
             return self.getHald()
-        if self.maskedThumbContainer is None:
-            self.maskedThumbContainer = QLayer.fromImage(self.getThumb(), parentImage=self.parentImage)
-        if self.maskedImageContainer is None:
+        if self.thumbMode():
+            # one container per pyramid level
+            level = self.getPyramidLevel()
+            if self.thumbContainers.get(level) is None:
+                self.thumbContainers[level] = QLayer.fromImage(self.getThumb(), parentImage=self.parentImage)
+            self.maskedThumbContainer = self.thumbContainers[level]
+        elif self.maskedImageContainer is None:
             self.maskedImageContainer = QLayer.fromImage(self, parentImage=self.parentImage)
-        if self.parentImage.useThumb:
+        if self.thumbMode():
             img = self.maskedThumbContainer
         else:
             img = self.maskedImageContainer
         # no thumbnails for containers
         img.getThumb = lambda: img
-        # draw lower stack
+        ind = self.getLowerVisibleStackIndex()
+        lower = self.parentImage.layersStack[ind].getCurrentMaskedImage(rect=rect) if ind >= 0 else None
+        # content key : cacheKey() changes whenever a pixmap or image is modified.
+        # The key of the lower container is chained.
+        if self.visible:
+            src = self.rPixmap if self.rPixmap is not None else \
+                  self.rImage if self.rImage is not None else self.getCurrentImage()
+            mask = self.mask.cacheKey() if self.isClipping and self.maskIsEnabled else None
+            own = (src.cacheKey(), self.opacity, int(self.compositionMode), mask)
+        else:
+            own = None
+        key = (None if lower is None else lower.compositeKey, own)
+        previousKey = getattr(img, 'compositeKey', None)
+        if key == previousKey:
+            return img
+        # count of full redraws of the lower container
+        lowerCount = None if lower is None else lower.compositeCount
+        partial = rect is not None and previousKey is not None and lowerCount == getattr(img, 'lowerCount', None)
         qp = QPainter(img)
-        top = self.parentImage.getStackIndex(self)
-        bottom = 0
-        for i, layer in enumerate(self.parentImage.layersStack[bottom:top+1]):
-            if layer.visible:
-                if i == 0:
-                    qp.setCompositionMode(QPainter.CompositionMode_Source)
-                else:
-                    qp.setOpacity(layer.opacity)
-                    qp.setCompositionMode(layer.compositionMode)
-                if layer.rPixmap is not None:
-                    qp.drawPixmap(QRect(0,0,img.width(), img.height()), layer.rPixmap)
-                else:
-                    qp.drawImage(QRect(0,0,img.width(), img.height()), layer.getCurrentImage())
-                # clipping
-                if layer.isClipping and layer.maskIsEnabled: #TODO modified 23/06/18
-                    # draw mask as opacity mask
-                    # mode DestinationIn (set dest opacity to source opacity)
-                    qp.setCompositionMode(QPainter.CompositionMode_DestinationIn)
-                    omask = vImage.color2OpacityMask(layer.mask)
-                    qp.drawImage(QRect(0, 0, img.width(), img.height()), omask)
+        if partial:
+            r = img.width() / self.width()
+            qp.setClipRect(QRect(int(rect.left() * r) - 1, int(rect.top() * r) - 1,
+                                 int(rect.width() * r) + 3, int(rect.height() * r) + 3))
+        target = QRect(0, 0, img.width(), img.height())
+        # draw lower stack
+        qp.setCompositionMode(QPainter.CompositionMode_Source)
+        if lower is not None:
+            qp.drawImage(target, lower)
+        else:
+            qp.fillRect(target, Qt.transparent)
+        if self.visible:
+            if lower is not None:
+                qp.setOpacity(self.opacity)
+                qp.setCompositionMode(self.compositionMode)
+            if self.rPixmap is not None:
+                qp.drawPixmap(target, self.rPixmap)
+            elif self.rImage is not None:
+                qp.drawImage(target, self.rImage)
+            else:
+                qp.drawImage(target, self.getCurrentImage())
+            # clipping
+            if self.isClipping and self.maskIsEnabled:
+                # draw mask as opacity mask
+                # mode DestinationIn (set dest opacity to source opacity)
+                qp.setCompositionMode(QPainter.CompositionMode_DestinationIn)
+                omask = vImage.color2OpacityMask(self.mask)
+                qp.drawImage(target, omask)
         qp.end()
+        img.cacheInvalidate()
+        img.compositeKey = key
+        img.lowerCount = lowerCount
+        if not partial:
+            img.compositeCount = getattr(img, 'compositeCount', 0) + 1
         return img
 
+    def renderMode(self):
+        """
+        Returns the current render mode of the parent image.
+        Pyramid levels k > 0 are rendered in mode 'level<k>'.
+        @return: 'hald', 'thumb', 'level<k>' or 'full'
+        @rtype: str
+        """
+        if self.parentImage.useHald:
+            return 'hald'
+        level = self.parentImage.pyramidLevel
+        if level is not None:
+            return 'level%d' % level if level > 0 else 'full'
+        return 'thumb' if self.parentImage.useThumb else 'full'
+
+    def renderFingerprint(self, mode):
+        """
+        Returns the fingerprint of the layer output in render mode mode.
+        It depends on the layer parameters (paramsVersion and execute)
+        and on the layer input, i.e. on the fingerprints of the lower visible layers and
+        on the way they are composed (opacity, composition mode, offsets and masks).
+        Fingerprints are chained, so no image buffer is read.
+        @param mode: render mode
+        @type mode: str
+        @return: fingerprint
+        @rtype: int
+        """
+        inputs = []
+        for layer in self.parentImage.layersStack[:self.getStackIndex()]:
+            if not layer.visible:
+                continue
+            mask = (layer.maskIsSelected, layer.mask.cacheKey()) if layer.maskIsEnabled else None
+            inputs.append((layer.renderFingerprints.get(mode), layer.opacity, int(layer.compositionMode),
+                           layer.isClipping, layer.xOffset, layer.yOffset, layer.Zoom_coeff, mask))
+        return hash((mode, self.paramsVersion, id(self.execute), tuple(inputs)))
+
+    def isUpToDate(self, mode):
+        """
+        Returns True if the layer output in render mode mode is up to date,
+        possibly as part of a fused run (cf. mImage.renderFused()).
+        @param mode: render mode
+        @type mode: str
+        @return:
+        @rtype: boolean
+        """
+        fp = self.renderFingerprint(mode)
+        recorded = self.renderFingerprints.get(mode)
+        return recorded == fp or recorded == ('fused', fp)
 
-    def applyToStack(self):
+    def isFused(self, mode):
         """
-        Apply new layer parameters and propagate changes to upper layers.
+        Returns True if the layer was rendered in mode as a lower
+        layer of a fused run : its output is not computed.
+        @param mode: render mode
+        @type mode: str
+        @return:
+        @rtype: boolean
         """
-        # recursive function
-        def applyToStack_(layer, pool=None):
-            # apply transformation
-            if layer.visible:
-                start = time()
-                layer.execute(l=layer)
-                layer.cacheInvalidate()
-                print("%s %.2f" %(layer.name, time()-start))
-            stack = layer.parentImage.layersStack
-            lg = len(stack)
-            ind = layer.getStackIndex() + 1
-            # update histograms displayed
-            # on the layer form, if any
-            if ind < lg:
-                grForm = stack[ind].getGraphicsForm()
-                if grForm is not None:
-                    grForm.updateHists()
-            # get next upper visible layer
-            while ind < lg:
-                if stack[ind].visible:
-                    break
-                ind += 1
-            if ind < lg:
-                layer1 = stack[ind]
-                applyToStack_(layer1, pool=pool)
+        return type(self.renderFingerprints.get(mode)) is tuple
+
+    def isFusible(self):
+        """
+        Returns True if the layer can be fused with its neighbours
+        into a single 3D LUT : it must be a point-wise adjustment layer,
+        drawn over its input without mask, offset or blending.
+        @return:
+        @rtype: boolean
+        """
+        return (self.visible and self.tLayer is self and self.pointWise() and not self.isClipping
+                and not self.maskIsEnabled and self.opacity == 1.0
+                and self.compositionMode == QPainter.CompositionMode_SourceOver
+                and self.xOffset == 0 and self.yOffset == 0 and self.Zoom_coeff == 1.0)
+
+    def evaluateOnHald(self, haldIn, haldOut):
+        """
+        Applies the layer to a hald image : execute() is called with
+        haldIn as input and haldOut as output. The layer buffers,
+        pixmap and pass-through state are left unchanged.
+        The current image of haldIn must be haldIn itself (cf. mImage.fusedLUT()) :
+        it is read by the apply* methods converting their input to other color spaces.
+        @param haldIn: input hald
+        @type haldIn: QLayer
+        @param haldOut: output hald
+        @type haldOut: QLayer
+        @return: output hald (haldIn for pass-through)
+        @rtype: QLayer
+        """
+        mode = self.renderMode()
+        saved = {a: self.__dict__[a] for a in ('inputImg', 'getCurrentImage') if a in self.__dict__}
+        rPixmap, rImage, forwarded, dirtyRect = self.rPixmap, self.rImage, self.forwarded.get(mode), self.inputDirtyRect
+        pixmapMode = self.pixmapMode
+        self.inputImg = lambda: haldIn
+        self.getCurrentImage = lambda: haldOut
+        self.inputDirtyRect = None
+        try:
+            self.execute(l=self)
+            return haldIn if self.forwarded.get(mode) is haldIn else haldOut
+        finally:
+            del self.inputImg, self.getCurrentImage
+            self.__dict__.update(saved)
+            self.rPixmap, self.rImage, self.inputDirtyRect = rPixmap, rImage, dirtyRect
+            self.pixmapMode = pixmapMode
+            if forwarded is None:
+                self.forwarded.pop(mode, None)
+            else:
+                self.forwarded[mode] = forwarded
+
+    def render(self, mode, rect=None, force=False):
+        """
+        Brings the layer output up to date : the layer is executed
+        only if its fingerprint changed since the last execution, or if force is True.
+        Previews (render modes other than 'full') are restored from
+        the render cache, if possible.
+        If rect is not None, only rect changed in the layer input : it is
+        passed to execute() as inputDirtyRect, and apply* methods supporting
+        regions of interest recompute it only, recording the changed region of
+        the output in outputDirtyRect. Other methods leave outputDirtyRect to None,
+        meaning the whole output changed.
+        Forced renders (cf. mImage.renderViewport()) compute rect only, even if
+        the output was never rendered, and their partial outputs are not cached.
+        @param mode: render mode
+        @type mode: str
+        @param rect: changed region of the input (full size coordinates)
+        @type rect: QRect
+        @param force: execute the layer, even if it is up to date
+        @type force: boolean
+        @return: 'executed', 'skipped' or 'restored'
+        @rtype: str
+        """
+        fp = self.renderFingerprint(mode)
+        if self.renderFingerprints.get(mode) == fp and not force:
+            # the output is up to date, but the pixmap may be built in another mode
+            self.refreshPixmap(mode)
+            return 'skipped'
+        # the output buffer is written by both restoring and executing
+        if self.forwarded.pop(self.renderMode(), None) is not None and not force:
+            # a partial update needs a valid output
+            rect = None
+        store = self.getTileStore()
+        cached = None if force or fp not in self.renderCache else store.get((self.storeKey, 'render', fp))
+        if cached is not None:
+            buf = QImageBuffer(self.getCurrentImage())
+            if buf.shape == cached.shape:
+                buf[...] = cached
+                self.renderCache.move_to_end(fp)
+                self.cacheInvalidate()
+                self.updatePixmap()
+                self.renderFingerprints[mode] = fp
+                # the input container was not updated : invalidate it
+                ind = self.getLowerVisibleStackIndex()
+                if ind >= 0:
+                    lower = self.parentImage.layersStack[ind]
+                    for container in [lower.maskedImageContainer] + list(lower.thumbContainers.values()):
+                        if container is not None:
+                            container.compositeKey = None
+                return 'restored'
+        # a partial update needs a valid output
+        if not force and (mode == 'hald' or mode not in self.renderFingerprints):
+            rect = None
+        self.inputDirtyRect, self.outputDirtyRect = rect, None
+        try:
+            self.execute(l=self)
+        finally:
+            self.inputDirtyRect = None
+        self.cacheInvalidate()
+        self.renderFingerprints[mode] = fp
+        # pass-through outputs are not cached
+        if mode != 'full' and self.renderCacheSize > 0 and not force and self.renderMode() not in self.forwarded:
+            store.put((self.storeKey, 'render', fp), QImageBuffer(self.getCurrentImage()))
+            self.renderCache[fp] = None
+            self.renderCache.move_to_end(fp)
+            while len(self.renderCache) > self.renderCacheSize:
+                k, _ = self.renderCache.popitem(last=False)
+                store.discard((self.storeKey, 'render', k))
+        return 'executed'
+
+    def applyToStack(self, dirty=True, rect=None):
+        """
+        Apply new layer parameters and propagate changes to upper layers.
+        Upper layers whose input did not change are not executed (cf. render()).
+        Callers which did not modify the layer parameters
+        (e.g. opacity or visibility changes) should set dirty to False.
+        If only a region of the layer input or parameters (e.g. the mask) changed,
+        it should be passed as rect : it is propagated through the stack,
+        each layer growing it by its own reach (cf. render()).
+        Background renders (cf. applyToStackAsync()) are completed first.
+        @param dirty: layer parameters were modified
+        @type dirty: boolean
+        @param rect: changed region (full size coordinates), None for whole image
+        @type rect: QRect
+        """
+        self.parentImage.waitForRender()
+        if dirty:
+            self.paramsVersion += 1
         try:
             QApplication.setOverrideCursor(Qt.WaitCursor)
             QApplication.processEvents()
-            applyToStack_(self, pool=None)
+            self.renderStack(rect=rect)
             # update the presentation layer
             self.parentImage.prLayer.execute(l=None, pool=None)
         finally:
             self.parentImage.setModified(True)
             QApplication.restoreOverrideCursor()
             QApplication.processEvents()
+
+    def applyToStackAsync(self, dirty=True, rect=None):
+        """
+        Asynchronous version of applyToStack(), for interactive
+        updates (sliders...) : the stack is rendered by a worker thread and
+        the method returns immediately. Superseded renders are cancelled.
+        When the render is done, parentImage.onImageChanged() is called
+        from the GUI thread (cf. renderScheduler).
+        The values of the graphics forms of the stack are recorded
+        for the worker thread (cf. snapshotForm()).
+        @param dirty: layer parameters were modified
+        @type dirty: boolean
+        @param rect: changed region (full size coordinates), None for whole image
+        @type rect: QRect
+        """
+        if dirty:
+            self.paramsVersion += 1
+        img = self.parentImage
+        for layer in img.layersStack:
+            if layer.visible:
+                layer.snapshotForm()
+        if img.scheduler is None:
+            img.scheduler = renderScheduler(img)
+        img.scheduler.request(self, rect=rect)
+
+    def renderStack(self, rect=None, cancel=None, updateForms=True):
+        """
+        Renders the layer and the upper layers (cf. render()). The
+        render mode is read once, at the beginning of the render.
+        If cancel is set, the render stops before the next layer.
+        @param rect: changed region (full size coordinates), None for whole image
+        @type rect: QRect
+        @param cancel: cancellation flag
+        @type cancel: threading.Event
+        @param updateForms: update the histograms displayed on the forms (GUI thread only)
+        @type updateForms: boolean
+        @return: True if the render was completed, False if it was cancelled
+        @rtype: boolean
+        """
+        mode = self.renderMode()
+        # only layers up to date before the change can be partially updated.
+        # As the parameters version of self may be already incremented,
+        # self only needs a valid output.
+        synced = set()
+        if rect is not None:
+            synced = {id(l) for l in self.parentImage.layersStack
+                      if l.visible and l.renderFingerprints.get(mode) == l.renderFingerprint(mode)}
+            if mode in self.renderFingerprints and not self.isFused(mode):
+                synced.add(id(self))
+        stack = self.parentImage.layersStack
+        # the lower layers of a fused run have no output :
+        # a render starting inside the run starts at its bottom
+        start = self
+        while True:
+            ind = start.getLowerVisibleStackIndex()
+            if ind < 0 or not stack[ind].isFused(mode):
+                break
+            start = stack[ind]
+        layers = [l for l in stack[start.getStackIndex():] if l.visible]
+        # the outputs of the lower layers are up to date, but their
+        # pixmaps may be built in another mode (e.g. at a coarser pyramid level)
+        for l in stack[:start.getStackIndex()]:
+            if l.visible:
+                l.refreshPixmap(mode)
+        # dirty rectangle propagated to upper layers
+        dirtyRect = rect
+        i = 0
+        while i < len(layers):
+            layer = layers[i]
+            if cancel is not None and cancel.is_set():
+                return False
+            # apply transformation
+            startTime = time()
+            inRect = dirtyRect if id(layer) in synced else None
+            # fuse the run of point-wise layers starting at layer (cf. mImage.renderFused())
+            run = []
+            if inRect is None and (layer.isFused(mode) or not layer.isUpToDate(mode)):
+                run = self.parentImage.fusibleRun(layers[i:], mode)
+            if len(run) > 1:
+                self.parentImage.renderFused(run, mode)
+                result, dirtyRect = 'fused', None
+            else:
+                run = [layer]
+                result = layer.render(mode, rect=inRect)
+                if result == 'executed':
+                    outRect = layer.outputDirtyRect
+                    dirtyRect = None if (inRect is None or outRect is None) else inRect.united(outRect)
+                elif result == 'restored':
+                    dirtyRect = None
+            elapsed = time() - startTime
+            for l in run:
+                l.renderStats[result] += 1
+                l.renderStats['time'] += elapsed / len(run)
+            # update histograms displayed
+            # on the form of the next layer, if any
+            for l in run:
+                ind = l.getStackIndex() + 1
+                if updateForms and ind < len(stack):
+                    grForm = stack[ind].getGraphicsForm()
+                    if grForm is not None:
+                        grForm.updateHists()
+            i += len(run)
+        return True
+
     """
     def applyToStackIter(self):
         #iterative version of applyToStack
@@ -996,9 +1661,42 @@ class QLayer(vImage):
             rImg = rImg.copy(QRect(-x, -y, rImg.width()*self.Zoom_coeff, rImg.height()*self.Zoom_coeff))
         if self.maskIsEnabled:
             rImg = vImage.visualizeMask(rImg, self.mask, color=self.maskIsSelected, clipping=True) #self.isClipping)
-        self.rPixmap = QPixmap.fromImage(rImg)
+        if isGUIThread():
+            self.rPixmap, self.rImage = QPixmap.fromImage(rImg), None
+        else:
+            # QPixmap is not thread safe : rPixmap is built in the GUI thread (cf. syncPixmap())
+            self.rPixmap, self.rImage = None, rImg
+        self.pixmapMode = self.renderMode()
         self.setModified(True)
 
+    def refreshPixmap(self, mode):
+        """
+        Rebuilds rPixmap if it was built in another render mode than mode :
+        a layer up to date in mode (e.g. 'full') may keep the pixmap of its last
+        render (e.g. in preview mode, or at a coarser pyramid level).
+        Layers without mask and offset drop their pixmap instead : their current
+        image is drawn by getCurrentMaskedImage().
+        @param mode: current render mode
+        @type mode: str
+        """
+        if self.pixmapMode == mode:
+            return
+        if self.maskIsEnabled or self.xOffset != 0 or self.yOffset != 0:
+            self.updatePixmap()
+        else:
+            self.rPixmap, self.rImage = None, None
+            self.pixmapMode = mode
+
+    def syncPixmap(self):
+        """
+        Converts the masked image built by a background
+        render, if any, to rPixmap. Must be called from the GUI thread,
+        when no background render is running (cf. renderScheduler.onDone()).
+        """
+        rImg = self.rImage
+        if rImg is not None:
+            self.rPixmap, self.rImage = QPixmap.fromImage(rImg), None
+
 
     def getStackIndex(self):
         """
@@ -1200,10 +1898,32 @@ class QPresentationLayer(QLayer):
     def __init__(self, *args, **kwargs):
         self.qPixmap = None
         self.cmImage = None
+        # images (qImg, rImg) built by a background render, waiting
+        # for their conversion to pixmaps in the GUI thread (cf. syncPixmap())
+        self.pendingImages = None
+        self.pendingLock = threading.Lock()
         super().__init__(*args, **kwargs)
 
     def inputImg(self):
-        return self.parentImage.layersStack[self.getTopVisibleStackIndex()].getCurrentMaskedImage()
+        return self.parentImage.layersStack[self.getTopVisibleStackIndex()].getCurrentMaskedImage(rect=self.inputDirtyRect)
+
+    def applyNone(self):
+        """
+        Overrides vImage.applyNone() : the presentation layer
+        owns the color managed qPixmap, so the input is never
+        forwarded. It is copied and qPixmap is rebuilt.
+        """
+        self.forwarded.clear()
+        bufIn = QImageBuffer(self.inputImg())
+        bufOut = QImageBuffer(self.getCurrentImage())
+        bufOut[:, :, :] = bufIn
+        self.updatePixmap()
+
+    def forwardInput(self):
+        """
+        Overrides QLayer.forwardInput() (cf. applyNone()).
+        """
+        self.applyNone()
 
     def updatePixmap(self, maskOnly = False):
         """
@@ -1236,10 +1956,32 @@ class QPresentationLayer(QLayer):
         if self.maskIsEnabled:
             #qImg = vImage.visualizeMask(qImg, self.mask, color=self.maskIsSelected, clipping=self.isClipping)
             rImg = vImage.visualizeMask(rImg, self.mask, color=self.maskIsSelected, clipping=self.isClipping)
-        self.qPixmap = QPixmap.fromImage(qImg)
-        self.rPixmap = QPixmap.fromImage(rImg)
+        if isGUIThread():
+            self.qPixmap = QPixmap.fromImage(qImg)
+            self.rPixmap = QPixmap.fromImage(rImg)
+            with self.pendingLock:
+                self.pendingImages = None
+        else:
+            # QPixmap is not thread safe : pixmaps are built in the GUI thread (cf. syncPixmap()).
+            # The layer buffer may be overwritten by the next render, so it is copied.
+            copied = currentImage.copy()
+            with self.pendingLock:
+                self.pendingImages = (copied if qImg is currentImage else qImg, copied if rImg is currentImage else rImg)
         self.setModified(True)
 
+    def syncPixmap(self):
+        """
+        Overrides QLayer.syncPixmap() : builds qPixmap and rPixmap
+        from the images of the last background render, if any.
+        Must be called from the GUI thread. The render thread may
+        be running (cf. renderScheduler.onProgress()).
+        """
+        with self.pendingLock:
+            images, self.pendingImages = self.pendingImages, None
+        if images is not None:
+            self.qPixmap = QPixmap.fromImage(images[0])
+            self.rPixmap = QPixmap.fromImage(images[1])
+
     def update(self):
         self.applyNone()
         # self.updatePixmap() done by applyNone()
@@ -1325,26 +2067,92 @@ class QRawLayer(QLayer):
         layer.parentImage = parentImage
         return layer
 
+    # cached stages of the development pipeline, in processing order (cf. rawProcessing.rawPostProcess)
+    rawStages = ('demosaic', 'matrix', 'lookTable', 'toneCurve')
+    # development resolutions (cf. rawProcessing.rawProxy()). Each one has its own cache entries.
+    rawProxies = ('full', 'half', 'quarter')
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.postProcessCache = None
-        self.bufCache_HSV_CV32 = None
+        # (stage, proxy) --> (key, buffer)
+        self.stageCache = {}
+        # resolution of the last development
+        self.proxy = 'full'
+        # linear luminosity image, and key of the matrix stage it was built from
+        self.linearImg, self.linearKey = None, None
+        # white balance multipliers of the grid of samples (cf. rawProcessing.sampleGrid())
+        self.samples = []
+
+    def getStage(self, stage, key, proxy='full'):
+        """
+        Returns the cached output of a development stage if it
+        was computed with the same key, and None otherwise.
+        @param stage: stage name
+        @type stage: str
+        @param key: hash of the stage parameters
+        @type key: int
+        @param proxy: development resolution
+        @type proxy: str
+        @return:
+        @rtype: ndarray or None
+        """
+        entry = self.stageCache.get((stage, proxy))
+        if entry is None or entry[0] != key:
+            return None
+        return entry[1]
+
+    def setStage(self, stage, key, buf, proxy='full'):
+        """
+        Caches the output of a development stage.
+        @param stage: stage name
+        @type stage: str
+        @param key: hash of the stage parameters
+        @type key: int
+        @param buf:
+        @type buf: ndarray
+        @param proxy: development resolution
+        @type proxy: str
+        """
+        self.stageCache[(stage, proxy)] = (key, buf)
+
+    def invalidateStages(self, stage='demosaic'):
+        """
+        Drops the cached outputs of stage and of all subsequent stages,
+        for all development resolutions.
+        @param stage: stage name
+        @type stage: str
+        """
+        for s in self.rawStages[self.rawStages.index(stage):]:
+            for proxy in self.rawProxies:
+                self.stageCache.pop((s, proxy), None)
 
     @property
     def postProcessCache(self):
-        return self.__postProcessCache
+        """
+        HSV image after white balance and color matrix (last
+        development resolution). Setting it to None invalidates all stages.
+        """
+        return self.stageCache.get(('matrix', self.proxy), (None, None))[1]
 
     @postProcessCache.setter
     def postProcessCache(self, buf):
-        self.__postProcessCache = buf
+        if buf is not None:
+            raise ValueError('postProcessCache : use setStage()')
+        self.invalidateStages('demosaic')
 
     @property
     def bufCache_HSV_CV32(self):
-        return self.__bufCache_HSV_CV32
+        """
+        HSV image after the tone curves. Setting it to None
+        invalidates the camera profile stages.
+        """
+        return self.stageCache.get(('toneCurve', self.proxy), (None, None))[1]
 
     @bufCache_HSV_CV32.setter
     def bufCache_HSV_CV32(self, buffer):
-        self.__bufCache_HSV_CV32 = buffer
+        if buffer is not None:
+            raise ValueError('bufCache_HSV_CV32 : use setStage()')
+        self.invalidateStages('matrix')
 
 
 
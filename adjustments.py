@@ -0,0 +1,504 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+#############################################
+# Adjustment algorithms, independent of layers and graphics forms.
+# Each adjustment is a function of an image buffer and of a
+# parameter object. Buffers are ndarrays, shape (h, w, 3) or (h, w, 4),
+# with BGR(A) channel order, as returned by QImageBuffer(), or by cv2.imread().
+# Functions return the BGR channels of the adjusted image, shape (h, w, 3),
+# the alpha channel, if any, is left to the caller.
+# Parameter objects are plain python objects : they can be pickled
+# and sent to worker processes. The vImage.apply* methods build them from
+# the values of the graphics forms (cf. adjustmentParams.fromForm() and
+# utils.formSnapshot) and call the functions.
+#############################################
+from copy import deepcopy
+
+import cv2
+import numpy as np
+
+from bLUeCore.dwtDenoising import dwtDenoiseChan
+from bLUeCore.kernel import filterIndex, getKernel
+from bLUeGui.colorCIE import rgb2rgbLinearVec, rgbLinear2rgbVec, sRGB2XYZVec, sRGB_lin2XYZInverse, \
+    bbTemperature2RGB, Lab2sRGBVec, sRGB2LabVec
+from bLUeGui.colorCube import rgb2hlsVec, hls2rgbVec, rgb2hspVec, hsp2rgbVec, hsv2rgbVec
+from bLUeGui.histogramWarping import warpHistogram
+from bLUeGui.multiplier import temperatureAndTint2Multipliers
+
+
+class adjustmentParams(object):
+    """
+    Base class for adjustment parameters. Subclasses
+    list the names and default values of their attributes
+    in the class attribute defaults. The attribute options
+    is a dict of boolean options.
+    """
+    defaults = {}
+
+    @classmethod
+    def fromForm(cls, form, **kwargs):
+        """
+        Builds a parameter object from the attributes of a graphics form.
+        Missing attributes get their default values. Options are copied
+        to a plain dict.
+        @param form: graphics form or snapshot of its values
+        @type form: QWidget or formSnapshot
+        @param kwargs: overriding values
+        @type kwargs: dict
+        @return:
+        @rtype: adjustmentParams
+        """
+        values = {}
+        for name, default in cls.defaults.items():
+            if name == 'options':
+                options = getattr(form, 'options', None)
+                if options is not None:
+                    values[name] = {key: bool(options[key]) for key in default}
+            elif hasattr(form, name):
+                values[name] = getattr(form, name)
+        values.update(kwargs)
+        return cls(**values)
+
+    def __init__(self, **kwargs):
+        for name, default in self.defaults.items():
+            setattr(self, name, deepcopy(default))
+        for name, value in kwargs.items():
+            if name not in self.defaults:
+                raise TypeError('%s : unknown parameter %s' % (type(self).__name__, name))
+            setattr(self, name, value)
+
+    def isNeutral(self):
+        """
+        Returns True if the adjustment does not modify images.
+        @return:
+        @rtype: boolean
+        """
+        return False
+
+
+class exposureParams(adjustmentParams):
+    defaults = {'exposureCorrection': 0.0}
+
+    def isNeutral(self):
+        return abs(self.exposureCorrection) < 0.05
+
+
+class contrastParams(adjustmentParams):
+    """
+    spline is the (quadratic) spline used by histogram warping,
+    None for an automatic spline. In this case, the function
+    contrast() sets the attribute curve to the
+    coefficients (a, b, d, T) of the automatic spline.
+    """
+    defaults = {'contrastCorrection': 0.0, 'satCorrection': 0.0, 'brightnessCorrection': 0.0,
+                'options': {'Multi-Mode': True, 'CLAHE': False, 'High': True, 'manualCurve': False},
+                'version': 'HSV', 'spline': None, 'curve': None}
+
+    def isNeutral(self):
+        return self.contrastCorrection == 0 and self.satCorrection == 0 and self.brightnessCorrection == 0
+
+    def isPointWise(self):
+        return self.contrastCorrection == 0
+
+
+class temperatureParams(adjustmentParams):
+    defaults = {'tempCorrection': 6500, 'tintCorrection': 0.0,
+                'options': {'Photo Filter': False, 'Chromatic Adaptation': True}}
+
+    def isNeutral(self):
+        return abs(self.tempCorrection - 6500) < 200 and self.tintCorrection == 0
+
+
+class lut1DParams(adjustmentParams):
+    """
+    stackedLUT is an array of color values (range 0..255), shape (3, 256) :
+    a row for each channel of the color space.
+    """
+    defaults = {'stackedLUT': np.arange(256)[np.newaxis, :].repeat(3, axis=0)}
+
+    def isNeutral(self):
+        return not np.any(self.stackedLUT - np.arange(256))  # last dims are equal : broadcast is working
+
+
+class filterParams(adjustmentParams):
+    defaults = {'kernelCategory': filterIndex.UNSHARP, 'radius': 10, 'amount': 50.0, 'tone': 100.0}
+
+
+class noiseParams(adjustmentParams):
+    defaults = {'noiseCorrection': 0, 'options': {'Wavelets': True, 'Bilateral': False, 'NLMeans': False}}
+
+    def isNeutral(self):
+        return self.noiseCorrection == 0
+
+
+def exposure(buf, params):
+    """
+    Applies exposure correction 2**exposureCorrection
+    to the linearized RGB channels.
+    @param buf: BGR(A) buffer
+    @type buf: ndarray, dtype uint8
+    @param params:
+    @type params: exposureParams
+    @return: BGR buffer
+    @rtype: ndarray, shape (h, w, 3)
+    """
+    rgb = rgb2rgbLinearVec(buf[:, :, :3][:, :, ::-1])
+    rgb *= 2 ** params.exposureCorrection
+    rgb = rgbLinear2rgbVec(rgb)
+    np.clip(rgb, 0.0, 255.0, out=rgb)
+    return rgb[:, :, ::-1]
+
+
+def contrast(buf, params, converted=None):
+    """
+    Applies contrast, saturation and brightness corrections.
+    If params.version is 'HSV' (default), the
+    image is converted to HSV and the correction is applied to
+    the S and V channels. Otherwise, the Lab color space is used.
+    Contrast corrections are histogram warping or CLAHE.
+    @param buf: BGR(A) buffer
+    @type buf: ndarray, dtype uint8
+    @param params:
+    @type params: contrastParams
+    @param converted: buf converted to HSV (opencv ranges) or Lab, computed if None. It is not modified.
+    @type converted: ndarray
+    @return: BGR buffer
+    @rtype: ndarray, shape (h, w, 3)
+    """
+    options = params.options
+    contrastCorrection = params.contrastCorrection
+    ##########################
+    # Lab mode, slower than HSV
+    ##########################
+    if params.version == 'Lab':
+        # L range is 0..1
+        LBuf = (sRGB2LabVec(buf[:, :, :3][:, :, ::-1]) if converted is None else converted).copy()
+        if params.brightnessCorrection != 0:
+            alpha = -params.brightnessCorrection + 1.0
+            # convert L to L**alpha
+            LBuf[:, :, 0] = np.power(LBuf[:, :, 0], alpha)
+        if contrastCorrection > 0:
+            # CLAHE
+            if options['CLAHE']:
+                clahe = cv2.createCLAHE(clipLimit=contrastCorrection, tileGridSize=(8, 8))
+                res = clahe.apply((LBuf[:, :, 0] * 255.0).astype(np.uint8)) / 255
+            # warping
+            else:
+                res, a, b, d, T = warpHistogram(LBuf[:, :, 0], warp=contrastCorrection,
+                                                preserveHigh=options['High'], spline=params.spline)
+                params.curve = (a, b, d, T)
+            LBuf[:, :, 0] = res
+        if params.satCorrection != 0:
+            slope = max(0.1, params.satCorrection / 25 + 1)  # range 0.1..3
+            # multiply a and b channels
+            LBuf[:, :, 1:3] *= slope
+            LBuf[:, :, 1:3] = np.clip(LBuf[:, :, 1:3], -127, 127)
+        # back to RGB
+        return Lab2sRGBVec(LBuf)[:, :, ::-1]
+    ###########
+    # HSV mode (default)
+    ###########
+    # H, S, V are in range 0..255
+    HSVBuf = (cv2.cvtColor(buf[:, :, :3], cv2.COLOR_BGR2HSV) if converted is None else converted).copy()
+    if params.brightnessCorrection != 0:
+        alpha = 1.0 / (0.501 + params.brightnessCorrection) - 1.0  # approx. map -0.5...0.0...0.5 --> +inf...1.0...0.0
+        # tabulate x**alpha
+        LUT = np.power(np.arange(256) / 255, alpha) * 255
+        # convert V to V**alpha
+        HSVBuf[:, :, 2] = LUT[HSVBuf[:, :, 2]]  # faster than take
+    if contrastCorrection > 0:
+        # CLAHE
+        if options['CLAHE']:
+            clahe = cv2.createCLAHE(clipLimit=contrastCorrection, tileGridSize=(8, 8))
+            res = clahe.apply(HSVBuf[:, :, 2])
+        # warping
+        else:
+            buf32 = HSVBuf[:, :, 2].astype(np.float64) / 255
+            res, a, b, d, T = warpHistogram(buf32, warp=contrastCorrection, preserveHigh=options['High'],
+                                            spline=params.spline)
+            res = (res * 255.0).astype(np.uint8)
+            params.curve = (a, b, d, T)
+        HSVBuf[:, :, 2] = res
+    if params.satCorrection != 0:
+        alpha = 1.0 / (0.501 + params.satCorrection) - 1.0  # approx. map -0.5...0.0...0.5 --> +inf...1.0...0.0
+        # tabulate x**alpha
+        LUT = np.power(np.arange(256) / 255, alpha) * 255
+        # convert saturation s to s**alpha
+        HSVBuf[:, :, 1] = LUT[HSVBuf[:, :, 1]]  # faster than take
+    # back to BGR
+    return cv2.cvtColor(HSVBuf, cv2.COLOR_HSV2BGR)
+
+
+def temperature(buf, params):
+    """
+    Color temperature correction. Two algorithms are implemented :
+        - Chromatic adaptation : multipliers in linear sRGB.
+        - Photo filter : Blending using mode multiply, plus correction of luminosity
+    @param buf: BGR(A) buffer
+    @type buf: ndarray, dtype uint8
+    @param params:
+    @type params: temperatureParams
+    @return: BGR buffer
+    @rtype: ndarray, shape (h, w, 3), dtype uint8
+    """
+    options = params.options
+    bufRGB = buf[:, :, :3][:, :, ::-1]
+    ################
+    # photo filter
+    ################
+    if options['Photo Filter']:
+        # multiply by the black body color
+        filtered = bufRGB * (np.array(bbTemperature2RGB(params.tempCorrection), dtype=np.float64) / 255)
+        # correct the luminosity of the resulting image,
+        # by blending it with the input image, using mode luminosity
+        # (cf. bLUeGui.blend.blendLuminosity()).
+        hlsFiltered = rgb2hlsVec(filtered.astype(np.uint8))
+        hlsFiltered[:, :, 1] = rgb2hlsVec(np.ascontiguousarray(bufRGB))[:, :, 1]
+        bufOutRGB = hls2rgbVec(hlsFiltered)
+    #####################
+    # Chromatic adaptation
+    #####################
+    elif options['Chromatic Adaptation']:
+        # get RGB multipliers
+        m1, m2, m3, _ = temperatureAndTint2Multipliers(params.tempCorrection, 2 ** params.tintCorrection,
+                                                       sRGB_lin2XYZInverse)
+        bufXYZ = sRGB2XYZVec(bufRGB)
+        bufsRGBLinear = np.tensordot(bufXYZ, sRGB_lin2XYZInverse, axes=(-1, -1))
+        # apply multipliers
+        bufsRGBLinear *= [m1, m2, m3]
+        # brightness correction
+        M = np.max(bufsRGBLinear)
+        bufsRGBLinear /= M
+        bufOutRGB = rgbLinear2rgbVec(bufsRGBLinear)
+    else:
+        raise ValueError('temperature : wrong option')
+    np.clip(bufOutRGB, 0, 255, out=bufOutRGB)
+    return bufOutRGB.astype(np.uint8)[:, :, ::-1]
+
+
+def rgbLUT(buf, params):
+    """
+    Applies 1D LUTs to the R, G, B channels.
+    @param buf: BGR(A) buffer
+    @type buf: ndarray, dtype uint8
+    @param params:
+    @type params: lut1DParams
+    @return: BGR buffer
+    @rtype: ndarray, shape (h, w, 3), dtype uint8
+    """
+    stackedLUT = params.stackedLUT
+    out = np.empty(buf.shape[:2] + (3,), dtype=np.uint8)
+    for c in range(3):  # 0.36s for 15Mpx
+        out[:, :, c] = np.take(stackedLUT[2 - c, :], buf[:, :, c])
+    return out
+
+
+def labLUT(buf, params, converted=None):
+    """
+    Applies 1D LUTs to the L, a, b channels.
+    @param buf: BGR(A) buffer
+    @type buf: ndarray, dtype uint8
+    @param params:
+    @type params: lut1DParams
+    @param converted: buf converted to Lab (cf. sRGB2LabVec()), computed if None. It is not modified.
+    @type converted: ndarray
+    @return: BGR buffer
+    @rtype: ndarray, shape (h, w, 3)
+    """
+    # convert LUT to float to speed up buffer conversions
+    stackedLUT = params.stackedLUT.astype(np.float64)
+    ndLabImg0 = sRGB2LabVec(buf[:, :, :3][:, :, ::-1]) if converted is None else converted
+    # scale to 0..255, copy is mandatory here to avoid the corruption of a cached Lab buffer
+    ndLImg0 = ndLabImg0 + [0.0, 128.0, 128.0]
+    ndLImg0[:, :, 0] *= 255.0
+    ndLImg0 = ndLImg0.astype(np.uint8)
+    ndLabImg1 = np.empty(ndLImg0.shape, dtype=np.float64)
+    for c in range(3):  # 0.43s for 15Mpx
+        ndLabImg1[:, :, c] = np.take(stackedLUT[c, :], ndLImg0[:, :, c])
+    ndLabImg1 -= [0.0, 128.0, 128.0]
+    ndLabImg1[:, :, 0] /= 255.0
+    ndsRGBImg1 = Lab2sRGBVec(ndLabImg1)
+    np.clip(ndsRGBImg1, 0, 255, out=ndsRGBImg1)  # mandatory
+    return ndsRGBImg1[:, :, ::-1]
+
+
+def hsvLUT(buf, params, converted=None):
+    """
+    Applies 1D LUTs to the hue, saturation and value channels.
+    @param buf: BGR(A) buffer
+    @type buf: ndarray, dtype uint8
+    @param params:
+    @type params: lut1DParams
+    @param converted: buf converted to HSV (opencv ranges), computed if None. It is not modified.
+    @type converted: ndarray
+    @return: BGR buffer
+    @rtype: ndarray, shape (h, w, 3)
+    """
+    # convert LUT to float to speed up buffer conversions
+    stackedLUT = params.stackedLUT.astype(np.float64)
+    # range H: 0..180, S:0..255 V:0..255
+    HSVImg0 = cv2.cvtColor(buf[:, :, :3], cv2.COLOR_BGR2HSV) if converted is None else converted
+    HSVImg0 = HSVImg0.astype(np.uint8)
+    HSVImg1 = np.empty(HSVImg0.shape, dtype=np.uint8)
+    for c in range(3):  # 0.43s for 15Mpx
+        HSVImg1[:, :, c] = np.take(stackedLUT[c, :], HSVImg0[:, :, c])
+    RGBImg1 = hsv2rgbVec(HSVImg1, cvRange=True)
+    np.clip(RGBImg1, 0, 255, out=RGBImg1)  # mandatory
+    return RGBImg1[:, :, ::-1]
+
+
+def hspbLUT(buf, params, converted=None):
+    """
+    Applies 1D LUTs to the hue, saturation and perceptual brightness channels.
+    @param buf: BGR(A) buffer
+    @type buf: ndarray, dtype uint8
+    @param params:
+    @type params: lut1DParams
+    @param converted: buf converted to HSpB (cf. rgb2hspVec()), computed if None. It is not modified.
+    @type converted: ndarray
+    @return: BGR buffer
+    @rtype: ndarray, shape (h, w, 3)
+    """
+    ndHSPBImg0 = rgb2hspVec(buf[:, :, :3][:, :, ::-1]) if converted is None else converted
+    # apply LUTS to normalized channels (range 0..255)
+    ndLImg0 = (ndHSPBImg0 * [255.0 / 360.0, 255.0, 255.0]).astype(np.uint8)
+    ndHSBPImg1 = np.empty(ndLImg0.shape, dtype=np.uint8)
+    for c in range(3):  # 0.36s for 15Mpx
+        ndHSBPImg1[:, :, c] = np.take(params.stackedLUT[c, :], ndLImg0[:, :, c])
+    ndRGBImg1 = hsp2rgbVec(ndHSBPImg1)  # time 4s for 15 Mpx
+    np.clip(ndRGBImg1, 0, 255, out=ndRGBImg1)  # mandatory
+    return ndRGBImg1[:, :, ::-1]
+
+
+def filterKernel(params, scale=1.0):
+    """
+    Returns the convolution kernel of a 2D filter, or
+    None for bilateral filters.
+    @param params:
+    @type params: filterParams
+    @param scale: image scale (e.g. preview size / full size)
+    @type scale: float
+    @return:
+    @rtype: ndarray or None
+    """
+    if params.kernelCategory in [filterIndex.IDENTITY, filterIndex.UNSHARP, filterIndex.SHARPEN,
+                                 filterIndex.BLUR1, filterIndex.BLUR2]:
+        return getKernel(params.kernelCategory, int(params.radius * scale), params.amount)
+    return None
+
+
+def filterMargin(params, scale=1.0):
+    """
+    Returns the reach of a 2D filter (pixels) : an output pixel
+    depends on the input pixels at a distance up to the reach.
+    @param params:
+    @type params: filterParams
+    @param scale: image scale (e.g. preview size / full size)
+    @type scale: float
+    @return:
+    @rtype: int
+    """
+    kernel = filterKernel(params, scale=scale)
+    if kernel is not None:
+        return max(kernel.shape) // 2
+    radius = int(params.radius * scale)
+    # for a null diameter, opencv computes it from sigmaSpace
+    return radius if radius > 0 else int(round(3 * params.tone))
+
+
+def filter2D(buf, params, scale=1.0):
+    """
+    Applies a 2D filter (convolution kernel or bilateral filter).
+    @param buf: BGR(A) buffer
+    @type buf: ndarray, dtype uint8
+    @param params:
+    @type params: filterParams
+    @param scale: image scale (e.g. preview size / full size)
+    @type scale: float
+    @return: BGR buffer
+    @rtype: ndarray, shape (h, w, 3), dtype uint8
+    """
+    kernel = filterKernel(params, scale=scale)
+    # kernel based filtering
+    if kernel is not None:
+        return cv2.filter2D(buf[:, :, :3], -1, kernel)
+    # bilateral filtering
+    sigmaColor = 2 * params.tone
+    sigmaSpace = sigmaColor
+    return cv2.bilateralFilter(np.ascontiguousarray(buf[:, :, :3]), int(params.radius * scale), sigmaColor, sigmaSpace)
+
+
+def noiseMargin(params, preview=False):
+    """
+    Returns the reach of a noise reduction filter (pixels),
+    or None if the filter is not local (wavelets).
+    @param params:
+    @type params: noiseParams
+    @param preview: preview settings
+    @type preview: boolean
+    @return:
+    @rtype: int or None
+    """
+    if params.options['Wavelets']:
+        return None
+    if params.options['Bilateral']:
+        # bilateral diameter
+        return (9 if preview else 15) // 2 + 1
+    # NLMeans template + search windows
+    return 7 // 2 + 21 // 2
+
+
+def denoise(buf, params, scale=1.0, preview=False):
+    """
+    Noise reduction : wavelets, bilateral filter or NLMeans.
+    @param buf: BGR(A) buffer
+    @type buf: ndarray, dtype uint8
+    @param params:
+    @type params: noiseParams
+    @param scale: image scale (e.g. preview size / full size)
+    @type scale: float
+    @param preview: use faster (preview) settings
+    @type preview: boolean
+    @return: BGR buffer
+    @rtype: ndarray, shape (h, w, 3), dtype uint8
+    """
+    buf01 = np.ascontiguousarray(buf[:, :, :3][:, :, ::-1])
+    noisecorr = params.noiseCorrection * scale
+    if params.options['Wavelets']:
+        noisecorr *= 100
+        bufLab = cv2.cvtColor(buf01, cv2.COLOR_RGB2Lab)
+        L = dwtDenoiseChan(bufLab, chan=0, thr=noisecorr, thrmode='wiener')
+        A = dwtDenoiseChan(bufLab, chan=1, thr=noisecorr, thrmode='wiener')
+        B = dwtDenoiseChan(bufLab, chan=2, thr=noisecorr, thrmode='wiener')
+        np.clip(L, 0, 255, out=L)
+        np.clip(A, 0, 255, out=A)
+        np.clip(B, 0, 255, out=B)
+        bufLab = np.dstack((L, A, B))
+        # back to BGR
+        return cv2.cvtColor(bufLab.astype(np.uint8), cv2.COLOR_Lab2BGR)
+    elif params.options['Bilateral']:
+        return cv2.bilateralFilter(buf01,
+                                   9 if preview else 15,  # diameter of (coordinate) pixel neighborhood,
+                                                          # 5 is the recommended value for fast processing
+                                   10 * params.noiseCorrection,  # std deviation sigma in color space, 100 middle value
+                                   50 if preview else 150,  # std deviation sigma in coordinate space, 100 middle value
+                                   )[:, :, ::-1]
+    elif params.options['NLMeans']:
+        # hluminance, hcolor, last params window sizes 7, 21 are recommended values
+        return cv2.fastNlMeansDenoisingColored(buf01, None, 1 + noisecorr, 1 + noisecorr, 7, 21)[:, :, ::-1]
+    return buf[:, :, :3]
@@ -119,6 +119,7 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 import numpy as np
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import sys
 import threading
 from itertools import cycle
@@ -132,8 +133,10 @@ from types import MethodType
 import rawpy
 
 from bLUeCore.bLUeLUT3D import haldArray
+from bLUeCore.multi import calibrateParallelThreshold
+from bLUeCore.scheduler import setParallelThreshold
 from grabcut import segmentForm
-from PySide2.QtCore import QRect, QEvent, QUrl, QSize, QFileInfo, QRectF, QObject
+from PySide2.QtCore import QRect, QEvent, QUrl, QSize, QFileInfo, QRectF, QObject, QPoint, QSettings
 from PySide2.QtGui import QPixmap, QPainter, QCursor, QKeySequence, QBrush, QPen, QDesktopServices, QFont, \
     QPainterPath, QTransform, QContextMenuEvent, QColor, QImage
 from PySide2.QtWidgets import QApplication, QAction,\
@@ -157,7 +160,7 @@ from colorManagement import icc
 from graphicsCoBrSat import CoBrSatForm
 from graphicsExp import ExpForm
 from graphicsPatch import patchForm
-from settings import USE_POOL, POOL_SIZE, THEME, MAX_ZOOM, TABBING
+from settings import USE_POOL, POOL_SIZE, USE_THREADS, THEME, MAX_ZOOM, TABBING
 from utils import QbLUeColorDialog
 from bLUeGui.tool import cropTool, rotatingTool
 from graphicsTemp import temperatureForm
@@ -168,9 +171,8 @@ from graphicsHspbLUT import graphicsHspbForm
 from graphicsLabLUT import graphicsLabForm
 from splittedView import splittedWindow
 
-from bLUeCore.demosaicing import demosaic
 from bLUeGui.dialog import *
-from viewer import playDiaporama, viewer
+from viewer import playDiaporama, viewer, lutViewer
 
 ##################
 #  Software Attributions
@@ -237,6 +239,22 @@ def paintEvent(widg, e):
     if mimg is None:
         return
     r = mimg.resize_coeff(widg)
+    # progressive rendering : refine the preview if
+    # the display needs a finer pyramid level (cf. vImage.progressiveLevels())
+    if widg is window.label:
+        level = mimg.densityLevel(r)
+        # viewport rendering : render the visible region at the display level (cf. mImage.renderViewport())
+        if mimg.useViewport:
+            viewport = QRect(int(-mimg.xOffset / r), int(-mimg.yOffset / r), int(widg.width() / r) + 1,
+                             int(widg.height() / r) + 1).intersected(QRect(0, 0, mimg.width(), mimg.height()))
+            if viewport != mimg.viewportRect or level != mimg.displayLevel:
+                mimg.viewportRect, mimg.displayLevel = viewport, level
+                mimg.layersStack[0].applyToStackAsync(dirty=False)
+        elif level != mimg.displayLevel:
+            mimg.displayLevel = level
+            current = mimg.pyramidLevel if mimg.pyramidLevel is not None else mimg.defaultThumbLevel()
+            if mimg.useThumb and max(level, 1) < current:
+                mimg.layersStack[0].applyToStackAsync(dirty=False)
     qp.begin(widg)
     # smooth painting
     qp.setRenderHint(QPainter.SmoothPixmapTransform)  # TODO may be useless
@@ -343,6 +361,8 @@ def mouseEvent(widget, event):  # TODO split into 3 handlers
         State['ix'], State['iy'] = x, y
         State['ix_begin'], State['iy_begin'] = x, y
         State['x_imagePrecPos'], State['y_imagePrecPos'] = (x - img.xOffset) // r, (y - img.yOffset) // r
+        # region modified by drawing tools
+        State['dirtyRect'] = None
         return  # no update needed
     ##################
     # mouse move event
@@ -378,6 +398,8 @@ def mouseEvent(widget, event):  # TODO split into 3 handlers
                         color = vImage.defaultColor_UnMasked if window.btnValues['drawFG'] else vImage.defaultColor_Masked
                     else:
                         color = vImage.defaultColor_UnMasked_Invalid if window.btnValues['drawFG'] else vImage.defaultColor_Invalid
+                    # the mask and the stack must not be modified during background renders
+                    img.waitForRender()
                     qp.begin(layer.mask)
                     # get pen width
                     w_pen = window.verticalSlider1.value() // r
@@ -390,6 +412,11 @@ def mouseEvent(widget, event):  # TODO split into 3 handlers
                     qp.drawLine(State['x_imagePrecPos'], State['y_imagePrecPos'], tmp_x, tmp_y)
                     qp.drawEllipse(tmp_x-w_pen//2, tmp_y-w_pen//2, w_pen, w_pen)
                     qp.end()
+                    # accumulate the modified region (full size coordinates)
+                    segRect = QRect(QPoint(int(State['x_imagePrecPos']), int(State['y_imagePrecPos'])), QPoint(int(tmp_x), int(tmp_y))).normalized()
+                    m = int(w_pen) + 1
+                    segRect = segRect.adjusted(-m, -m, m, m)
+                    State['dirtyRect'] = segRect if State.get('dirtyRect') is None else State['dirtyRect'].united(segRect)
                     State['x_imagePrecPos'], State['y_imagePrecPos'] = tmp_x, tmp_y
                     ############################
                     # update upper stack
@@ -409,6 +436,7 @@ def mouseEvent(widget, event):  # TODO split into 3 handlers
                         window.cropTool.drawCropTool(img)
                 # drag active layer only
                 elif modifiers == Qt.ControlModifier:
+                    img.waitForRender()
                     layer.xOffset += (x - State['ix'])
                     layer.yOffset += (y - State['iy'])
                     layer.updatePixmap()
@@ -445,7 +473,7 @@ def mouseEvent(widget, event):  # TODO split into 3 handlers
             if layer.maskIsEnabled \
                     and layer.getUpperVisibleStackIndex() != -1\
                     and (window.btnValues['drawFG'] or window.btnValues['drawBG']):
-                layer.applyToStack()
+                layer.applyToStack(rect=State.get('dirtyRect'))
             if img.isMouseSelectable:
                 # click event
                 if clicked:
@@ -487,8 +515,8 @@ def mouseEvent(widget, event):  # TODO split into 3 handlers
                             form = layer.getGraphicsForm()
                             if form.sampleMultipliers:
                                 row, col = 3*y_img//layer.height(), 3*x_img//layer.width()
-                                if form.samples:
-                                    form.setRawMultipliers(*form.samples[3*row + col], sampling=False)
+                                if layer.samples:
+                                    form.setRawMultipliers(*layer.samples[3*row + col], sampling=False)
                             else:
                                 form.setRawMultipliers(1/color[0], 1/color[1], 1/color[2], sampling=True)
                 """
@@ -777,38 +805,34 @@ def loadImageFromFile(f, createsidecar=True):
         rawpyInst = rawpy.RawPy()
         with open(f, "rb") as bufio:
             rawpyInst.open_buffer(bufio)
-        ######################################################################################
-        # unpack always applies the current tone curve (cf. https://www.libraw.org/node/2003)
-        # read from file for Nikon, Sony and some other cameras.
-        # Another curve (array, shape=65536) can be loaded here before unpacking.
-        # NO EFFECT with files where the curve is calculated on unpack() phase (e.g.Nikon lossy NEF files).
-        #####################################################################################
-        rawpyInst.unpack()
-        # postprocess raw image, applying default settings (cf. vImage.applyRawPostProcessing)
-        rawBuf = rawpyInst.postprocess(use_camera_wb=True)
-        # build Qimage
-        rawBuf = np.dstack((rawBuf[:, :, ::-1], np.zeros(rawBuf.shape[:2], dtype=np.uint8)+255))
+        # Sensor data are unpacked and developed later, in the background, by
+        # the development layer (cf. mImage.unpackRaw()). Meanwhile, we show the
+        # embedded jpg preview, scaled to the size of the developed image.
+        rawBuf = rawPreview(f, rawpyInst)
+        unpacked = rawBuf is None
+        if unpacked:
+            ######################################################################################
+            # unpack always applies the current tone curve (cf. https://www.libraw.org/node/2003)
+            # read from file for Nikon, Sony and some other cameras.
+            # Another curve (array, shape=65536) can be loaded here before unpacking.
+            # NO EFFECT with files where the curve is calculated on unpack() phase (e.g.Nikon lossy NEF files).
+            #####################################################################################
+            rawpyInst.unpack()
+            # no valid preview : postprocess raw image, applying default settings (cf. vImage.applyRawPostProcessing)
+            rawBuf = rawpyInst.postprocess(use_camera_wb=True)
+            # build Qimage
+            rawBuf = np.dstack((rawBuf[:, :, ::-1], np.zeros(rawBuf.shape[:2], dtype=np.uint8)+255))
         img = imImage(cv2Img=rawBuf, colorSpace=colorSpace, orientation=transformation, rawMetadata=metadata, profile=profile, name=name, rating=rating)
         img.filename = f
         # keep references to rawPy instance. rawpyInst.raw_image is the (linearized) sensor image
         img.rawImage = rawpyInst
+        img.rawUnpacked = unpacked
         # img.filename = f # TODO removed 29/10/18 done by imImage()
         # img.raw_image_from_profile = (rawpyInst.raw_image).copy()
         # img.raw_image_from_profile_min, img.raw_image_from_profile_max = np.min(rawpyInst.raw_image), np.max(rawpyInst.raw_image)
-        #########################################################
-        # Reconstructing the demosaic Bayer bitmap :
-        # we need it to calculate the multipliers corresponding
-        # to a user white point, and we cannot access the
-        # native rawpy demosaic buffer from the RawPy instance !!!!
-        #########################################################
-        # get 16 bits Bayer bitmap
-        img.demosaic = demosaic(rawpyInst.raw_image_visible, rawpyInst.raw_colors_visible, rawpyInst.black_level_per_channel)
-        # correct orientation
-        if orientation == 6:  # 90°
-            img.demosaic = np.swapaxes(img.demosaic, 0, 1)
-        elif orientation == 8:  # 270°
-            img.demosaic = np.swapaxes(img.demosaic, 0, 1)
-            img.demosaic = img.demosaic[:, ::-1, :]
+        # The demosaic Bayer bitmap (img.demosaic), used to calculate
+        # the multipliers corresponding to a user white point,
+        # is built on demand.
     else:
         raise ValueError("Cannot read file %s" % f)
     if img.isNull():
@@ -821,6 +845,43 @@ def loadImageFromFile(f, createsidecar=True):
     return img
 
 
+def rawPreview(f, rawpyInst):
+    """
+    Returns the jpg preview embedded in a raw file, rotated
+    and scaled to the size of the developed image, or None if
+    the file has no valid preview. Only the metadata of
+    the raw file are needed : rawpyInst must be opened, but it
+    may be unpacked later.
+    @param f: path to raw file
+    @type f: str
+    @param rawpyInst:
+    @type rawpyInst: rawpy.RawPy
+    @return: BGRA image
+    @rtype: ndarray or None
+    """
+    sizes = rawpyInst.sizes
+    w, h = sizes.width, sizes.height
+    if sizes.flip in (5, 6):
+        w, h = h, w
+    preview = QImage()
+    try:
+        with exiftool.ExifTool() as e:
+            for tagname in ('previewimage', 'jpgfromraw'):
+                preview = e.get_thumbNail(f, thumbname=tagname)
+                if not preview.isNull():
+                    break
+    except ValueError:
+        return None
+    if preview.isNull():
+        return None
+    # embedded previews are usually not rotated
+    angle = {3: 180, 5: -90, 6: 90}.get(sizes.flip, 0)
+    if angle == 180 or (angle != 0 and (preview.width() > preview.height()) != (w > h)):
+        preview = preview.transformed(QTransform().rotate(angle))
+    preview = preview.scaled(w, h).convertToFormat(QImage.Format_ARGB32)
+    return QImageBuffer(preview).copy()
+
+
 def addBasicAdjustmentLayers(img):
     if img.rawImage is None:
         # menuLayer('actionColor_Temperature')
@@ -881,8 +942,12 @@ def openFile(f):
                 addRawAdjustmentLayer()
             # add default adjustment layers
             addBasicAdjustmentLayers(img)
-            # updates
-            img.layersStack[0].applyToStack()
+            # updates. Raw images are developed in the background,
+            # while the embedded preview is shown.
+            if img.rawImage is not None:
+                img.layersStack[0].applyToStackAsync()
+            else:
+                img.layersStack[0].applyToStack()
             img.onImageChanged()
             updateStatus()
             # update list of recent files
@@ -967,6 +1032,12 @@ def setDocumentImage(img):
     # label_3.img : reference to working image
     ###################################
     window.label.img.onImageChanged = f
+
+    def g():
+        # intermediate background render : refresh windows only (cf. renderScheduler.onProgress())
+        window.label.repaint()
+        window.label_3.repaint()
+    window.label.img.onRenderProgress = g
     # before image : the stack is not copied
     window.label_2.img = imImage(QImg=img, meta=img.meta)
     # after image : ref to the opened document
@@ -1221,13 +1292,52 @@ def getPool():
         QApplication.processEvents()
         # init pool only once
         if USE_POOL and (pool is None):
-            pool = multiprocessing.Pool(POOL_SIZE)
+            # threads share image buffers with the main thread, processes need serialization
+            pool = ThreadPool(POOL_SIZE) if USE_THREADS else multiprocessing.Pool(POOL_SIZE)
+            # parallel/serial cutoff : calibrate once for each pool configuration.
+            # The result is stored in the user settings and calibration runs in
+            # a background thread, using the default cutoff until it completes.
+            poolId = '%s %d' % ('threads' if USE_THREADS else 'processes', POOL_SIZE)
+            calibration = QSettings(QSettings.IniFormat, QSettings.UserScope, 'bLUe', 'calibration')
+            threshold = calibration.value('pool/threshold', None)
+            if threshold is not None and calibration.value('pool/id', '') == poolId:
+                setParallelThreshold(threshold)
+            else:
+                def calibrate(p=pool):
+                    t = calibrateParallelThreshold(p, POOL_SIZE)
+                    setParallelThreshold(t)
+                    # QSettings is reentrant : use a separate instance in this thread
+                    s = QSettings(QSettings.IniFormat, QSettings.UserScope, 'bLUe', 'calibration')
+                    s.setValue('pool/threshold', t)
+                    s.setValue('pool/id', poolId)
+                    s.sync()
+                threading.Thread(target=calibrate, daemon=True).start()
     finally:
         QApplication.restoreOverrideCursor()
         QApplication.processEvents()
     return pool
 
 
+def addLUT3DLayer(lut, lname):
+    """
+    Adds an adjustment layer applying a 3D LUT to the current image.
+    @param lut:
+    @type lut: LUT3D
+    @param lname: layer name
+    @type lname: str
+    """
+    layer = window.label.img.addAdjustmentLayer(name=lname)
+    pool = getPool()
+    layer.execute = lambda l=layer, pool=pool: l.tLayer.apply3DLUT(lut.LUT3DArray, lut.step, {'use selection': False, 'keep alpha': True}, pool=pool, lut3D=lut)
+    layer.pointWise = lambda: True
+    window.tableView.setLayers(window.label.img)
+    layer.applyToStack()
+    # The resulting image is modified,
+    # so we update the presentation layer before returning
+    layer.parentImage.prLayer.update()
+    layer.parentImage.onImageChanged()
+
+
 def menuLayer(name):
     """
     Menu Layer handler
@@ -1251,11 +1361,13 @@ def menuLayer(name):
         grWindow = form.getNewWindow(axeSize=axeSize, targetImage=window.label.img, layer=layer, parent=window, mainForm=window)
         # wrapper for the right applyXXX method
         if name == 'actionCurves_RGB':
-            layer.execute = lambda l=layer, pool=None: l.tLayer.apply1DLUT(grWindow.scene().cubicItem.getStackedLUTXY())
+            layer.execute = lambda l=layer, pool=None: l.tLayer.apply1DLUT(l.getFormValues().stackedLUTXY)
         elif name == 'actionCurves_HSpB':  # displayed as HSV in the layer menu !!
-            layer.execute = lambda l=layer, pool=None: l.tLayer.applyHSV1DLUT(grWindow.scene().cubicItem.getStackedLUTXY(), pool=pool)
+            layer.execute = lambda l=layer, pool=None: l.tLayer.applyHSV1DLUT(l.getFormValues().stackedLUTXY, pool=pool)
         elif name == 'actionCurves_Lab':
-            layer.execute = lambda l=layer, pool=None: l.tLayer.applyLab1DLUT(grWindow.scene().cubicItem.getStackedLUTXY())
+            layer.execute = lambda l=layer, pool=None: l.tLayer.applyLab1DLUT(l.getFormValues().stackedLUTXY)
+        # curves can be fused with neighbour layers
+        layer.pointWise = lambda: True
     # 3D LUT
     elif name in ['action3D_LUT', 'action3D_LUT_HSB']:
         # color model
@@ -1267,6 +1379,7 @@ def menuLayer(name):
         pool = getPool()
         sc = grWindow.scene()
         layer.execute = lambda l=layer, pool=pool: l.tLayer.apply3DLUT(sc.lut.LUT3DArray, sc.lut.step, options=sc.options, pool=pool)
+        layer.pointWise = lambda: sc.options is not None and not sc.options['use selection'] and bool(sc.options['keep alpha'])
     # cloning
     elif name == 'actionNew_Cloning_Layer':
         lname = 'Cloning'
@@ -1323,17 +1436,21 @@ def menuLayer(name):
         grWindow = temperatureForm.getNewWindow(axeSize=axeSize, targetImage=window.label.img, layer=layer, parent=window, mainForm=window)
         # wrapper for the right apply method
         layer.execute = lambda l=layer, pool=None: l.tLayer.applyTemperature()
+        # chromatic adaptation depends on the image maximum
+        layer.pointWise = lambda: grWindow.options['Photo Filter']
     elif name == 'actionContrast_Correction':
         layer = window.label.img.addAdjustmentLayer(name=CoBrSatForm.layerTitle, role='CONTRAST')
         grWindow = CoBrSatForm.getNewWindow(axeSize=axeSize, targetImage=window.label.img, layer=layer, parent=window, mainForm=window)
         # clipLimit change event handler
         def h(lay, clipLimit):
             lay.clipLimit = clipLimit
-            lay.applyToStack()
-            window.label.img.onImageChanged()
+            # background render, onImageChanged() is called when done
+            lay.applyToStackAsync()
         grWindow.onUpdateContrast = h
         # wrapper for the right apply method
         layer.execute = lambda l=layer, pool=None: l.tLayer.applyContrast()
+        # contrast corrections depend on the image histogram
+        layer.pointWise = lambda: grWindow.contrastCorrection == 0
     elif name == 'actionExposure_Correction':
         lname = 'Exposure'
         layer = window.label.img.addAdjustmentLayer(name=lname)
@@ -1342,11 +1459,12 @@ def menuLayer(name):
         # clipLimit change event handler
         def h(lay, clipLimit):
             lay.clipLimit = clipLimit
-            lay.applyToStack()
-            window.label.img.onImageChanged()
+            # background render, onImageChanged() is called when done
+            lay.applyToStackAsync()
         grWindow.onUpdateExposure = h
         # wrapper for the right apply method
         layer.execute = lambda l=layer,  pool=None: l.tLayer.applyExposure(l.clipLimit, grWindow.options)
+        layer.pointWise = lambda: True
     elif name == 'actionGeom_Transformation':
         lname = 'Transformation'
         layer = window.label.img.addAdjustmentLayer(name=lname, role='GEOMETRY')
@@ -1431,16 +1549,21 @@ def menuLayer(name):
             except (ValueError, IOError) as e:
                 dlgWarn('Unable to load 3D LUT : ', info=str(e))
                 return
-            lname = path.basename(name)
-            layer = window.label.img.addAdjustmentLayer(name=lname)
-            pool = getPool()
-            layer.execute = lambda l=layer, pool=pool: l.tLayer.apply3DLUT(lut.LUT3DArray, lut.step, {'use selection': False}, pool=pool)
-            window.tableView.setLayers(window.label.img)
-            layer.applyToStack()
-            # The resulting image is modified,
-            # so we update the presentation layer before returning
-            layer.parentImage.prLayer.update()
-            layer.parentImage.onImageChanged()
+            addLUT3DLayer(lut, path.basename(name))
+        return
+    elif name == 'actionLUT_Library':
+        lastDir = window.settings.value('paths/dlg3DLUTdir', '.')
+        dlg = QFileDialog(window, "select", lastDir)
+        dlg.setFileMode(QFileDialog.Directory)
+        if dlg.exec_():
+            newDir = dlg.selectedFiles()[0]
+            window.settings.setValue('paths/dlg3DLUTdir', newDir)
+            # previews are rendered on a small copy of the current image
+            s = lutViewer.iconSize
+            qImg = window.label.img.getThumb().scaled(s, s, Qt.KeepAspectRatio)
+            thumb = QImageBuffer(qImg)[:, :, :3].copy()
+            viewerInstance = lutViewer.getViewerInstance(mainWin=window, onActivate=addLUT3DLayer)
+            viewerInstance.playViewer(newDir, thumb=thumb)
         return
     elif name == 'actionSave_Layer_Stack_as_LUT_Cube':
         img = window.label.img
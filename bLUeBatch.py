@@ -0,0 +1,342 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+#############################################
+# Headless batch processing : a layer stack saved by
+# mImage.saveStackToFile() is replayed over a folder of images.
+# Layers are built without graphics forms : the parameters
+# read from the stack file are held by replayForm instances,
+# and evaluated by the vImage.apply* methods.
+# Usage :
+#     python -m bLUeBatch batch --stack look.blu --in dir --out dir
+#############################################
+import argparse
+import gc
+import multiprocessing
+import os
+import sys
+from os import path
+
+import numpy as np
+
+from PySide2.QtCore import QDataStream, QFile, QIODevice, QPointF
+
+from bLUeGui.dialog import IMAGE_FILE_EXTENSIONS
+from bLUeGui.spline import interpolationCubSpline
+from bLUeGui.bLUeImage import QImageBuffer
+from bLUeCore.kernel import filterIndex
+from MarkedImg import mImage
+from graphicsCoBrSat import CoBrSatForm
+from graphicsExp import ExpForm
+
+# stack actions which can be replayed
+CURVE_ACTIONS = ('actionCurves_RGB', 'actionCurves_HSpB', 'actionCurves_Lab')
+LUT3D_ACTIONS = ('action3D_LUT', 'action3D_LUT_HSB')
+FILTER_NAMES = {'Unsharp Mask': filterIndex.UNSHARP, 'Sharpen': filterIndex.SHARPEN,
+                'Gaussian Blur': filterIndex.BLUR1, 'Surface Blur': filterIndex.SURFACEBLUR}
+
+
+class replayForm(object):
+    """
+    Stand-in for the graphics form of a replayed layer :
+    it holds the attributes read by the vImage.apply* methods.
+    """
+    def __init__(self, **kwargs):
+        self.options = {}
+        self.__dict__.update(kwargs)
+
+
+def splineToLUT(size, points):
+    """
+    Tabulates the cubic spline interpolating control points,
+    as activeCubicSpline.updatePath() and updateLUTXY() do.
+    @param size: axe size of the spline
+    @type size: int
+    @param points: control points (scene coordinates)
+    @type points: list of 2-uples of float
+    @return: LUT
+    @rtype: ndarray, shape (256,), dtype int
+    """
+    points = sorted(points)
+    X = [p[0] for p in points]
+    Y = [p[1] for p in points]
+    X0, X1 = X[0], X[-1]
+    Y0, Y1 = Y[0], Y[-1]
+    Y2 = Y0 - X0 * (Y1 - Y0) / (X1 - X0)
+    Y3 = Y0 + (size - X0) * (Y1 - Y0) / (X1 - X0)
+    if X[0] > 0.0:
+        X.insert(0, 0.0)
+        Y.insert(0, Y2)
+    if X[-1] < size:
+        X.append(size)
+        Y.append(Y3)
+    spline = interpolationCubSpline(np.array(X), np.array(Y), clippingInterval=[-size, 0])
+    yValues = np.array([Y0 if p.x() < X0 else (Y1 if p.x() > X1 else p.y()) for p in spline])
+    return (-yValues * (255.0 / size)).astype(int)
+
+
+def readSpline(dataStream):
+    """
+    Reads a spline written by activeSpline.writeToStream() and returns its LUT.
+    @param dataStream:
+    @type dataStream: QDataStream
+    @return: LUT
+    @rtype: ndarray, shape (256,), dtype int
+    """
+    size = dataStream.readInt32()
+    count = dataStream.readInt32()
+    points = []
+    for i in range(count):
+        point = QPointF()
+        dataStream >> point
+        points.append((point.x(), point.y()))
+    return splineToLUT(size, points)
+
+
+def readLayer(dataStream, actionName):
+    """
+    Reads the form parameters of a layer, written by the
+    writeToStream() method of its graphics form, and returns them
+    as a dictionary. A ValueError exception is raised if the layer
+    cannot be replayed.
+    @param dataStream:
+    @type dataStream: QDataStream
+    @param actionName: layer action name
+    @type actionName: str
+    @return: layer parameters
+    @rtype: dict
+    """
+    name = dataStream.readQString()
+    if name != actionName:
+        raise ValueError('Corrupted stack : expected %s, found %s' % (actionName, name))
+    params = {'actionName': actionName, 'name': dataStream.readQString()}
+    if actionName == 'actionExposure_Correction':
+        dataStream.readQString()
+        params['exposureCorrection'] = dataStream.readInt32() * ExpForm.DefaultStep
+    elif actionName == 'actionContrast_Correction':
+        # one string per selected option (exclusive list), saturation
+        # and brightness are not saved.
+        sel = dataStream.readQString()
+        params['options'] = {'Multi-Mode': sel == 'Multi-Mode', 'CLAHE': sel == 'CLAHE',
+                             'High': True, 'manualCurve': False}
+        params['contrastCorrection'] = CoBrSatForm.slider2Contrast(dataStream.readInt32())
+        params['satCorrection'], params['brightnessCorrection'] = 0.0, 0.0
+    elif actionName == 'actionColor_Temperature':
+        # tint is not saved
+        sel = dataStream.readQString()
+        params['options'] = {'Photo Filter': sel == 'Photo Filter',
+                             'Chromatic Adaptation': sel == 'Chromatic Adaptation'}
+        params['tempCorrection'] = (dataStream.readInt32() // 100) * 100
+        params['tintCorrection'] = 0.0
+    elif actionName == 'actionFilter':
+        sel = dataStream.readQString()
+        if sel not in FILTER_NAMES:
+            raise ValueError('Unknown filter %s' % sel)
+        params['kernelCategory'] = FILTER_NAMES[sel]
+        params['radius'] = dataStream.readFloat32()
+        params['amount'] = dataStream.readFloat32()
+        params['tone'] = 100.0
+    elif actionName in LUT3D_ACTIONS:
+        size = dataStream.readInt32()
+        params['step'] = dataStream.readInt32()
+        l = dataStream.readInt32()
+        byteData = dataStream.readRawData(l)
+        params['LUT'] = np.frombuffer(byteData, dtype=int).reshape((size, size, size, 3)).copy()
+    elif actionName in CURVE_ACTIONS:
+        sel = dataStream.readQString()
+        LUTs = [readSpline(dataStream) for i in range(4 if actionName == 'actionCurves_RGB' else 3)]
+        if actionName == 'actionCurves_RGB':
+            # the brightness curve is applied to all channels
+            # when it is the current curve (cf. activeCubicSpline.getStackedLUTXY())
+            LUTs = LUTs[:1] * 3 if sel == 'RGB' else LUTs[1:]
+        params['stackedLUT'] = np.vstack(LUTs)
+    else:
+        raise ValueError('Cannot replay layer %s (%s)' % (params['name'], actionName))
+    return params
+
+
+def loadStack(filename):
+    """
+    Reads a stack file written by mImage.saveStackToFile().
+    Layers without graphics form (e.g. the background layer) are
+    not part of the returned list.
+    @param filename:
+    @type filename: str
+    @return: layer parameters, from bottom to top
+    @rtype: list of dict
+    """
+    qf = QFile(filename)
+    if not qf.open(QIODevice.ReadOnly):
+        raise IOError('cannot open file %s' % filename)
+    try:
+        dataStream = QDataStream(qf)
+        count = dataStream.readInt32()
+        actionNames = [dataStream.readQString() for i in range(count)]
+        return [readLayer(dataStream, actionName) for actionName in actionNames if actionName != 'actionNull']
+    finally:
+        qf.close()
+
+
+def addLayer(img, params):
+    """
+    Adds a layer replaying params on top of the stack of img.
+    @param img:
+    @type img: mImage
+    @param params: layer parameters (cf. readLayer())
+    @type params: dict
+    @return: the new layer
+    @rtype: QLayer
+    """
+    actionName = params['actionName']
+    form = replayForm(**params)
+    layer = img.addAdjustmentLayer(name=params['name'],
+                                   role='CONTRAST' if actionName == 'actionContrast_Correction' else '')
+    layer.actionName = actionName
+    layer.getGraphicsForm = lambda: form
+    if actionName == 'actionExposure_Correction':
+        layer.execute = lambda l=layer, pool=None: l.tLayer.applyExposure(form.exposureCorrection, form.options)
+        layer.pointWise = lambda: True
+    elif actionName == 'actionContrast_Correction':
+        layer.execute = lambda l=layer, pool=None: l.tLayer.applyContrast()
+        layer.pointWise = lambda: form.contrastCorrection == 0
+    elif actionName == 'actionColor_Temperature':
+        layer.execute = lambda l=layer, pool=None: l.tLayer.applyTemperature()
+        layer.pointWise = lambda: form.options['Photo Filter']
+    elif actionName == 'actionFilter':
+        layer.execute = lambda l=layer, pool=None: l.tLayer.applyFilter2D()
+    elif actionName in LUT3D_ACTIONS:
+        options = {'use selection': False, 'keep alpha': True}
+        layer.execute = lambda l=layer, pool=None: l.tLayer.apply3DLUT(form.LUT, form.step, options=options, pool=pool)
+        layer.pointWise = lambda: True
+    elif actionName == 'actionCurves_RGB':
+        layer.execute = lambda l=layer, pool=None: l.tLayer.apply1DLUT(form.stackedLUT)
+        layer.pointWise = lambda: True
+    elif actionName == 'actionCurves_HSpB':
+        layer.execute = lambda l=layer, pool=None: l.tLayer.applyHSV1DLUT(form.stackedLUT, pool=pool)
+        layer.pointWise = lambda: True
+    elif actionName == 'actionCurves_Lab':
+        layer.execute = lambda l=layer, pool=None: l.tLayer.applyLab1DLUT(form.stackedLUT)
+        layer.pointWise = lambda: True
+    return layer
+
+
+##########################
+# worker processes : each process owns
+# a (windowless) QApplication, needed by QPixmap,
+# and the replayed stack (cf. initWorker()).
+##########################
+__app = None
+__stack = None
+
+
+def initWorker(stack):
+    global __app, __stack
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PySide2.QtWidgets import QApplication
+    __app = QApplication.instance() or QApplication([])
+    __stack = stack
+
+
+def processFile(task):
+    """
+    Replays the stack over an image and saves the result.
+    @param task: input and output file paths
+    @type task: 2-uple of str
+    @return: input path, error message or None
+    @rtype: 2-uple
+    """
+    inFile, outFile = task
+    img = None
+    try:
+        img = mImage(filename=inFile, name=path.basename(inFile))
+        # mImage.save() would show a warning dialog
+        if not outFile.lower().endswith('.png') and np.any(QImageBuffer(img)[:, :, 3] < 255):
+            raise ValueError('Transparency would be lost. Use PNG format instead')
+        # full frame render in the calling thread
+        img.useViewport = False
+        for params in __stack:
+            addLayer(img, params)
+        img.layersStack[0].renderStack(updateForms=False)
+        img.prLayer.execute(l=None, pool=None)
+        img.save(outFile, quality=90, compression=6)
+        return inFile, None
+    except Exception as e:
+        return inFile, str(e)
+    finally:
+        # release buffers before the next task
+        del img
+        gc.collect()
+
+
+def batch(stackFile, inDir, outDir, fileFormat='jpg', jobs=None, tasksPerChild=8):
+    """
+    Replays a saved layer stack over all images of inDir and writes
+    the results to outDir, using a pool of processes. Memory use is
+    bounded by the number of processes : each process holds a single
+    image at a time and is restarted after tasksPerChild images.
+    @param stackFile: stack file (cf. mImage.saveStackToFile())
+    @type stackFile: str
+    @param inDir: input folder
+    @type inDir: str
+    @param outDir: output folder
+    @type outDir: str
+    @param fileFormat: output format, 'jpg', 'png' or 'tif'
+    @type fileFormat: str
+    @param jobs: number of processes (default cpu count)
+    @type jobs: int
+    @param tasksPerChild: images processed by a process before it is restarted
+    @type tasksPerChild: int
+    @return: list of (input file, error message) for the failed images
+    @rtype: list
+    """
+    stack = loadStack(stackFile)
+    os.makedirs(outDir, exist_ok=True)
+    tasks = [(path.join(inDir, f), path.join(outDir, path.splitext(f)[0] + '.' + fileFormat))
+             for f in sorted(os.listdir(inDir)) if f.endswith(IMAGE_FILE_EXTENSIONS)]
+    failed = []
+    with multiprocessing.Pool(processes=jobs, initializer=initWorker, initargs=(stack,),
+                              maxtasksperchild=tasksPerChild) as pool:
+        for inFile, error in pool.imap_unordered(processFile, tasks):
+            if error is None:
+                print('%s : done' % inFile)
+            else:
+                print('%s : %s' % (inFile, error))
+                failed.append((inFile, error))
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bLUeBatch', description='bLUe headless processing')
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('batch', help='replay a saved layer stack over a folder of images')
+    p.add_argument('--stack', required=True, help='layer stack file')
+    p.add_argument('--in', dest='inDir', required=True, help='input folder')
+    p.add_argument('--out', dest='outDir', required=True, help='output folder')
+    p.add_argument('--format', dest='fileFormat', choices=['jpg', 'png', 'tif'], default='jpg')
+    p.add_argument('--jobs', type=int, default=None, help='number of processes (default cpu count)')
+    args = parser.parse_args(argv)
+    if args.command != 'batch':
+        parser.print_help()
+        return 2
+    failed = batch(args.stack, args.inDir, args.outDir, fileFormat=args.fileFormat, jobs=args.jobs)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    # mandatory for frozen executables, cf. bLUe.py
+    multiprocessing.freeze_support()
+    sys.exit(main())
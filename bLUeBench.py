@@ -0,0 +1,509 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+#############################################
+# Benchmarks of the image processing functions and of the
+# adjustment layers, on synthetic images of 2, 12, 24 and 50 Mpx.
+# Each benchmark records its time (min and median of the runs) and
+# its peak memory (numpy allocations, measured by tracemalloc
+# during a separate, untimed, run). Results are written to a json file,
+# which can be used as the baseline of a later run : benchmarks slower
+# than the baseline by more than the tolerance are reported as regressions.
+# Layers are rendered offscreen, without graphics forms.
+# With --check-fusion, no benchmark is run : the outputs of fused runs of
+# point-wise layers (cf. mImage.renderFused()) are compared with the outputs
+# of the unfused stack, for each fusible layer type, in preview and full size modes.
+# Usage :
+#     python -m bLUeBench [--sizes 2 12] [--only 'contrast*'] [--repeat 3] [--out results.json]
+#                         [--baseline baseline.json] [--tolerance 0.2] [--raw file.nef]
+#     python -m bLUeBench --check-fusion [--sizes 2]
+#############################################
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import sys
+import tempfile
+import tracemalloc
+from multiprocessing.pool import ThreadPool
+from time import perf_counter
+
+import numpy as np
+
+import adjustments
+from bLUeCore.bLUeLUT3D import LUT3D
+from bLUeCore.dwtDenoising import dwtDenoiseChan
+from bLUeCore.kernel import filterIndex
+from bLUeCore.multi import interpMulti
+from bLUeCore.tetrahedral import interpTetra
+from bLUeCore.trilinear import interpTriLinear
+from bLUeGui.colorCube import rgb2hspVec, hsp2rgbVec
+from bLUeGui.histogramWarping import warpHistogram
+from graphicsBlendFilter import blendFilterIndex
+
+# image sizes (Mpx)
+SIZES = (2, 12, 24, 50)
+
+# registered benchmarks : list of (name, factory, qt)
+__benchmarks = []
+
+
+def benchmark(name, qt=False):
+    """
+    Decorator registering a benchmark factory. The factory is called with
+    a synthetic image buffer and the benchmark context, and it returns the
+    function to time (without parameter). Setup done by the factory is not timed.
+    Benchmarks using layers (qt=True) need an (offscreen) QApplication.
+    @param name: benchmark name
+    @type name: str
+    @param qt:
+    @type qt: boolean
+    """
+    def register(factory):
+        __benchmarks.append((name, factory, qt))
+        return factory
+    return register
+
+
+class benchContext(object):
+    """
+    Resources shared by benchmarks
+    """
+    def __init__(self, rawFile=None):
+        self.rawFile = rawFile
+        self.poolSize = os.cpu_count() or 1
+        self.pool = ThreadPool(self.poolSize)
+        self.tmpDir = tempfile.mkdtemp(prefix='bLUeBench')
+        self.lut = LUT3D(None, size=33)
+        self.app = None
+
+    def initQt(self):
+        if self.app is None:
+            os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+            from PySide2.QtWidgets import QApplication
+            self.app = QApplication.instance() or QApplication([])
+
+
+def syntheticImage(mpx, seed=0):
+    """
+    Builds a reproducible BGRA image with 3:2 aspect ratio : smooth
+    gradients, a few sharp edges and noise.
+    @param mpx: size (Mpx)
+    @type mpx: float
+    @param seed:
+    @type seed: int
+    @return: image buffer
+    @rtype: ndarray, shape (h, w, 4), dtype uint8
+    """
+    w = int(np.sqrt(mpx * 1e6 * 1.5))
+    h = int(mpx * 1e6 / w)
+    rng = np.random.RandomState(seed)
+    y = np.linspace(0.0, 1.0, h, dtype=np.float32)[:, np.newaxis]
+    x = np.linspace(0.0, 1.0, w, dtype=np.float32)[np.newaxis, :]
+    buf = np.empty((h, w, 4), dtype=np.uint8)
+    buf[:, :, 0] = 255 * x * (1 - 0.5 * y)
+    buf[:, :, 1] = 255 * (0.5 + 0.5 * np.sin(12 * x + 7 * y)) ** 2
+    buf[:, :, 2] = 255 * y * (x > 0.3)
+    buf[:, :, :3] += rng.randint(0, 16, size=(h, w, 3), dtype=np.uint8) // 2
+    buf[:, :, 3] = 255
+    return buf
+
+
+####################
+# image processing functions
+####################
+@benchmark('interpTriLinear')
+def benchTriLinear(buf, ctx):
+    return lambda: interpTriLinear(ctx.lut.LUT3DArray, ctx.lut.step, buf[:, :, :3])
+
+
+@benchmark('interpTetra')
+def benchTetra(buf, ctx):
+    return lambda: interpTetra(ctx.lut.LUT3DArray, ctx.lut.step, buf[:, :, :3])
+
+
+@benchmark('interpMulti')
+def benchMulti(buf, ctx):
+    return lambda: interpMulti(ctx.lut.LUT3DArray, ctx.lut.step, buf[:, :, :3], pool=ctx.pool,
+                               poolSize=ctx.poolSize)
+
+
+@benchmark('warpHistogram')
+def benchWarp(buf, ctx):
+    V = buf[:, :, :3].max(axis=-1) / 255
+    return lambda: warpHistogram(V, warp=0.5, preserveHigh=True)
+
+
+@benchmark('hsp2rgbVec')
+def benchHsp2rgb(buf, ctx):
+    hsp = rgb2hspVec(buf[:, :, :3][:, :, ::-1])
+    return lambda: hsp2rgbVec(hsp)
+
+
+@benchmark('dwtDenoiseChan')
+def benchDwt(buf, ctx):
+    return lambda: dwtDenoiseChan(buf[:, :, :3], chan=0, thr=50.0, thrmode='wiener')
+
+
+####################
+# adjustments (cf. adjustments.py)
+####################
+def identityLUT():
+    return np.arange(256)[np.newaxis, :].repeat(3, axis=0)
+
+
+def sCurveLUT():
+    x = np.arange(256) / 255
+    return np.vstack([(255 * (3 * x ** 2 - 2 * x ** 3)).astype(int), np.arange(256), np.arange(256)])
+
+
+ADJUSTMENTS = [
+    ('exposure', adjustments.exposure, adjustments.exposureParams(exposureCorrection=1.0), {}),
+    ('contrast.warp', adjustments.contrast, adjustments.contrastParams(contrastCorrection=0.5, satCorrection=0.1), {}),
+    ('contrast.clahe', adjustments.contrast,
+     adjustments.contrastParams(contrastCorrection=2.0, options={'Multi-Mode': False, 'CLAHE': True, 'High': True,
+                                                                 'manualCurve': False}), {}),
+    ('contrast.lab', adjustments.contrast,
+     adjustments.contrastParams(contrastCorrection=0.5, satCorrection=0.1, version='Lab'), {}),
+    ('temperature.adaptation', adjustments.temperature, adjustments.temperatureParams(tempCorrection=4500), {}),
+    ('temperature.photoFilter', adjustments.temperature,
+     adjustments.temperatureParams(tempCorrection=4500, options={'Photo Filter': True, 'Chromatic Adaptation': False}), {}),
+    ('rgbLUT', adjustments.rgbLUT, adjustments.lut1DParams(stackedLUT=sCurveLUT()), {}),
+    ('labLUT', adjustments.labLUT, adjustments.lut1DParams(stackedLUT=sCurveLUT()), {}),
+    ('hsvLUT', adjustments.hsvLUT, adjustments.lut1DParams(stackedLUT=sCurveLUT()), {}),
+    ('hspbLUT', adjustments.hspbLUT, adjustments.lut1DParams(stackedLUT=sCurveLUT()), {}),
+    ('filter2D.unsharp', adjustments.filter2D, adjustments.filterParams(radius=10, amount=50.0), {}),
+    ('filter2D.surfaceBlur', adjustments.filter2D,
+     adjustments.filterParams(kernelCategory=filterIndex.SURFACEBLUR, radius=10), {}),
+    ('denoise.wavelets', adjustments.denoise, adjustments.noiseParams(noiseCorrection=1), {}),
+    ('denoise.bilateral', adjustments.denoise,
+     adjustments.noiseParams(noiseCorrection=1, options={'Wavelets': False, 'Bilateral': True, 'NLMeans': False}), {}),
+    ('denoise.nlmeans', adjustments.denoise,
+     adjustments.noiseParams(noiseCorrection=1, options={'Wavelets': False, 'Bilateral': False, 'NLMeans': True}), {}),
+]
+
+
+def registerAdjustment(name, func, params, kwargs):
+    benchmark(name)(lambda buf, ctx: lambda: func(buf, params, **kwargs))
+
+
+for args in ADJUSTMENTS:
+    registerAdjustment(*args)
+
+
+####################
+# layers (vImage.apply* methods),
+# histogram and save. Parameter objects
+# stand in for the graphics forms.
+####################
+def newImage(buf):
+    from MarkedImg import mImage
+    img = mImage(cv2Img=buf)
+    img.useViewport = False
+    return img
+
+
+def addLayer(img, execute, form=None, role=''):
+    """
+    Adds an adjustment layer executing execute(layer).
+    @return: the function rendering the layer
+    @rtype: function
+    """
+    layer = img.addAdjustmentLayer(name='bench', role=role)
+    layer.getGraphicsForm = lambda: form
+    layer.execute = lambda l=layer, pool=None: execute(l.tLayer)
+    return lambda: layer.execute(l=layer, pool=None)
+
+
+def registerLayer(name, execute, form=None, role=''):
+    benchmark('vImage.%s' % name, qt=True)(lambda buf, ctx: addLayer(newImage(buf), execute, form=form, role=role))
+
+
+def blendForm():
+    from bLUeBatch import replayForm
+    return replayForm(kernelCategory=blendFilterIndex.GRADUALTB, filterStart=20, filterEnd=80)
+
+
+registerLayer('applyExposure', lambda l: l.applyExposure(1.0, None))
+registerLayer('applyContrast', lambda l: l.applyContrast(), form=adjustments.contrastParams(contrastCorrection=0.5),
+              role='CONTRAST')
+registerLayer('applyTemperature', lambda l: l.applyTemperature(), form=adjustments.temperatureParams(tempCorrection=4500))
+registerLayer('apply1DLUT', lambda l: l.apply1DLUT(sCurveLUT()))
+registerLayer('applyLab1DLUT', lambda l: l.applyLab1DLUT(sCurveLUT()))
+registerLayer('applyHSPB1DLUT', lambda l: l.applyHSPB1DLUT(sCurveLUT()))
+registerLayer('applyHSV1DLUT', lambda l: l.applyHSV1DLUT(sCurveLUT()))
+registerLayer('applyFilter2D', lambda l: l.applyFilter2D(), form=adjustments.filterParams())
+registerLayer('applyNoiseReduction', lambda l: l.applyNoiseReduction(), form=adjustments.noiseParams(noiseCorrection=1))
+registerLayer('applyInvert', lambda l: l.applyInvert())
+
+
+@benchmark('vImage.applyBlendFilter', qt=True)
+def benchBlendFilter(buf, ctx):
+    return addLayer(newImage(buf), lambda l: l.applyBlendFilter(), form=blendForm())
+
+
+@benchmark('vImage.apply3DLUT', qt=True)
+def bench3DLUT(buf, ctx):
+    options = {'use selection': False, 'keep alpha': True}
+    return addLayer(newImage(buf),
+                    lambda l: l.apply3DLUT(ctx.lut.LUT3DArray, ctx.lut.step, options=options, pool=ctx.pool))
+
+
+@benchmark('vImage.histogram', qt=True)
+def benchHistogram(buf, ctx):
+    img = newImage(buf)
+    return lambda: img.histogram(mode='Luminosity')
+
+
+@benchmark('mImage.save', qt=True)
+def benchSave(buf, ctx):
+    img = newImage(buf)
+    img.prLayer.execute(l=None, pool=None)
+    filename = os.path.join(ctx.tmpDir, 'bench.jpg')
+    return lambda: img.save(filename, quality=90)
+
+
+@benchmark('rawPostProcess', qt=True)
+def benchRaw(buf, ctx):
+    """
+    Develops the raw file given on the command line. Its
+    size does not depend on the synthetic image size.
+    """
+    if ctx.rawFile is None:
+        raise ValueError('no raw file (use --raw)')
+    import rawpy
+    from MarkedImg import QRawLayer
+    from graphicsRaw import rawForm
+    rawpyInst = rawpy.RawPy()
+    with open(ctx.rawFile, "rb") as bufio:
+        rawpyInst.open_buffer(bufio)
+    rawpyInst.unpack()
+    rawBuf = rawpyInst.postprocess(use_camera_wb=True)
+    rawBuf = np.dstack((rawBuf[:, :, ::-1], np.zeros(rawBuf.shape[:2], dtype=np.uint8) + 255))
+    img = newImage(rawBuf)
+    img.rawImage = rawpyInst
+    img.rawUnpacked = True
+    layer = img.addAdjustmentLayer(layerType=QRawLayer, name='Development', role='RAW')
+    form = rawForm.getNewWindow(targetImage=img, layer=layer, parent=None, mainForm=None)
+    layer.getGraphicsForm = lambda: form
+
+    def develop():
+        # invalidate the cached development stages
+        layer.invalidateStages()
+        layer.applyRawPostProcessing(pool=None)
+    return develop
+
+
+####################
+# fusion check
+####################
+def fusibleLayers():
+    """
+    Returns the fusible layer types, with the parameters used by the check.
+    @return: list of (name, execute, form, role)
+    @rtype: list
+    """
+    lut = LUT3D(None, size=33)
+    lut.LUT3DArray = 255.0 * (lut.LUT3DArray / 255.0) ** 0.8
+    options = {'use selection': False, 'keep alpha': True}
+    pointWiseContrast = adjustments.contrastParams(satCorrection=0.2, brightnessCorrection=0.1)
+    photoFilter = adjustments.temperatureParams(tempCorrection=4500,
+                                                options={'Photo Filter': True, 'Chromatic Adaptation': False})
+    return [
+        ('exposure', lambda l: l.applyExposure(0.5, None), None, ''),
+        ('contrast', lambda l: l.applyContrast(), pointWiseContrast, 'CONTRAST'),
+        ('contrast.lab', lambda l: l.applyContrast(version='Lab'), pointWiseContrast, 'CONTRAST'),
+        ('temperature.photoFilter', lambda l: l.applyTemperature(), photoFilter, ''),
+        ('rgbLUT', lambda l: l.apply1DLUT(sCurveLUT()), None, ''),
+        ('labLUT', lambda l: l.applyLab1DLUT(sCurveLUT()), None, ''),
+        ('hsvLUT', lambda l: l.applyHSV1DLUT(sCurveLUT()), None, ''),
+        ('hspbLUT', lambda l: l.applyHSPB1DLUT(sCurveLUT()), None, ''),
+        ('3DLUT', lambda l: l.apply3DLUT(lut.LUT3DArray, lut.step, options=options), None, ''),
+    ]
+
+
+def checkFusion(buf, ctx, tolerance=2.0):
+    """
+    Renders an exposure layer followed by a layer of each fusible type,
+    with and without fusion, in preview and full size modes, and compares the
+    outputs of the top layer. Fused runs apply a 3D LUT, so small differences
+    are expected : a check fails if the mean absolute difference is above tolerance.
+    @param buf: image buffer
+    @type buf: ndarray, shape (h, w, 4), dtype uint8
+    @param ctx:
+    @type ctx: benchContext
+    @param tolerance: max mean absolute difference
+    @type tolerance: float
+    @return: results : list of (name, mode, mean abs. difference, max abs. difference, passed)
+    @rtype: list
+    """
+    ctx.initQt()
+    from bLUeGui.bLUeImage import QImageBuffer
+    exposure = fusibleLayers()[0]
+    results = []
+    for name, execute, form, role in fusibleLayers():
+        for mode in ('preview', 'full'):
+            outputs = []
+            for fused in (False, True):
+                img = newImage(buf)
+                img.useThumb = mode == 'preview'
+                img.useFusion = fused
+                layers = []
+                for e, f, r in (exposure[1:], (execute, form, role)):
+                    addLayer(img, e, form=f, role=r)
+                    layers.append(img.layersStack[-1])
+                    layers[-1].pointWise = lambda: True
+                layers[0].renderStack(updateForms=False)
+                if fused and not layers[-1].renderStats['fused']:
+                    raise ValueError('checkFusion : %s layers were not fused' % name)
+                outputs.append(QImageBuffer(layers[-1].getCurrentImage())[:, :, :3].astype(np.int16))
+            d = np.abs(outputs[0] - outputs[1])
+            mean, dmax = float(np.mean(d)), int(np.max(d))
+            results.append((name, mode, mean, dmax, mean <= tolerance))
+    return results
+
+
+####################
+# runner
+####################
+def run(fn, repeat):
+    """
+    Runs fn once with tracemalloc to get its peak memory
+    (this run also warms up caches), then repeat times for timing.
+    @param fn:
+    @type fn: function
+    @param repeat:
+    @type repeat: int
+    @return: min time, median time (s), peak memory (bytes)
+    @rtype: 3-uple
+    """
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    times = []
+    for i in range(repeat):
+        t = perf_counter()
+        fn()
+        times.append(perf_counter() - t)
+    return min(times), float(np.median(times)), peak
+
+
+def runAll(sizes=SIZES, only=None, repeat=3, rawFile=None):
+    """
+    Runs the benchmarks whose name matches one of the patterns in only (all if None).
+    @param sizes: image sizes (Mpx)
+    @type sizes: sequence of float
+    @param only: name patterns (fnmatch syntax)
+    @type only: list of str
+    @param repeat: number of timed runs
+    @type repeat: int
+    @param rawFile: raw file for rawPostProcess
+    @type rawFile: str
+    @return: results, by benchmark name and size
+    @rtype: dict
+    """
+    ctx = benchContext(rawFile=rawFile)
+    selected = [b for b in __benchmarks if only is None or any(fnmatch.fnmatch(b[0], p) for p in only)]
+    results = {}
+    for size in sizes:
+        buf = syntheticImage(size)
+        for name, factory, qt in selected:
+            if qt:
+                ctx.initQt()
+            try:
+                tmin, tmed, peak = run(factory(buf, ctx), repeat)
+                r = {'time': tmin, 'median': tmed, 'peak': peak}
+                print('%-32s %5s Mpx %9.3f s %9.1f MB' % (name, size, tmin, peak / 2**20))
+            except Exception as e:
+                r = {'error': str(e)}
+                print('%-32s %5s Mpx failed : %s' % (name, size, e))
+            results.setdefault(name, {})[str(size)] = r
+        del buf
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results with a baseline and returns the regressions.
+    @param results:
+    @type results: dict
+    @param baseline:
+    @type baseline: dict
+    @param tolerance: max relative slowdown or memory increase
+    @type tolerance: float
+    @return: list of (name, size, key, baseline value, new value)
+    @rtype: list
+    """
+    regressions = []
+    for name, bySize in results.items():
+        for size, r in bySize.items():
+            b = baseline.get(name, {}).get(size)
+            if b is None or 'error' in b or 'error' in r:
+                continue
+            for key in ('time', 'peak'):
+                if r[key] > b[key] * (1 + tolerance):
+                    regressions.append((name, size, key, b[key], r[key]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bLUeBench', description='bLUe benchmarks')
+    parser.add_argument('--sizes', type=float, nargs='+', default=SIZES, help='image sizes (Mpx)')
+    parser.add_argument('--only', nargs='+', default=None, help='benchmark name patterns')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs')
+    parser.add_argument('--out', default=None, help='json result file')
+    parser.add_argument('--baseline', default=None, help='json result file of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='max relative regression')
+    parser.add_argument('--raw', default=None, help='raw file for rawPostProcess')
+    parser.add_argument('--list', action='store_true', help='list benchmarks and exit')
+    parser.add_argument('--check-fusion', action='store_true', help='compare fused and unfused renders and exit')
+    args = parser.parse_args(argv)
+    if args.list:
+        print('\n'.join(b[0] for b in __benchmarks))
+        return 0
+    sizes = [int(s) if s == int(s) else s for s in args.sizes]
+    if args.check_fusion:
+        ctx = benchContext()
+        failed = False
+        for size in sizes:
+            for name, mode, mean, dmax, passed in checkFusion(syntheticImage(size), ctx):
+                print('%-32s %5s Mpx %-8s mean %6.3f max %4d %s' % (name, size, mode, mean, dmax,
+                                                                      'ok' if passed else 'FAILED'))
+                failed = failed or not passed
+        return 1 if failed else 0
+    results = runAll(sizes=sizes, only=args.only, repeat=args.repeat, rawFile=args.raw)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump({'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                                   'numpy': np.__version__, 'cpus': os.cpu_count()},
+                       'results': results}, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for name, size, key, old, new in regressions:
+            print('regression %s %s Mpx %s : %.4g --> %.4g' % (name, size, key, old, new))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,7 +15,15 @@ Lesser General Lesser Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
 from .cartesian import cartesianProduct
+from .tetrahedral import interpTetra
+from .trilinear import interpTriLinearStrips
 import numpy as np
 
 
@@ -60,6 +68,29 @@ class LUT3D (object):
     defaultSize = 33  # 17
     ####################
 
+    ###################################
+    # Baked tables : dense 8 bits lookup tables
+    # with 256**3 entries, built from the LUT and
+    # cached (memory mapped) in bakeDir.
+    bakeDir = os.path.join(tempfile.gettempdir(), 'bLUe_LUT3D')
+    # Max total size (bytes) of the tables in bakeDir.
+    # Least recently used tables are removed first.
+    bakeBudget = 2 ** 29
+    # Min pixel count of an image for building a
+    # baked table on first use. The cost of baking
+    # is approx. that of interpolating a 16 Mpx image.
+    bakeMinPixels = 2 ** 22
+    # Tables built on first use are built in a
+    # background thread (cf. getBaked()). Unfinished
+    # table files older than bakeStale seconds are
+    # removed by pruneBakeDir().
+    bakeStale = 3600
+    ###################################
+
+    # names of the tables being built in background
+    __building = set()
+    __buildLock = threading.Lock()
+
     @classmethod
     def HaldBuffer2LUT3D(cls, haldBuff):
         """
@@ -94,6 +125,13 @@ class LUT3D (object):
         Values read should be between 0 and 1. They are
         multiplied by 255 and converted to int.
         The channels of the LUT and the axes of the cube are both in order BGR.
+        Header keywords TITLE, LUT_3D_SIZE, DOMAIN_MIN and DOMAIN_MAX are
+        recognized; other keywords are ignored. For compatibility with
+        files written by older versions of bLUe, any keyword ending with SIZE
+        gives the LUT size. Only the default domain (0, 1) is supported.
+        Files with both LUT_1D_SIZE and LUT_3D_SIZE keywords hold a 1D shaper,
+        whose data lines come first. It is resampled to 256 values per channel.
+        Data lines are parsed in a single (vectorized) pass.
         Raises a ValueError exception if the method fails.
         @param inStream:
         @type inStream: TextIoWrapper
@@ -103,79 +141,165 @@ class LUT3D (object):
         ##########
         # read header
         #########
-        # We expect exactly 2 uncommented lines
-        # where the second is LUT_3D_SIZE xxx
-        i = 0
+        size, size1D, title = None, 0, ''
+        domain = {'DOMAIN_MIN': [0.0] * 3, 'DOMAIN_MAX': [1.0] * 3}
+        inputRange = {'LUT_1D_INPUT_RANGE': [0.0, 1.0], 'LUT_3D_INPUT_RANGE': [0.0, 1.0]}
+        data = []
         for line in inStream:
             # skip comments
-            if line.startswith('#') or (len(line.lstrip()) == 0):
-                continue
-            i += 1
-            if i < 2:
+            line = line.strip()
+            if not line or line.startswith('#'):
                 continue
-            # get LUT size (second line format should be : Size xx)
-            token = line.split()
-            if len(token) >= 2:
-                _, size = token
+            # first data line
+            if line[0] in '0123456789+-.':
+                data.append(line + '\n')
                 break
-            else:
-                raise ValueError('Cannot find LUT size')
-        # LUT size
-        size = int(size)
-        bufsize = (size ** 3) * 3
-        buf = np.zeros(bufsize, dtype=float)
+            token = line.split(maxsplit=1)
+            keyword = token[0].upper()
+            if keyword == 'TITLE':
+                title = token[1].strip('"') if len(token) > 1 else ''
+            elif keyword in domain or keyword in inputRange:
+                try:
+                    value = [float(x) for x in token[1].split()]
+                except (IndexError, ValueError):
+                    raise ValueError('Wrong %s' % keyword)
+                if keyword in domain:
+                    domain[keyword] = value
+                else:
+                    inputRange[keyword] = value
+            elif keyword == 'LUT_1D_SIZE':
+                try:
+                    size1D = int(token[1])
+                except (IndexError, ValueError):
+                    raise ValueError('Wrong LUT_1D_SIZE')
+            elif keyword.endswith('SIZE'):
+                try:
+                    size = int(token[1])
+                except (IndexError, ValueError):
+                    raise ValueError('Cannot find LUT size')
+        if size is None:
+            if size1D > 0:
+                raise ValueError('1D LUTs are not supported')
+            raise ValueError('Cannot find LUT size')
+        if domain['DOMAIN_MIN'] != [0.0] * 3 or domain['DOMAIN_MAX'] != [1.0] * 3:
+            raise ValueError('Unsupported domain %s %s' % (domain['DOMAIN_MIN'], domain['DOMAIN_MAX']))
+        for keyword, value in inputRange.items():
+            if value != [0.0, 1.0]:
+                raise ValueError('Unsupported %s %s' % (keyword, value))
         #######
         # LUT
         ######
-        i = 0
-        # restarting from current position
-        for line in inStream:
-            if line.startswith('#') or (len(line.lstrip()) == 0):
-                continue
-            token = line.split()
-            if len(token) >= 3:
-                a, b, c = token
-            else:
-                raise ValueError('Wrong file format')
-            # BGR order for channels
-            buf[i:i+3] = float(c), float(b), float(a)
-            i += 3
+        # remaining lines (restarting from current position)
+        # are parsed at once. Comments are removed first.
+        data.extend(inStream.readlines())
+        # keep a separator : a trailing comment also removes the line terminator
+        data = ''.join(l.split('#', 1)[0] + '\n' if '#' in l else l for l in data)
+        bufsize = (size1D + size ** 3) * 3
+        try:
+            buf = np.fromstring(data.strip(), dtype=float, sep=' ')
+        except ValueError:
+            raise ValueError('Wrong file format')
         # sanity check
-        if i != bufsize:
+        if buf.size != bufsize:
             raise ValueError('LUT size does not match line count')
-        buf *= 255.0
-        buf = buf.astype(int)
-        buf = buf.reshape(size, size, size, 3)
+        shaper = None
+        if size1D > 0:
+            # BGR order for channels
+            curves = buf[:size1D * 3].reshape(size1D, 3)[:, ::-1]
+            buf = buf[size1D * 3:]
+            x = np.linspace(0.0, 1.0, 256)
+            u = np.linspace(0.0, 1.0, size1D)
+            shaper = np.column_stack([np.interp(x, u, curves[:, c]) for c in range(3)]) * 255.0
+        # round to nearest, so that write/read round trips are lossless
+        buf = np.rint(buf * 255.0).astype(int)
+        # BGR order for channels
+        buf = buf.reshape(size, size, size, 3)[..., ::-1].copy()
         # the specification of the .cube format
         # gives BGR order for the cube axes (R-axis changing most rapidly)
         # So, no transposition is needed.
         # buf = buf.transpose(2, 1, 0, 3)
-        return LUT3D(buf, size=size)
+        lut = LUT3D(buf, size=size, shaper=shaper)
+        if title:
+            lut.title = title
+        return lut
 
     @classmethod
-    def readFromTextFile(cls, filename):
+    def readFromTextFile(cls, filename, useCache=True):
         """
         Read a 3D LUT from a file in format .cube.
         Values read should be between 0 and 1. They are
         multiplied by 255 and converted to int.
         The channels of the LUT and the axes of the cube are both in order BGR.
+        If useCache is True (default), the LUT array is saved to a binary
+        sidecar file in LUT3D.bakeDir (cf. sidecarPath()), which is loaded instead of the
+        text file as long as it is not older than the text file. The title
+        is then read from the header of the text file. LUTs with
+        a shaper are not cached.
         Raise a IOError exception.
         @param filename: path to file
         @type filename: str
+        @param useCache: use the binary sidecar
+        @type useCache: boolean
         @return: LUT3D
         @rtype: LUT3D class instance
         """
+        sidecar = cls.sidecarPath(filename)
+        if useCache and os.path.isfile(sidecar) and os.stat(sidecar).st_mtime_ns >= os.stat(filename).st_mtime_ns:
+            try:
+                buf = np.load(sidecar)
+                lut = LUT3D(buf, size=buf.shape[0])
+                # the sidecar holds the array only : read the title from the header
+                with open(filename) as textStream:
+                    for line in textStream:
+                        token = line.strip().split(maxsplit=1)
+                        if not token or token[0].startswith('#'):
+                            continue
+                        if token[0][0] in '0123456789+-.':
+                            break
+                        if token[0].upper() == 'TITLE':
+                            lut.title = token[1].strip('"') if len(token) > 1 else ''
+                            break
+                return lut
+            except (IOError, ValueError):
+                pass
         with open(filename) as textStream:
             lut = cls.readFromTextStream(textStream)
+        if useCache and lut.shaper is None:
+            try:
+                os.makedirs(cls.bakeDir, exist_ok=True)
+                np.save(sidecar, lut.LUT3DArray)
+            except OSError:
+                pass
         return lut
 
-    def __init__(self, LUT3DArray, size=defaultSize, maxrange=standardMaxRange, dtype=np.int16, alpha=False):
+    @classmethod
+    def sidecarPath(cls, filename):
+        """
+        Returns the path of the binary sidecar of a .cube file (cf. readFromTextFile()).
+        Sidecars are kept in bakeDir, named after the absolute path of the file,
+        so that LUT directories are never written to.
+        @param filename: path to .cube file
+        @type filename: str
+        @return: path to sidecar
+        @rtype: str
+        """
+        key = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+        return os.path.join(cls.bakeDir, key + '.cube.npy')
+
+    def __init__(self, LUT3DArray, size=defaultSize, maxrange=standardMaxRange, dtype=np.int16, alpha=False, shaper=None):
         """
         Initializes a LUT3D object with shape (size, size,size, 3).
-        size should be 2**n +1. Most common values are 17 and 33.
+        size can be any integer >= 2. Most common values are 17, 32, 33 and 65.
+        The interpolation step maxrange / (size - 1) needs not be an integer.
 
         maxrange defines the maximum value which can be interpolated from the LUT.
 
+        An optional per channel 1D shaper curve can be applied to the input
+        values before lookup (cf. shapeInput()). It is given as an array
+        of 256 values per channel, in the range 0..255, with the same
+        channel ordering as the LUT. Shapers allow smaller LUTs to keep
+        precision where it is needed (e.g. in the shadows).
+
         LUT3DArray is the array of color values, with shape (size, size, size, 3).
         By convention, the role (R or G or B) of the three first axes follows the ordering
         of the color channels..
@@ -198,22 +322,26 @@ class LUT3D (object):
         @type maxrange: int
         @param dtype: type of array data
         @type dtype: numeric type
+        @param shaper: 1D input curves
+        @type shaper: ndarray, shape (256, 3)
         """
         # sanity check
-        if ((size - 1) & (size - 2)) != 0:
-            raise ValueError("LUT3D : size should be 2**n+1, found %d" % size)
+        if size < 2:
+            raise ValueError("LUT3D : size should be >= 2, found %d" % size)
 
         self.LUT3DArray = LUT3DArray
         self.size = size
+        self.title = 'bLUe 3D LUT'
 
         # interpolation step
         self.step = maxrange / (size - 1)
-        if not self.step.is_integer():
-            raise ValueError('LUT3D : wrong size')
 
         if LUT3DArray is None:
             # build default LUT3DArray
-            a = np.arange(size, dtype=dtype) * self.step  #
+            a = np.arange(size) * self.step
+            if np.issubdtype(dtype, np.integer):
+                a = np.rint(a)
+            a = a.astype(dtype)
             c = cartesianProduct((a, a, a))
             self.LUT3DArray = c
         else:
@@ -226,8 +354,246 @@ class LUT3D (object):
                                      self.LUT3DArray,
                                      np.zeros(self.LUT3DArray.shape[:3] + (1,), dtype=self.LUT3DArray.dtype
                                               )), axis=-1)
+        if shaper is not None:
+            shaper = np.clip(np.asarray(shaper, dtype=np.float32), 0, 255)
+            if shaper.shape != (256, 3):
+                raise ValueError("LUT3D : shaper shape should be (256, 3)")
+        self.shaper = shaper
+        # baked table and content hash
+        self.__baked, self.__bakedKey = None, None
+        # memoized content hashes, keyed by interpolation method
+        self.__hashes = {}
         super().__init__()
 
+    def shapeInput(self, ndImg):
+        """
+        Applies the shaper curves to the three first channels of ndImg.
+        The result is the input to pass to the interpolation functions,
+        together with LUT3DArray and step. If the LUT has no shaper, ndImg is
+        returned unchanged.
+        @param ndImg: input image
+        @type ndImg: ndarray, shape (h, w, d), d >= 3
+        @return: shaped image
+        @rtype: ndarray, dtype np.float32, shape (h, w, 3)
+        """
+        if self.shaper is None:
+            return ndImg
+        out = np.empty(ndImg.shape[:2] + (3,), dtype=np.float32)
+        x = np.arange(256)
+        for c in range(3):
+            if ndImg.dtype == np.uint8:
+                np.take(self.shaper[:, c], ndImg[:, :, c], out=out[:, :, c])
+            else:
+                out[:, :, c] = np.interp(ndImg[:, :, c], x, self.shaper[:, c])
+        return out
+
+    def contentHash(self, use_tetra=False):
+        """
+        Returns a hash of the LUT content (array values, shape, step)
+        and of the interpolation method.
+        @param use_tetra: tetrahedral interpolation
+        @type use_tetra: boolean
+        The hash is memoized until the next call to invalidate().
+        @return: hex digest
+        @rtype: str
+        """
+        key = self.__hashes.get(use_tetra)
+        if key is not None:
+            return key
+        LUT = np.ascontiguousarray(self.LUT3DArray)
+        h = hashlib.sha1(LUT.tobytes())
+        h.update(('%s %s %s %s' % (LUT.shape, LUT.dtype, self.step, 'tetra' if use_tetra else 'trilinear')).encode())
+        if self.shaper is not None:
+            h.update(self.shaper.tobytes())
+        key = h.hexdigest()
+        self.__hashes[use_tetra] = key
+        return key
+
+    def invalidate(self):
+        """
+        Drops the baked table and the memoized content hash.
+        The method must be called when LUT3DArray is modified.
+        """
+        self.__baked, self.__bakedKey = None, None
+        self.__hashes = {}
+
+    @classmethod
+    def pruneBakeDir(cls, keep=None):
+        """
+        Removes the least recently used tables from bakeDir,
+        until their total size is at most bakeBudget.
+        Tables still mapped by another process (Windows) are skipped.
+        @param keep: path of a table to keep
+        @type keep: str
+        """
+        try:
+            entries = [e for e in os.scandir(cls.bakeDir) if e.name.endswith('.npy') and e.path != keep]
+            # unfinished tables left by an interrupted build
+            for e in os.scandir(cls.bakeDir):
+                if e.name.endswith('.tmp') and time.time() - e.stat().st_mtime > cls.bakeStale:
+                    try:
+                        os.remove(e.path)
+                    except OSError:
+                        pass
+        except OSError:
+            return
+        stats = sorted(((e.stat(), e.path) for e in entries), key=lambda t: t[0].st_mtime)
+        total = sum(st.st_size for st, _ in stats)
+        if keep is not None and os.path.isfile(keep):
+            total += os.stat(keep).st_size
+        for st, path in stats:
+            if total <= cls.bakeBudget:
+                break
+            try:
+                os.remove(path)
+                total -= st.st_size
+            except OSError:
+                pass
+
+    def getBaked(self, use_tetra=False, build=True, wait=False):
+        """
+        Returns the baked table of the LUT : a dense table, with shape (256**3, d) and dtype uint8,
+        holding the interpolated values for all 8 bits colors. The entry for color (c0, c1, c2)
+        has index (c0 << 16) + (c1 << 8) + c2.
+        The table is memory mapped from a .npy file in LUT3D.bakeDir, named after
+        the content hash of the LUT. If the file does not exist and build
+        is True, the table is built and saved, otherwise None is returned.
+        Unless wait is True, the table is built in a background thread and None
+        is returned until it is ready : meanwhile, callers should interpolate
+        the LUT (cf. vImage.apply3DLUT()).
+        The modification time of the file records its last use, and the
+        total size of bakeDir is bounded by bakeBudget (cf. pruneBakeDir()).
+        @param use_tetra: tetrahedral interpolation
+        @type use_tetra: boolean
+        @param build: build missing table
+        @type build: boolean
+        @param wait: build missing table in the calling thread
+        @type wait: boolean
+        @return: baked table
+        @rtype: numpy.memmap or None
+        """
+        key = self.contentHash(use_tetra=use_tetra)
+        if self.__bakedKey == key:
+            return self.__baked
+        filename = os.path.join(self.bakeDir, key + '.npy')
+        if os.path.isfile(filename):
+            table = np.load(filename, mmap_mode='r')
+            try:
+                # mark as recently used
+                os.utime(filename)
+            except OSError:
+                pass
+        elif build:
+            # snapshot of the LUT : it may be modified while the table is built
+            args = (self.LUT3DArray.astype(np.float32), self.step,
+                    None if self.shaper is None else self.shaper.copy(), use_tetra, filename)
+            if not wait:
+                with LUT3D.__buildLock:
+                    if filename in LUT3D.__building:
+                        return None
+                    LUT3D.__building.add(filename)
+                threading.Thread(target=LUT3D.__bakeAsync, args=args, daemon=True).start()
+                return None
+            LUT3D.__bake(*args)
+            table = np.load(filename, mmap_mode='r')
+        else:
+            return None
+        self.__baked, self.__bakedKey = table, key
+        return table
+
+    @classmethod
+    def __bake(cls, LUT, step, shaper, use_tetra, filename):
+        """
+        Builds a baked table (cf. getBaked()) and saves it to filename.
+        @param LUT: LUT array
+        @type LUT: ndarray, dtype float32, shape (s, s, s, d)
+        @param step: interpolation step
+        @type step: float
+        @param shaper: 1D input curves
+        @type shaper: ndarray, shape (256, 3) or None
+        @param use_tetra: tetrahedral interpolation
+        @type use_tetra: boolean
+        @param filename: path of the table
+        @type filename: str
+        """
+        os.makedirs(cls.bakeDir, exist_ok=True)
+        nc = LUT.shape[-1]
+        interp = interpTetra if use_tetra else interpTriLinearStrips
+        # write to a temporary file, to never leave a partial table under the final name.
+        # The name is per thread, as the same table may be built by a background thread.
+        tmpName = '%s.%d.tmp' % (filename, threading.get_ident())
+        try:
+            table = np.lib.format.open_memmap(tmpName, mode='w+', dtype=np.uint8, shape=(256 ** 3, nc))
+            # planes of constant c0
+            a = np.arange(256, dtype=np.uint8)
+            plane = np.empty((256, 256, 3), dtype=np.uint8)
+            plane[:, :, 1], plane[:, :, 2] = a[:, np.newaxis], a
+            shaped = plane if shaper is None else np.empty(plane.shape, dtype=np.float32)
+            for c0 in range(256):
+                plane[:, :, 0] = c0
+                if shaper is not None:
+                    for c in range(3):
+                        np.take(shaper[:, c], plane[:, :, c], out=shaped[:, :, c])
+                interp(LUT, step, shaped, out=table[c0 << 16:(c0 + 1) << 16].reshape(256, 256, nc))
+            table.flush()
+            del table
+            os.replace(tmpName, filename)
+        except BaseException:
+            try:
+                os.remove(tmpName)
+            except OSError:
+                pass
+            raise
+        cls.pruneBakeDir(keep=filename)
+
+    @classmethod
+    def __bakeAsync(cls, *args):
+        """
+        Background version of __bake() : errors are ignored, and
+        the table is built again on next use.
+        """
+        filename = args[-1]
+        try:
+            cls.__bake(*args)
+        except (OSError, ValueError, MemoryError):
+            pass
+        finally:
+            with cls.__buildLock:
+                cls.__building.discard(filename)
+
+    def applyBaked(self, ndImg, out=None, use_tetra=False, rows=256):
+        """
+        Applies the LUT to an 8 bits image, by a single lookup
+        per pixel in the baked table (cf. getBaked()). The table is built if needed,
+        in the calling thread.
+        The image is processed by strips of rows, to bound the size of index arrays.
+        @param ndImg: input image
+        @type ndImg: ndarray, dtype uint8, shape (h, w, d0), d0 >= 3
+        @param out: output array
+        @type out: ndarray, dtype uint8, shape(h, w, d)
+        @param use_tetra: tetrahedral interpolation
+        @type use_tetra: boolean
+        @param rows: strip height
+        @type rows: int
+        @return: out
+        @rtype: ndarray
+        """
+        if ndImg.dtype != np.uint8:
+            raise ValueError('LUT3D.applyBaked : image must be 8 bits')
+        table = self.getBaked(use_tetra=use_tetra, wait=True)
+        h, w = ndImg.shape[:2]
+        if out is None:
+            out = np.empty((h, w, table.shape[-1]), dtype=np.uint8)
+        ind = np.empty((min(rows, h), w), dtype=np.uint32)
+        for r in range(0, h, rows):
+            n = min(rows, h - r)
+            strip, ix = ndImg[r:r + n], ind[:n]
+            np.left_shift(strip[:, :, 0], 16, out=ix, dtype=np.uint32)
+            ix |= np.left_shift(strip[:, :, 1], 8, dtype=np.uint32)
+            ix |= strip[:, :, 2]
+            out[r:r + n] = table[ix]
+        return out
+
     def toHaldArray(self, w, h):
         """
         Convert the LUT3D object to a hald array with shape (w,h,3).
@@ -263,16 +629,16 @@ class LUT3D (object):
         @param outStream:
         @type outStream: TextIoWrapper
         """
-        LUT = self.LUT3DArray
-        outStream.write('bLUe 3D LUT\n')
-        outStream.write('Size %d\n' % self.size)
-        coeff = 255.0
-        for b in range(self.size):
-            for g in range(self.size):
-                for r in range(self.size):
-                    # r1, g1, b1 = LUT[r, g, b]  # order RGB
-                    b1, g1, r1 = LUT[b, g, r]  # order BGR
-                    outStream.write("%.7f %.7f %.7f\n" % (r1 / coeff, g1 / coeff, b1 / coeff))
+        outStream.write('TITLE "%s"\n' % self.title)
+        if self.shaper is not None:
+            outStream.write('LUT_1D_SIZE 256\n')
+        outStream.write('LUT_3D_SIZE %d\n' % self.size)
+        if self.shaper is not None:
+            np.savetxt(outStream, self.shaper[:, ::-1] / 255.0, fmt='%.7f')
+        # the cube axes are in order BGR (R-axis changing most rapidly), thus
+        # we only reverse the channel order (BGR to RGB).
+        data = self.LUT3DArray[..., :3][..., ::-1].reshape(-1, 3) / 255.0
+        np.savetxt(outStream, data, fmt='%.7f')
 
     def writeToTextFile(self, filename):
         """
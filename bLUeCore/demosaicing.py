@@ -47,4 +47,43 @@ def demosaic(raw_image_visible, raw_colors_visible, black_level_per_channel):
     pattern = 'cv2.COLOR_BAYER_' + tmpdict[raw_colors_visible[1,1]] + tmpdict[raw_colors_visible[1,2]] + '2RGB'
     # demosaic
     demosaicBuffer = cv2.cvtColor(bayerBuf, eval(pattern))
-    return demosaicBuffer
\ No newline at end of file
+    return demosaicBuffer
+def binBayer(raw_image_visible, raw_colors_visible, black_level_per_channel, white_level, factor=2):
+    """
+    Builds a reduced RGB image from a Bayer sensor bitmap, without demosaicing :
+    each 2x2 quad of sensor points gives one pixel (the two green points are averaged),
+    next blocks of factor x factor pixels are averaged. Thus, the output
+    image dimensions are those of the sensor bitmap divided by 2 * factor.
+    Black levels are substracted and values are scaled to the range 0..65535.
+    The function returns None if the sensor pattern is not a Bayer pattern.
+    @param raw_image_visible: image from sensor
+    @type raw_image_visible: nd_array, dtype uint16, shape(img_h, img_w)
+    @param raw_colors_visible: color channels (0=R, 1=G, 2=B, 3=G)
+    @type raw_colors_visible: nd_array, dtype u1, shape(img_h, img_w)
+    @param black_level_per_channel:
+    @type black_level_per_channel: list or array, dtype= int
+    @param white_level: sensor saturation level
+    @type white_level: int
+    @param factor: binning factor
+    @type factor: int
+    @return: binned linear image or None
+    @rtype: ndarray, dtype uint16, shape (img_h // (2*factor), img_w // (2*factor), 3)
+    """
+    pattern = raw_colors_visible[:2, :2]
+    colors = np.where(pattern == 3, 1, pattern)
+    if sorted(colors.ravel().tolist()) != [0, 1, 1, 2]:
+        return None
+    step = 2 * factor
+    h, w = (raw_image_visible.shape[0] // step) * step, (raw_image_visible.shape[1] // step) * step
+    if h == 0 or w == 0:
+        return None
+    binned = np.zeros((h // 2, w // 2, 3), dtype=np.float32)
+    for i in range(2):
+        for j in range(2):
+            c = colors[i, j]
+            binned[:, :, c] += raw_image_visible[i:h:2, j:w:2] - np.float32(black_level_per_channel[pattern[i, j]])
+    binned[:, :, 1] /= 2
+    binned = binned.reshape(h // step, factor, w // step, factor, 3).mean(axis=(1, 3))
+    binned *= 65535 / (white_level - np.mean(black_level_per_channel))
+    np.clip(binned, 0, 65535, out=binned)
+    return binned.astype(np.uint16)
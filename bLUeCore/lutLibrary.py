@@ -0,0 +1,268 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .bLUeLUT3D import LUT3D
+from .trilinear import interpTriLinear
+
+#############################################
+# Library of 3D LUTs (.cube files).
+# A directory is indexed once : for each .cube file, the index
+# records its mtime, length, content hash, LUT size, shaper curves and a coarse
+# (9x9x9) subsampling of the LUT, used to render previews
+# without parsing the file. The index is persisted to disk
+# and re-scans only parse new or modified files.
+# LUT arrays are loaded on demand and kept in a LRU cache.
+#############################################
+
+
+class lutLibrary(object):
+    """
+    Index of the 3D LUTs found in a directory.
+    """
+    indexName = '.bLUe_LUTIndex.json'
+    indexVersion = 2
+    # number of nodes per axis of preview LUTs
+    previewSize = 9
+    # max number of LUT3D objects kept in memory
+    cacheSize = 16
+
+    def __init__(self, folder, cacheSize=None):
+        """
+        Loads the persisted index of folder, if any. Call
+        scan() to bring it up to date.
+        @param folder: path to the LUT directory
+        @type folder: str
+        @param cacheSize: max number of LUTs kept in memory
+        @type cacheSize: int
+        """
+        self.folder = os.path.abspath(folder)
+        if cacheSize is not None:
+            self.cacheSize = cacheSize
+        self.index = {}
+        self.__cache = OrderedDict()
+        self.__previews = {}
+        self.__lock = threading.Lock()
+        self.loadIndex()
+
+    @property
+    def indexPath(self):
+        """
+        The index is stored in the LUT directory, or in the temp
+        directory if the former is read only.
+        @return: path to index file
+        @rtype: str
+        """
+        p = os.path.join(self.folder, self.indexName)
+        if os.access(self.folder, os.W_OK):
+            return p
+        key = hashlib.sha1(self.folder.encode()).hexdigest()
+        return os.path.join(tempfile.gettempdir(), 'bLUe_LUTIndex_%s.json' % key)
+
+    def loadIndex(self):
+        """
+        Loads the persisted index. A missing or
+        unreadable index is silently reset.
+        """
+        try:
+            with open(self.indexPath) as f:
+                d = json.load(f)
+            if d.get('version') == self.indexVersion:
+                self.index = d['entries']
+        except (IOError, ValueError, KeyError):
+            self.index = {}
+
+    def saveIndex(self):
+        """
+        Saves the index to disk, atomically.
+        """
+        p = self.indexPath
+        tmp = p + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': self.indexVersion, 'entries': self.index}, f)
+            os.replace(tmp, p)
+        except IOError:
+            pass
+
+    def names(self):
+        """
+        @return: sorted names of indexed LUTs
+        @rtype: list of str
+        """
+        return sorted(self.index)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def scan(self, save=True):
+        """
+        Brings the index up to date : new or modified files are
+        parsed, entries of removed files are dropped.
+        Unchanged files (same mtime and length) are not read.
+        Files that cannot be parsed are skipped.
+        @param save: save index to disk if it was modified
+        @type save: boolean
+        @return: names of the (re-)indexed LUTs
+        @rtype: list of str
+        """
+        updated = []
+        found = set()
+        try:
+            entries = list(os.scandir(self.folder))
+        except OSError:
+            entries = []
+        for e in entries:
+            if not e.is_file() or not e.name.lower().endswith('.cube'):
+                continue
+            found.add(e.name)
+            st = e.stat()
+            old = self.index.get(e.name)
+            if old is not None and old['mtime'] == st.st_mtime_ns and old['length'] == st.st_size:
+                continue
+            try:
+                self.index[e.name] = self.indexEntry(e.path, st)
+            except (ValueError, IOError):
+                self.index.pop(e.name, None)
+                continue
+            with self.__lock:
+                self.__cache.pop(e.name, None)
+                self.__previews.pop(e.name, None)
+            updated.append(e.name)
+        removed = set(self.index) - found
+        for name in removed:
+            del self.index[name]
+            with self.__lock:
+                self.__cache.pop(name, None)
+                self.__previews.pop(name, None)
+        if save and (updated or removed):
+            self.saveIndex()
+        return updated
+
+    def indexEntry(self, filename, st):
+        """
+        Parses a .cube file and returns its index entry.
+        @param filename:
+        @type filename: str
+        @param st: file stat
+        @type st: os.stat_result
+        @return: index entry
+        @rtype: dict
+        """
+        with open(filename, 'rb') as f:
+            h = hashlib.sha1(f.read()).hexdigest()
+        lut = LUT3D.readFromTextFile(filename)
+        coarse = self.coarseLUT(lut)
+        return {'mtime': st.st_mtime_ns,
+                'length': st.st_size,
+                'hash': h,
+                'size': lut.size,
+                'title': lut.title,
+                'preview': base64.b64encode(coarse.tobytes()).decode('ascii'),
+                'shaper': None if lut.shaper is None else
+                          base64.b64encode(np.rint(lut.shaper).astype(np.uint8).tobytes()).decode('ascii')
+                }
+
+    @classmethod
+    def coarseLUT(cls, lut):
+        """
+        Subsamples a LUT3D to previewSize nodes per axis.
+        @param lut:
+        @type lut: LUT3D
+        @return: coarse LUT array
+        @rtype: ndarray, dtype=np.uint8, shape (previewSize, previewSize, previewSize, 3)
+        """
+        size, n = lut.size, cls.previewSize
+        a = lut.LUT3DArray[..., :3]
+        if (size - 1) % (n - 1) == 0:
+            s = (size - 1) // (n - 1)
+            a = a[::s, ::s, ::s]
+        else:
+            # nearest node
+            ind = np.rint(np.linspace(0, size - 1, n)).astype(int)
+            a = a[np.ix_(ind, ind, ind)]
+        return np.clip(a, 0, 255).astype(np.uint8)
+
+    def previewLUT(self, name):
+        """
+        @param name: LUT name
+        @type name: str
+        @return: coarse LUT
+        @rtype: LUT3D
+        """
+        n = self.previewSize
+        entry = self.index[name]
+        buf = np.frombuffer(base64.b64decode(entry['preview']), dtype=np.uint8)
+        shaper = entry.get('shaper')
+        if shaper is not None:
+            shaper = np.frombuffer(base64.b64decode(shaper), dtype=np.uint8).reshape(256, 3)
+        return LUT3D(buf.reshape(n, n, n, 3).astype(np.float32), size=n, shaper=shaper)
+
+    def preview(self, name, ndImg):
+        """
+        Renders a preview of a LUT applied to ndImg, using the coarse
+        LUT from the index. The full LUT is not loaded.
+        Previews are cached until the content of ndImg changes.
+        @param name: LUT name
+        @type name: str
+        @param ndImg: image, BGR order
+        @type ndImg: ndarray, dtype=np.uint8, shape (h, w, d), d >= 3
+        @return: preview, BGR order
+        @rtype: ndarray, dtype=np.uint8, shape (h, w, 3)
+        """
+        # content digest : ids of freed arrays are reused
+        key = (ndImg.shape, hashlib.sha1(np.ascontiguousarray(ndImg).tobytes()).hexdigest())
+        with self.__lock:
+            p = self.__previews.get(name)
+        if p is not None and p[0] == key:
+            return p[1]
+        lut = self.previewLUT(name)
+        out = interpTriLinear(lut.LUT3DArray, lut.step, lut.shapeInput(ndImg[:, :, :3]))
+        with self.__lock:
+            self.__previews[name] = (key, out)
+        return out
+
+    def getLUT(self, name):
+        """
+        Returns the LUT3D object corresponding to name. LUTs are
+        loaded on demand and kept in a LRU cache.
+        Raises ValueError or IOError.
+        @param name: LUT name
+        @type name: str
+        @return:
+        @rtype: LUT3D
+        """
+        with self.__lock:
+            lut = self.__cache.get(name)
+            if lut is not None:
+                self.__cache.move_to_end(name)
+                return lut
+        lut = LUT3D.readFromTextFile(self.path(name))
+        with self.__lock:
+            self.__cache[name] = lut
+            while len(self.__cache) > self.cacheSize:
+                self.__cache.popitem(last=False)
+        return lut
@@ -15,13 +15,19 @@ Lesser General Lesser Public License for more details.
 You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import os
 from functools import partial
+from multiprocessing.pool import ThreadPool
+from time import perf_counter
 import numpy as np
 
+from bLUeCore.bLUeLUT3D import LUT3D
+from bLUeCore.scheduler import bandSlices
 from bLUeCore.tetrahedral import interpTetra
-from bLUeCore.trilinear import interpTriLinear
+from bLUeCore.trilinear import interpTriLinear, interpTriLinearStrips
 
-def interpMulti(LUT, LUTSTEP, ndImg, pool=None, use_tetra=False, convert=True):
+
+def interpMulti(LUT, LUTSTEP, ndImg, pool=None, poolSize=None, use_tetra=False, convert=True, out=None):
     """
     Parallel trilinear/tetrahedral interpolation, using
     a pool of workers.
@@ -29,7 +35,18 @@ def interpMulti(LUT, LUTSTEP, ndImg, pool=None, use_tetra=False, convert=True):
     The roles (R or G or B) of the three first LUT channels
     must follow the ordering of the color channels.
     The output image is interpolated from the LUT.
-    It has the same type as the input image.
+
+    If pool is a thread pool (multiprocessing.pool.ThreadPool), the image is cut into
+    bands of rows, and the workers read ndImg and write the interpolated values directly into
+    the corresponding rows of the output array : there is neither serialization nor copy of the
+    data. Numpy kernels release the GIL, so the threads run concurrently.
+    Otherwise, image bands and LUT are sent to the worker processes and
+    results are collected into the output array.
+    Band count is a multiple of the pool size (cf. scheduler.bandSlices).
+
+    If out is None, a new output array is allocated, otherwise out must
+    have shape ndImg.shape[:2] + (LUT.shape[-1],). It can be a (non contiguous)
+    slice of an image buffer.
     @param LUT: 3D LUT array
     @type LUT: ndarray, dtype float or int, shape(s1, s2, s3, 3)
     @param LUTSTEP: interpolation step
@@ -38,29 +55,119 @@ def interpMulti(LUT, LUTSTEP, ndImg, pool=None, use_tetra=False, convert=True):
     @type ndImg: ndarray dtype float or int, shape (w, h, 3)
     @param pool: multiprocessing pool
     @type pool: mulpiprocessing.Pool
+    @param poolSize: worker count of pool (default os.cpu_count(), the default size of pools)
+    @type poolSize: int
     @param use_tetra: use tetrahedral interpolation
     @type use_tetra : boolean
     @param convert: convert the output to dtype=np.uint8
     @type convert: boolean
+    @param out: output array
+    @type out: ndarray, shape (w, h, d)
     @return: interpolated array
-    @rtype: ndarray, same shape as the input image
+    @rtype: ndarray, dtype np.uint8 if convert is True and float32 otherwise
     """
-    w, h = ndImg.shape[1], ndImg.shape[0]
-    SLF = 4
-    sl_w = [slice((w * i) // SLF, (w * (i+1)) // SLF) for i in range(SLF)]
-    sl_h = [slice((h * i) // SLF, (h * (i + 1)) // SLF) for i in range(SLF)]
-
-    slices = [ (s1, s2) for s1 in sl_w for s2 in sl_h]
-    imgList = [ndImg[s2, s1] for s1, s2 in slices]
     if pool is None:
         raise ValueError('interpMulti: no processing pool')
+    if out is None:
+        out = np.empty(ndImg.shape[:2] + (LUT.shape[-1],), dtype=np.uint8 if convert else np.float32)
+    if isinstance(pool, ThreadPool):
+        return interpThreads(LUT, LUTSTEP, ndImg, out, pool, poolSize=poolSize, use_tetra=use_tetra, convert=convert)
+    w, h = ndImg.shape[1], ndImg.shape[0]
+    slices = bandSlices(h, w, poolSize or os.cpu_count() or 1)
+    imgList = [ndImg[s] for s in slices]
     # get vectorized interpolation as partial function
     partial_f = partial(interpTetra if use_tetra else interpTriLinear, LUT, LUTSTEP, convert=convert)
     # parallel interpolation
     res = pool.map(partial_f, imgList)
-    outImg = np.empty(ndImg.shape)
     # collect results
-    for i, (s1, s2) in enumerate(slices):
-            outImg[s2, s1] = res[i]
+    for i, s in enumerate(slices):
+            out[s] = res[i]
     # np.clip(outImg, 0, 255, out=outImg) # chunks are already clipped
-    return outImg # .astype(np.uint8)  # TODO 07/09/18 validate
+    return out
+
+
+def interpThreads(LUT, LUTSTEP, ndImg, out, pool, poolSize=None, use_tetra=False, convert=True):
+    """
+    In place parallel interpolation, using a pool of threads.
+    The image is cut into bands of consecutive rows. Each worker
+    interpolates a band of ndImg and writes the result to the same band
+    of out. ndImg, LUT and out are shared by all threads.
+    @param LUT: 3D LUT array
+    @type LUT: ndarray, dtype float or int, shape(s1, s2, s3, d)
+    @param LUTSTEP: interpolation step
+    @type LUTSTEP: number or 3-uple of numbers
+    @param ndImg: input array
+    @type ndImg: ndarray dtype float or int, shape (h, w, d0)
+    @param out: output array
+    @type out: ndarray, shape (h, w, d)
+    @param pool: thread pool
+    @type pool: multiprocessing.pool.ThreadPool
+    @param poolSize: worker count of pool (default os.cpu_count())
+    @type poolSize: int
+    @param use_tetra: use tetrahedral interpolation
+    @type use_tetra : boolean
+    @param convert: clip the output to (0, 255) and convert it to dtype=np.uint8
+    @type convert: boolean
+    @return: out
+    @rtype: ndarray
+    """
+    if not LUT.flags['C_CONTIGUOUS']:
+        raise ValueError('interpThreads : LUT array must be contiguous')
+    # convert the LUT once for all workers
+    LUT = LUT.astype(np.float32)
+    bands = bandSlices(ndImg.shape[0], ndImg.shape[1], poolSize or os.cpu_count() or 1)
+
+    def interpBand(band):
+        if use_tetra:
+            interpTetra(LUT, LUTSTEP, ndImg[band], convert=convert, out=out[band])
+        else:
+            interpTriLinearStrips(LUT, LUTSTEP, ndImg[band], out=out[band], convert=convert)
+
+    pool.map(interpBand, bands)
+    return out
+
+
+def calibrateParallelThreshold(pool, poolSize, use_tetra=False, maxPixels=2 ** 21, repeat=2):
+    """
+    Measures the smallest pixel count for which parallel interpolation
+    with pool is faster than serial interpolation.
+    Random images of increasing sizes (powers of 2) are interpolated
+    with an identity LUT. If parallel interpolation never wins, or if
+    there is a single cpu, maxPixels is returned.
+    @param pool: pool of workers
+    @type pool: multiprocessing.Pool
+    @param poolSize: worker count of pool
+    @type poolSize: int
+    @param use_tetra: use tetrahedral interpolation
+    @type use_tetra: boolean
+    @param maxPixels: max pixel count of test images
+    @type maxPixels: int
+    @param repeat: number of timings for each size (the best one is kept)
+    @type repeat: int
+    @return: parallel/serial cutoff
+    @rtype: int
+    """
+    if (os.cpu_count() or 1) == 1 or poolSize == 1:
+        return maxPixels
+    lut = LUT3D(None, size=LUT3D.defaultSize)
+    LUT = lut.LUT3DArray.astype(np.float32)
+    serial = (lambda img: interpTetra(LUT, lut.step, img)) if use_tetra else \
+             (lambda img: interpTriLinearStrips(LUT, lut.step, img))
+
+    def timing(f, img):
+        best = float('inf')
+        for _ in range(repeat):
+            t = perf_counter()
+            f(img)
+            best = min(best, perf_counter() - t)
+        return best
+
+    pixels = 2 ** 16
+    while pixels <= maxPixels:
+        w = int(np.sqrt(pixels))
+        img = np.random.randint(0, 256, size=(pixels // w, w, 3), dtype=np.uint8)
+        tPar = timing(lambda x: interpMulti(LUT, lut.step, x, pool=pool, poolSize=poolSize, use_tetra=use_tetra), img)
+        if tPar < timing(serial, img):
+            return pixels
+        pixels *= 2
+    return maxPixels
@@ -0,0 +1,119 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+from math import ceil
+
+#####################
+# Default L2 cache size (bytes), used when
+# the actual size cannot be read from the system.
+L2_DEFAULT_SIZE = 2 ** 20
+#####################
+
+#########################
+# scratch memory per pixel (bytes)
+# used by the strip kernel interpTriLinearStrips for a 3 channel LUT
+STRIP_BYTES_PER_PIXEL = 144
+#########################
+
+###########################
+# max pixel count of the bands sent to workers.
+# It bounds the temporary memory used by
+# the non strip kernels in each worker.
+MAX_BAND_PIXELS = 2 ** 20
+###########################
+
+##################################
+# Parallel/serial cutoff (pixel count).
+# Images with a larger pixel count are
+# interpolated in parallel. It is updated
+# by setParallelThreshold, after calibration.
+parallelThreshold = 3000000
+##################################
+
+
+def getL2CacheSize():
+    """
+    Returns the size (in bytes) of the L2 cache of the first cpu,
+    read from sysfs (Linux) and L2_DEFAULT_SIZE otherwise.
+    @return: cache size
+    @rtype: int
+    """
+    try:
+        with open('/sys/devices/system/cpu/cpu0/cache/index2/size') as f:
+            s = f.read().strip().upper()
+        mult = {'K': 2 ** 10, 'M': 2 ** 20}.get(s[-1:], 1)
+        return int(s.rstrip('KM')) * mult
+    except (IOError, OSError, ValueError):
+        return L2_DEFAULT_SIZE
+
+
+def cacheStripPixels():
+    """
+    Returns the pixel count of the strips used by the strip kernels :
+    scratch buffers for a strip should fit in half the L2 cache.
+    @return: pixel count
+    @rtype: int
+    """
+    return min(max(getL2CacheSize() // (2 * STRIP_BYTES_PER_PIXEL), 2 ** 10), 2 ** 16)
+
+
+def bandSlices(h, w, workers, maxBandPixels=MAX_BAND_PIXELS):
+    """
+    Cuts an image with shape (h, w) into bands of consecutive rows.
+    Band count is a multiple of the worker count,
+    and each band holds at most maxBandPixels pixels (unless
+    the band count is limited by h).
+    Rows are contiguous in memory, so bands are sliced and
+    transferred without gathering scattered data.
+    @param h: image height
+    @type h: int
+    @param w: image width
+    @type w: int
+    @param workers: worker count
+    @type workers: int
+    @param maxBandPixels: max pixel count in a band
+    @type maxBandPixels: int
+    @return: row slices
+    @rtype: list of slice objects
+    """
+    workers = max(1, workers)
+    count = workers * max(1, ceil(h * w / (workers * maxBandPixels)))
+    count = max(1, min(count, h))
+    return [slice((h * i) // count, (h * (i + 1)) // count) for i in range(count)]
+
+
+def isParallel(pixelCount, pool):
+    """
+    Chooses between parallel and serial interpolation
+    @param pixelCount: image pixel count
+    @type pixelCount: int
+    @param pool:
+    @type pool: multiprocessing.Pool
+    @return: True if parallel interpolation should be used
+    @rtype: boolean
+    """
+    return pool is not None and pixelCount > parallelThreshold
+
+
+def setParallelThreshold(threshold):
+    """
+    Sets the parallel/serial cutoff
+    @param threshold: pixel count
+    @type threshold: int
+    """
+    global parallelThreshold
+    parallelThreshold = int(threshold)
@@ -18,8 +18,10 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
 
+from bLUeCore.trilinear import STRIP_PIXELS
 
-def interpTetra(LUT, LUTSTEP, ndImg, convert=True):
+
+def interpTetra(LUT, LUTSTEP, ndImg, convert=True, out=None, stripPixels=STRIP_PIXELS):
     """
     Implement a vectorized version of tetrahedral interpolation.
 
@@ -39,8 +41,16 @@ def interpTetra(LUT, LUTSTEP, ndImg, convert=True):
     to dtype=np.uint8, otherwise the output array has the same shape as ndImg and
     dtype= np.float32.
 
-    It turns out that tetrahedral interpolation is 2 times slower
-    than trilinear.
+    The bounding unit cube of each point is split into 6 tetrahedra, all sharing
+    the diagonal from vertex (0, 0, 0) to vertex (1, 1, 1). The tetrahedron
+    containing the point is given by the ordering of its fractional
+    parts fx >= fy >= fz, and the interpolated value is
+    (1 - fx) * V0 + (fx - fy) * V1 + (fy - fz) * V2 + fz * V3,
+    where V1 = V0 + ex and V2 = V1 + ey. Only these 4 vertices are gathered
+    from the LUT.
+
+    The image is processed by strips of about stripPixels pixels (cf. trilinear.interpTriLinearStrips),
+    and the result is written to out. If out is None, a new output array is allocated.
     @param LUT: 3D LUT array
     @type LUT: ndarray, dtype float or int, shape(s1, s2, s3, 3)
     @param LUTSTEP: interpolation step
@@ -49,81 +59,77 @@ def interpTetra(LUT, LUTSTEP, ndImg, convert=True):
     @type ndImg: ndarray dtype float or int, shape (w, h, 3)
     @param convert: convert the output to dtype=np.uint8
     @type convert: boolean
-    @return: interpolatd array
+    @param out: output array
+    @type out: ndarray, shape (w, h, d)
+    @param stripPixels: approximate pixel count of strips
+    @type stripPixels: int
+    @return: interpolated array
     @rtype: ndarray, same shape as the input image
     """
-    # Probably due to a numpy bug, ravel_multi_index sometimes returns wrong indices
-    # for non contiguous arrays.
     if not LUT.flags['C_CONTIGUOUS']:
         raise ValueError('interpTetra : LUT array must be contiguous')
-    # As interpolation computes differences, we switch to a signed type,
-    # minimizing memory usage and implicit conversions.
-    LUT = LUT.astype(np.float32)
-    # We will use the bounding unit cube around each point (r, g, b)/LUTSTEP :
-    # get its vertex closest to the origin and the corresponding channel colors.
-    ndImgF = ndImg / LUTSTEP
-    a = ndImgF.astype(np.int16)
-    # RGB channels
-    r0, g0, b0 = a[:, :, 0], a[:, :, 1], a[:, :, 2]
-
-    # get indices of vertex channels in the flattened LUT
-    s = LUT.shape
-    st = np.array(LUT.strides)
-    st = st // st[-1]  # we count items instead of bytes
-    flatIndex = np.ravel_multi_index((r0[..., np.newaxis],
-                                      g0[..., np.newaxis],
-                                      b0[..., np.newaxis],
-                                      np.arange(s[-1])),
-                                      s)  # broadcasted to shape (w,h,3)
-
-    # apply LUT to the vertices of the bounding cube
-    # np.take uses the the flattened LUT, but keeps the shape of flatIndex
-    ndImg00 = np.take(LUT, flatIndex)                            # = LUT[r0, g0, b0] but faster
-    ndImg01 = np.take(LUT, flatIndex + st[0])                    # = LUT[r1, g0, b0] where r1 = r0 + 1
-    ndImg02 = np.take(LUT, flatIndex + st[1])                    # = LUT[r0, g1, b0]
-    ndImg03 = np.take(LUT, flatIndex + (st[0] + st[1]))          # = LUT[r1, g1, b0]
-    ndImg10 = np.take(LUT, flatIndex + st[2])                    # = LUT[r0, g0, b1]
-    ndImg11 = np.take(LUT, flatIndex + (st[0] + st[2]))          # = LUT[r1, g0, b1]
-    ndImg12 = np.take(LUT, flatIndex + (st[1] + st[2]))          # = LUT[r0, g1, b1]
-    ndImg13 = np.take(LUT, flatIndex + (st[0] + st[1] + st[2]))  # = LUT[r1, g1, b1]
-
-    fR = ndImgF[:, :, 0] - a[:, :, 0]
-    fG = ndImgF[:, :, 1] - a[:, :, 1]
-    fB = ndImgF[:, :, 2] - a[:, :, 2]
-    oneMinusFR = (1 - fR)[..., np.newaxis] * ndImg00
-    oneMinusFG = (1 - fG)[..., np.newaxis] * ndImg00
-    oneMinusFB = (1 - fB)[..., np.newaxis] * ndImg00
-
-    fRG = (fR - fG)[..., np.newaxis]
-    fGB = (fG - fB)[..., np.newaxis]
-    fBR = (fB - fR)[..., np.newaxis]
-    fR = fR[..., np.newaxis]
-    fG = fG[..., np.newaxis]
-    fB = fB[..., np.newaxis]
-
-    # regions
-    C1 = fR > fG
-    C2 = fG > fB
-    C3 = fB > fR
-
-    fR = fR * ndImg13
-    fG = fG * ndImg13
-    fB = fB * ndImg13
-
-    X0 = oneMinusFG + fGB * ndImg02 + fBR * ndImg12 + fR  # fG > fB > fR
-    X1 = oneMinusFB + fBR * ndImg10 + fRG * ndImg11 + fG  # fB > fR > fG
-    X2 = oneMinusFB - fGB * ndImg10 - fRG * ndImg12 + fR  # fB >=fG >=fR
-    X3 = oneMinusFR + fRG * ndImg01 + fGB * ndImg03 + fB  # fR > fG > fB
-    X4 = oneMinusFG - fRG * ndImg02 - fBR * ndImg03 + fB  # fG >=fR >=fB
-    X5 = oneMinusFR - fBR * ndImg01 - fGB * ndImg11 + fG  # fR >=fB >=fG
-
-    Y1 = np.select(
-                [C2 * C3, C3 * C1, np.logical_not(np.logical_or(C1, C2)), C1 * C2, np.logical_not(np.logical_or(C1,C3))],
-                [X0, X1, X2, X3, X4],  # clockwise ordering: X3, X5, X1, X2, X0, X4
-                default=X5
-                )
-
-    if convert:
-        np.clip(Y1, 0, 255, out=Y1)
-        Y1 = Y1.astype(np.uint8)
-    return Y1
+    h, w = ndImg.shape[:2]
+    nc = LUT.shape[-1]
+    if out is None:
+        out = np.empty((h, w, nc), dtype=np.uint8 if convert else np.float32)
+    elif out.shape != (h, w, nc):
+        raise ValueError('interpTetra : wrong output shape')
+    if h == 0 or w == 0:
+        return out
+    flatLUT = LUT.astype(np.float32).ravel()
+    st = np.array(LUT.strides) // LUT.strides[-1]  # we count items instead of bytes
+    st3 = st[:3]
+    diag = st3.sum()  # offset of vertex (1, 1, 1)
+    step = np.asarray(LUTSTEP, dtype=np.float32)
+    chans = np.arange(nc)
+    rows = max(1, min(h, stripPixels // w))
+    # scratch buffers
+    F = np.empty((rows, w, 3), dtype=np.float32)   # scaled coordinates, next fractional parts
+    I = np.empty((rows, w, 3), dtype=np.intp)      # bounding cube origin
+    base = np.empty((rows, w, nc), dtype=np.intp)  # flat indices of origin channels
+    ind = np.empty((rows, w, nc), dtype=np.intp)
+    X = np.empty((rows, w, 3), dtype=np.float32)   # sorted fractional parts
+    P = [np.empty((rows, w, nc), dtype=np.float32) for _ in range(3)]
+    T = np.empty((rows, w, nc), dtype=np.float32)
+    for r in range(0, h, rows):
+        n = min(rows, h - r)
+        f, i, b, ix, x, t = F[:n], I[:n], base[:n], ind[:n], X[:n], T[:n]
+        acc, p1, p2 = (p[:n] for p in P)
+        np.divide(ndImg[r:r + n, :, :3], step, out=f, casting='unsafe')
+        np.copyto(i, f, casting='unsafe')  # truncation : input values are >= 0
+        np.subtract(f, i, out=f, casting='unsafe')
+        np.multiply(i, st3, out=i)
+        np.sum(i, axis=-1, keepdims=True, out=b[:, :, :1])
+        np.add(b[:, :, :1], chans, out=b)
+        # select the tetrahedron : the path V0 -> V1 -> V2 -> V3 follows the axes
+        # by decreasing order of fractional parts.
+        aMax = np.argmax(f, axis=-1)
+        aMin = np.argmin(f, axis=-1)
+        off1 = st3[aMax][..., np.newaxis]
+        off2 = (diag - st3[aMin])[..., np.newaxis]
+        np.max(f, axis=-1, out=x[:, :, 0])
+        np.min(f, axis=-1, out=x[:, :, 2])
+        np.sum(f, axis=-1, out=x[:, :, 1])
+        x[:, :, 1] -= x[:, :, 0]
+        x[:, :, 1] -= x[:, :, 2]
+        # V0 + fx * (V1 - V0) + fy * (V2 - V1) + fz * (V3 - V2)
+        np.take(flatLUT, b, out=acc, mode='clip')
+        np.add(b, off1, out=ix)
+        np.take(flatLUT, ix, out=p1, mode='clip')
+        np.subtract(p1, acc, out=t)
+        t *= x[:, :, 0:1]
+        acc += t
+        np.add(b, off2, out=ix)
+        np.take(flatLUT, ix, out=p2, mode='clip')
+        np.subtract(p2, p1, out=t)
+        t *= x[:, :, 1:2]
+        acc += t
+        np.add(b, diag, out=ix)
+        np.take(flatLUT, ix, out=p1, mode='clip')
+        np.subtract(p1, p2, out=t)
+        t *= x[:, :, 2:3]
+        acc += t
+        if convert:
+            np.clip(acc, 0, 255, out=acc)
+        out[r:r + n] = acc
+    return out
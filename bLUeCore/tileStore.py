@@ -0,0 +1,297 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import bisect
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+#############################################
+# Tiled store for image buffers which are not
+# currently used (render caches, inactive pyramid levels...).
+# Arrays are split into square tiles. Tiles are kept
+# uncompressed in memory (hot tiles) up to a memory budget;
+# least recently used tiles are then compressed (zlib) and kept in
+# memory, or spilled to a temporary file if a spill file is used.
+#############################################
+
+
+class tileStore(object):
+    """
+    LRU store of image arrays, split into tiles.
+    Entries are identified by hashable keys. Stored arrays
+    are copies : modifying the array passed to put() or
+    the array returned by get() does not modify the stored entry.
+    The class is thread safe.
+    """
+    def __init__(self, budget=512 * 2 ** 20, tileSize=256, spill=False, level=1):
+        """
+        @param budget: max memory used by uncompressed tiles (bytes)
+        @type budget: int
+        @param tileSize: tile size (pixels)
+        @type tileSize: int
+        @param spill: spill cold tiles to a temporary file
+        @type spill: boolean
+        @param level: zlib compression level
+        @type level: int
+        """
+        self.budget = budget
+        self.tileSize = tileSize
+        self.level = level
+        # entries : key --> (shape, dtype, list of tile ids)
+        self.__entries = {}
+        # hot tiles (LRU order) : tile id --> array
+        self.__hot = OrderedDict()
+        # cold tiles : tile id --> (shape, compressed bytes) or (shape, (offset, length)) if spilled
+        self.__cold = {}
+        self.hotBytes, self.coldBytes = 0, 0
+        self.__nextId = 0
+        self.__lock = threading.Lock()
+        self.__spill = tempfile.TemporaryFile() if spill else None
+        # free extents of the spill file : list of (offset, length),
+        # sorted by offset. Adjacent extents are merged.
+        self.__free = []
+        self.__spillSize = 0
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def keys(self):
+        with self.__lock:
+            return list(self.__entries)
+
+    def put(self, key, array):
+        """
+        Stores a copy of array. An existing entry with
+        the same key is replaced.
+        @param key:
+        @type key: hashable
+        @param array: image array
+        @type array: ndarray, shape (h, w) or (h, w, d)
+        """
+        t = self.tileSize
+        h, w = array.shape[:2]
+        with self.__lock:
+            self.__discard(key)
+            ids = []
+            for i in range(0, h, t):
+                for j in range(0, w, t):
+                    tile = array[i:i + t, j:j + t].copy()
+                    tid = self.__nextId
+                    self.__nextId += 1
+                    self.__hot[tid] = tile
+                    self.hotBytes += tile.nbytes
+                    ids.append(tid)
+            self.__entries[key] = (array.shape, array.dtype, ids)
+            self.__evict()
+
+    def get(self, key, default=None):
+        """
+        Returns a copy of the array stored under key,
+        or default if there is no such entry.
+        @param key:
+        @type key: hashable
+        @param default:
+        @type default: object
+        @return:
+        @rtype: ndarray
+        """
+        t = self.tileSize
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return default
+            shape, dtype, ids = entry
+            out = np.empty(shape, dtype=dtype)
+            h, w = shape[:2]
+            k = 0
+            for i in range(0, h, t):
+                for j in range(0, w, t):
+                    out[i:i + t, j:j + t] = self.__getTile(ids[k], dtype)
+                    k += 1
+            self.__evict()
+            return out
+
+    def discard(self, key):
+        """
+        Removes an entry, if it exists.
+        @param key:
+        @type key: hashable
+        """
+        with self.__lock:
+            self.__discard(key)
+
+    def purge(self, owner):
+        """
+        Removes all entries whose key is a tuple starting with owner.
+        @param owner:
+        @type owner: hashable
+        """
+        with self.__lock:
+            for key in [k for k in self.__entries if type(k) is tuple and k and k[0] == owner]:
+                self.__discard(key)
+
+    def clear(self):
+        with self.__lock:
+            for key in list(self.__entries):
+                self.__discard(key)
+
+    def stats(self):
+        """
+        @return: entry count, hot, cold (compressed) and spill file sizes (bytes)
+        @rtype: dict
+        """
+        with self.__lock:
+            return {'entries': len(self.__entries), 'hot': self.hotBytes, 'cold': self.coldBytes,
+                    'spill': self.__spillSize}
+
+    def __discard(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return
+        for tid in entry[2]:
+            tile = self.__hot.pop(tid, None)
+            if tile is not None:
+                self.hotBytes -= tile.nbytes
+                continue
+            shape, data = self.__cold.pop(tid)
+            self.__releaseCold(data)
+
+    def __releaseCold(self, data):
+        if self.__spill is not None:
+            self.__freeExtent(*data)
+            self.coldBytes -= data[1]
+        else:
+            self.coldBytes -= len(data)
+
+    def __freeExtent(self, offset, length):
+        """
+        Adds an extent to the free extents of the spill file, merging
+        it with its neighbours. A free extent at the end of the file is
+        dropped and the file is truncated. The lock must be held.
+        """
+        free = self.__free
+        k = bisect.bisect_left(free, (offset, length))
+        # merge with next extent
+        if k < len(free) and offset + length == free[k][0]:
+            length += free.pop(k)[1]
+        # merge with previous extent
+        if k > 0 and free[k - 1][0] + free[k - 1][1] == offset:
+            k -= 1
+            offset, length = free[k][0], free[k][1] + length
+            del free[k]
+        if offset + length == self.__spillSize:
+            self.__spillSize = offset
+            self.__spill.truncate(offset)
+        else:
+            free.insert(k, (offset, length))
+
+    def __getTile(self, tid, dtype):
+        """
+        Returns a hot tile, decompressing it if needed. The lock must be held.
+        """
+        tile = self.__hot.get(tid)
+        if tile is not None:
+            self.__hot.move_to_end(tid)
+            return tile
+        shape, data = self.__cold.pop(tid)
+        if self.__spill is not None:
+            offset, length = data
+            self.__spill.seek(offset)
+            buf = self.__spill.read(length)
+        else:
+            buf = data
+        self.__releaseCold(data)
+        tile = np.frombuffer(zlib.decompress(buf), dtype=dtype).reshape(shape).copy()
+        self.__hot[tid] = tile
+        self.hotBytes += tile.nbytes
+        return tile
+
+    def __evict(self):
+        """
+        Compresses (and spills) least recently used
+        tiles until the budget is met. The lock must be held.
+        """
+        while self.hotBytes > self.budget and self.__hot:
+            tid, tile = self.__hot.popitem(last=False)
+            self.hotBytes -= tile.nbytes
+            buf = zlib.compress(tile.tobytes(), self.level)
+            if self.__spill is not None:
+                data = self.__write(buf)
+                self.coldBytes += data[1]
+            else:
+                data = buf
+                self.coldBytes += len(buf)
+            self.__cold[tid] = (tile.shape, data)
+
+    def __write(self, buf):
+        """
+        Writes buf to the spill file, reusing a free extent if possible.
+        @return: offset, length
+        @rtype: 2-uple of int
+        """
+        n = len(buf)
+        for k, (offset, length) in enumerate(self.__free):
+            if length >= n:
+                if length > n:
+                    self.__free[k] = (offset + n, length - n)
+                else:
+                    del self.__free[k]
+                break
+        else:
+            offset = self.__spillSize
+            self.__spillSize += n
+        self.__spill.seek(offset)
+        self.__spill.write(buf)
+        return offset, n
+
+
+#######################
+# store shared by all images,
+# cf. defaultStore()
+#######################
+__defaultStore = None
+__defaultLock = threading.Lock()
+
+
+def defaultStore(budget=512 * 2 ** 20, tileSize=256, spill=False):
+    """
+    Returns the store shared by all images. It is
+    created by the first call, using the parameters; they are
+    ignored by subsequent calls.
+    @param budget: max memory used by uncompressed tiles (bytes)
+    @type budget: int
+    @param tileSize: tile size (pixels)
+    @type tileSize: int
+    @param spill: spill cold tiles to a temporary file
+    @type spill: boolean
+    @return:
+    @rtype: tileStore
+    """
+    global __defaultStore
+    with __defaultLock:
+        if __defaultStore is None:
+            __defaultStore = tileStore(budget=budget, tileSize=tileSize, spill=spill)
+        return __defaultStore
@@ -17,6 +17,8 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import numpy as np
 
+from bLUeCore.scheduler import cacheStripPixels
+
 
 def interpTriLinear(LUT, LUTSTEP, ndImg, convert=True):
     """
@@ -116,3 +118,112 @@ def interpTriLinear(LUT, LUTSTEP, ndImg, convert=True):
         np.clip(IValue, 0, 255, out=IValue)
         IValue = IValue.astype(np.uint8)
     return IValue
+
+
+##########################
+# Strip based interpolation :
+# pixel count of the row strips processed
+# by interpTriLinearStrips. Scratch buffers
+# (5 float32 and 2 index planes per strip)
+# should fit in L2 cache.
+STRIP_PIXELS = cacheStripPixels()
+##########################
+
+
+def interpTriLinearStrips(LUT, LUTSTEP, ndImg, out=None, convert=True, stripPixels=STRIP_PIXELS):
+    """
+    Strip based version of interpTriLinear.
+
+    The image is processed in strips of consecutive rows, holding about
+    stripPixels pixels. For each strip, the vertices of the bounding cubes
+    are gathered from the LUT and interpolated into a small set of scratch
+    buffers, allocated once. The result is written directly into the corresponding
+    rows of the output array. Thus, the extra memory needed is bounded by
+    the strip size and does not depend on the image size.
+
+    Results are identical to those of interpTriLinear, up to
+    float32 rounding (1 LSB).
+
+    If out is None, a new output array is allocated, otherwise out must
+    have shape ndImg.shape[:2] + (LUT.shape[-1],). It can be a (non contiguous)
+    slice of an image buffer. If convert is True (default), values are clipped to (0, 255)
+    and truncated to integers when written to out.
+
+    @param LUT: 3D LUT array
+    @type LUT: ndarray, dtype float or int, shape(s1, s2, s3, d)
+    @param LUTSTEP: interpolation step
+    @type LUTSTEP: number or 3-uple of numbers
+    @param ndImg: input array
+    @type ndImg: ndarray dtype float or int, shape (h, w, d0), d0 >= 3
+    @param out: output array
+    @type out: ndarray, shape (h, w, d)
+    @param convert: clip the output to (0, 255) and convert it to dtype=np.uint8
+    @type convert: boolean
+    @param stripPixels: approximate pixel count of strips
+    @type stripPixels: int
+    @return: interpolated array
+    @rtype: ndarray, shape (h, w, d)
+    """
+    if not LUT.flags['C_CONTIGUOUS']:
+        raise ValueError('interpTriLinearStrips : LUT array must be contiguous')
+    h, w = ndImg.shape[:2]
+    nc = LUT.shape[-1]
+    if out is None:
+        out = np.empty((h, w, nc), dtype=np.uint8 if convert else np.float32)
+    elif out.shape != (h, w, nc):
+        raise ValueError('interpTriLinearStrips : wrong output shape')
+    if h == 0 or w == 0:
+        return out
+    flatLUT = LUT.astype(np.float32).ravel()
+    st = np.array(LUT.strides) // LUT.strides[-1]  # we count items instead of bytes
+    # offsets of the cube vertices in the flattened LUT, in the order of the
+    # intermediate planes I22, I21, I12, I11 (cf. interpTriLinear)
+    vertexPairs = ((0, st[1]),                    # (r0, g0, b0), (r0, g1, b0)
+                   (st[0], st[0] + st[1]),        # (r1, g0, b0), (r1, g1, b0)
+                   (st[2], st[1] + st[2]),        # (r0, g0, b1), (r0, g1, b1)
+                   (st[0] + st[2], st[0] + st[1] + st[2]))  # (r1, g0, b1), (r1, g1, b1)
+    step = np.asarray(LUTSTEP, dtype=np.float32)
+    chans = np.arange(nc)
+    rows = max(1, min(h, stripPixels // w))
+    # scratch buffers
+    F = np.empty((rows, w, 3), dtype=np.float32)         # scaled coordinates, next fractional parts
+    I = np.empty((rows, w, 3), dtype=np.intp)            # bounding cube origin
+    base = np.empty((rows, w, nc), dtype=np.intp)        # flat indices of origin channels
+    ind = np.empty((rows, w, nc), dtype=np.intp)
+    P = [np.empty((rows, w, nc), dtype=np.float32) for _ in range(4)]
+    T = np.empty((rows, w, nc), dtype=np.float32)
+    for r in range(0, h, rows):
+        n = min(rows, h - r)
+        f, i, b, ix, t = F[:n], I[:n], base[:n], ind[:n], T[:n]
+        p22, p21, p12, p11 = (p[:n] for p in P)
+        np.divide(ndImg[r:r + n, :, :3], step, out=f, casting='unsafe')
+        np.copyto(i, f, casting='unsafe')  # truncation : input values are >= 0
+        np.subtract(f, i, out=f, casting='unsafe')
+        np.multiply(i, st[:3], out=i)
+        np.sum(i, axis=-1, keepdims=True, out=b[:, :, :1])
+        np.add(b[:, :, :1], chans, out=b)
+        alpha, beta, gamma = f[:, :, 1:2], f[:, :, 0:1], f[:, :, 2:3]
+        # interpolation along the g-axis
+        for p, (o0, o1) in zip((p22, p21, p12, p11), vertexPairs):
+            np.add(b, o0, out=ix)
+            np.take(flatLUT, ix, out=p, mode='clip')
+            np.add(b, o1, out=ix)
+            np.take(flatLUT, ix, out=t, mode='clip')
+            t -= p
+            t *= alpha
+            p += t
+        # r-axis : I2 = I22 + beta * (I21 - I22), I1 = I12 + beta * (I11 - I12)
+        p21 -= p22
+        p21 *= beta
+        p22 += p21
+        p11 -= p12
+        p11 *= beta
+        p12 += p11
+        # b-axis : I = I2 + gamma * (I1 - I2)
+        p12 -= p22
+        p12 *= gamma
+        p22 += p12
+        if convert:
+            np.clip(p22, 0, 255, out=p22)
+        out[r:r + n] = p22
+    return out
@@ -108,8 +108,8 @@ class blendFilterForm (baseForm):
                 if self.listWidget1.options[key]:
                     self.kernelCategory = filterDict[key]
                     break
-            self.layer.applyToStack()
-            self.layer.parentImage.onImageChanged()
+            # background render, onImageChanged() is called when done
+            self.layer.applyToStackAsync()
 
         self.dataChanged.connect(updateLayer)  # TODO 3/12/18 move to setDefaults
         # layout
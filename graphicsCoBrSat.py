@@ -358,8 +358,8 @@ Sliders are <b>reset</b> to their default value by double clicking the name of t
         data changed event handler.
         """
         self.enableSliders()
-        self.layer.applyToStack()
-        self.layer.parentImage.onImageChanged()
+        # background render, onImageChanged() is called when done
+        self.layer.applyToStackAsync()
         # enable/disable options relative to multi-mode
         for intname in ['High', 'manualCurve']:
             item = self.listWidget2.items[intname]
@@ -195,8 +195,8 @@ class filterForm (baseForm):
             if self.listWidget1.options[key]:
                 self.kernelCategory = self.filterDict[key]
                 break
-        self.layer.applyToStack()
-        self.layer.parentImage.onImageChanged()
+        # background render, onImageChanged() is called when done
+        self.layer.applyToStackAsync()
 
     def enableSliders(self):
         opt = self.listWidget1.options
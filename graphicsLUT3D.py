@@ -405,6 +405,8 @@ class activeNode(QGraphicsPathItem):
                 nbghd1[..., 3] = 0
             else:
                 nbghd1[..., 3] = 255
+        # the baked table (if any) is out of date
+        self.scene().lut.invalidate()
 
     def gridPos(self):
         """
@@ -1244,6 +1246,7 @@ This option must be unchecked to build a mask from the 3D LUT.<br>
         l = inStream.readInt32()
         byteData = inStream.readRawData(l)
         self.graphicsScene.lut.LUT3DArray = np.fromstring(byteData, dtype=int).reshape((size, size, size, 3))
+        self.graphicsScene.lut.invalidate()
         return inStream
 
 
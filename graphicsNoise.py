@@ -125,8 +125,8 @@ class noiseForm (baseForm):
         #if invalidate:
             #self.layer.postProcessCache = None  # TODO 2/11/18 unused validate
         #self.enableSliders()
-        self.layer.applyToStack()
-        self.layer.parentImage.onImageChanged()
+        # background render, onImageChanged() is called when done
+        self.layer.applyToStackAsync()
 
     def slider2Thr(self, v):
         return v
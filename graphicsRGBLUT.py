@@ -300,7 +300,7 @@ class graphicsForm(graphicsCurveForm) :
         layer = graphicsScene.layer
         outStream.writeQString(layer.actionName)
         outStream.writeQString(layer.name)
-        if layer.actionName in ['actionBrightness_Contrast', 'actionCurves_HSpB', 'actionCurves_Lab']:
+        if layer.actionName in ['actionBrightness_Contrast', 'actionCurves_RGB', 'actionCurves_HSpB', 'actionCurves_Lab']:
             outStream.writeQString(self.listWidget1.selectedItems()[0].text())
             graphicsScene.cubicRGB.writeToStream(outStream)
             graphicsScene.cubicR.writeToStream(outStream)
@@ -63,9 +63,10 @@ class graphicsToneForm(graphicsSplineForm):
         @type modifiers:
         """
         rImg = self.scene().targetImage.getActiveLayer()
-        if rImg.parentImage.useThumb:
-            x, y = x//2, y//2
-        color = rImg.linearImg.pixelColor(x, y)
+        # linearImg has the size of the development proxy (cf. rawProcessing.rawProxy())
+        linearImg, img = rImg.linearImg, rImg.parentImage
+        x, y = x * linearImg.width() // img.width(), y * linearImg.height() // img.height()
+        color = linearImg.pixelColor(x, y)
         r, g, b = color.red(), color.green(), color.blue()
         h, s, v = cv2.cvtColor((np.array([r,g,b])/255).astype(np.float32)[np.newaxis, np.newaxis,:], cv2.COLOR_RGB2HSV)[0,0,:]
         self.inputMarker.setPos(v*self.scene().axeSize, 0.0)
@@ -187,7 +188,6 @@ class rawForm (baseForm):
         self.asShotTemp, self.asShotTint = multipliers2TemperatureAndTint(*1 / np.array(self.asShotMultipliers[:3]), self.XYZ2CameraMatrix)
         self.rawMultipliers = self.asShotMultipliers #rawpyObj.camera_whitebalance # = 1/(dng ASSHOTNEUTRAL tag value)
         self.sampleMultipliers = False
-        self.samples = []
         ########################################
         # XYZ-->Camera conversion matrix:
         # Last row is zero for RGB cameras (cf. rawpy and libraw docs).
@@ -589,7 +589,7 @@ Valid values are 0 to 3 (0=clip;1=unclip;2=blend;3=rebuild); (with Auto Exposed
             form.baseCurve = [QPointF(x*axeSize, -y*axeSize) for x,y in zip(toneCurve.dataX, toneCurve.dataY)]
             def f():
                 layer = self.layer
-                layer.bufCache_HSV_CV32 = None
+                # the tone curve stage is keyed by the curve : no invalidation needed
                 layer.applyToStack()
                 layer.parentImage.onImageChanged()
             form.scene().quadricB.curveChanged.sig.connect(f)
@@ -726,19 +726,12 @@ former.<br>
     def updateLayer(self, level):
         """
         data changed event handler.
+        Cached development stages are keyed by their parameters,
+        so rawPostProcess only recomputes the stages depending
+        on the modified parameters : level is informative only.
         @param level: 3: redo contrast and saturation, 2: previous + camera profile stuff, 1: all
         @type level: int
         """
-        if level == 1:
-            # force all
-            self.layer.bufCache_HSV_CV32 = None
-            self.layer.postProcessCache = None
-        elif level == 2:
-            # force camera profile stuff
-            self.layer.bufCache_HSV_CV32 = None
-        elif level == 3:
-            # keep the 2 cache buffers
-            pass
         # contrast curve
         cf = getattr(self, 'dockC', None)
         if cf is not None:
@@ -186,8 +186,8 @@ color space to adjust <b>temperature</b> and <b>tint</b>.
         data changed event handler.
         """
         self.enableSliders()
-        self.layer.applyToStack()
-        self.layer.parentImage.onImageChanged()
+        # background render, onImageChanged() is called when done
+        self.layer.applyToStackAsync()
 
     def slider2Temp(self, v):
         return v * 100
@@ -154,7 +154,10 @@ class QLayerView(QTableView) :
         def m(state):  # state : Qt.Checked Qt.UnChecked
             if self.img is None:
                 return
+            self.img.waitForRender()
             self.img.useThumb = (state == Qt.Checked)
+            # back to the default thumbnail/full size modes
+            self.img.pyramidLevel = None
             window.updateStatus()
             self.img.cacheInvalidate()
             for layer in self.img.layersStack:
@@ -164,7 +167,7 @@ class QLayerView(QTableView) :
                 QApplication.setOverrideCursor(Qt.WaitCursor)  # TODO 18/04/18 waitcursor is called by applytostack?
                 QApplication.processEvents()
                 # update the whole stack
-                self.img.layersStack[0].applyToStack()
+                self.img.layersStack[0].applyToStack(dirty=False)
                 self.img.onImageChanged()  # TODO added 30/11/18 validate
 
             finally:
@@ -205,9 +208,10 @@ class QLayerView(QTableView) :
         # opacity slider released event handler
         def f2():
             try:
+                self.img.waitForRender()
                 layer = self.img.getActiveLayer()
                 layer.setOpacity(self.opacitySlider.value())
-                layer.applyToStack()
+                layer.applyToStack(dirty=False)
                 self.img.onImageChanged()
             except AttributeError:
                 return
@@ -240,6 +244,7 @@ class QLayerView(QTableView) :
         # mask slider released event handler
         def g2():
             try:
+                self.img.waitForRender()
                 layer = self.img.getActiveLayer()
                 layer.setColorMaskOpacity(self.maskSlider.value())
                 layer.applyToStack()
@@ -276,9 +281,10 @@ class QLayerView(QTableView) :
         def g(ind):
             s = self.blendingModeCombo.currentText()
             try:
+                self.img.waitForRender()
                 layer = self.img.getActiveLayer()
                 layer.compositionMode = self.compositionModeDict[str(s)]
-                layer.applyToStack()
+                layer.applyToStack(dirty=False)
                 self.img.onImageChanged()
             except AttributeError:
                 return
@@ -584,7 +590,7 @@ Note that upper visible layers slow down mask edition.<br>
         elif len(sel) == 1:
             self.img.setActiveLayer(len(self.img.layersStack) - sel[0] -1)
         # update stack
-        self.img.layersStack[0].applyToStack()
+        self.img.layersStack[0].applyToStack(dirty=False)
         self.img.onImageChanged()
 
 
@@ -621,6 +627,7 @@ Note that upper visible layers slow down mask edition.<br>
             # background layer is always visible
             if row == len(self.img.layersStack) - 1:
                 return
+            self.img.waitForRender()
             #layer.visible = not(layer.visible)
             layer.setVisible(not(layer.visible))
             if self.currentWin is not None:
@@ -631,11 +638,11 @@ Note that upper visible layers slow down mask edition.<br>
                 layer.tool.setVisible(layer.visible)
             # update stack
             if layer.visible:
-                layer.applyToStack()
+                layer.applyToStack(dirty=False)
             else:
                 i = layer.getUpperVisibleStackIndex()
                 if i >=0:
-                    layer.parentImage.layersStack[i].applyToStack()
+                    layer.parentImage.layersStack[i].applyToStack(dirty=False)
                 else:
                     # top layer : update only the presentation layer
                     layer.parentImage.prLayer.execute(l=None, pool=None)
@@ -928,6 +935,11 @@ Note that upper visible layers slow down mask edition.<br>
             if hasattr(view, 'reset'):
                 view.reset()
 
+        # handlers read and modify the stack : background renders
+        # must be completed first. Slots are called in connection order.
+        for action in self.cMenu.actions() + self.cMenu.subMenuEnable.actions():
+            if action is not self.actionDup:
+                action.triggered.connect(lambda checked=False: self.img.waitForRender())
         self.cMenu.actionRepositionLayer.triggered.connect(RepositionLayer)
         self.cMenu.actionUnselect.triggered.connect(unselectAll)
         self.cMenu.actionLoadImage.triggered.connect(loadImage)
@@ -18,11 +18,13 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import cv2
 import itertools
+from functools import partial
 
 import numpy as np
 import rawpy
 from PySide2.QtGui import QImage
 
+from bLUeCore.demosaicing import binBayer
 from bLUeCore.multi import interpMulti
 from bLUeGui.bLUeImage import QImageBuffer, bImage
 from bLUeGui.colorCIE import rgbLinear2rgbVec, sRGB_lin2XYZ, sRGB_lin2XYZInverse, bradfordAdaptationMatrix, \
@@ -32,17 +34,200 @@ from bLUeGui.histogramWarping import warpHistogram
 from debug import tdec
 from dng import dngProfileLookTable, dngProfileToneCurve, dngProfileColorMatrices, dngProfileIlluminants, \
     interpolatedColorMatrix, interpolatedForwardMatrix
-from settings import USE_TETRA
+from settings import USE_TETRA, POOL_SIZE
+from utils import isGUIThread
+
+def autoMultipliers(buf):
+    """
+    Gray world white balance : returns the multipliers
+    equalizing the channel means of the non saturated pixels.
+    @param buf: linear demosaiced image, raw color space
+    @type buf: ndarray, dtype=np.uint16
+    @return: multipliers (R, G, B), normalized (G = 1)
+    @rtype: 3-uple of float
+    """
+    sample = buf[::8, ::8].reshape(-1, 3)
+    sample = sample[sample.max(axis=-1) < 65000]
+    if len(sample) == 0:
+        return 1.0, 1.0, 1.0
+    r, g, b = sample.mean(axis=0)
+    return float(g / max(r, 1)), 1.0, float(g / max(b, 1))
+
+def autoBrightness(buf):
+    """
+    Returns the exposure correction mapping
+    the 99th percentile of the brightest channel to white
+    (cf. libraw auto bright).
+    @param buf: linear image, range 0..1
+    @type buf: ndarray
+    @return:
+    @rtype: float
+    """
+    p = np.percentile(buf[::8, ::8].max(axis=-1), 99)
+    return 1.0 / p if p > 0 else 1.0
+
+def compressHighlights(buf, scale, preserve):
+    """
+    In place exposure correction of a linear image : values
+    are multiplied by scale and clipped to 1. If scale > 1, values above
+    the knee 1 - preserve / 2 are compressed by an exponential
+    shoulder instead of clipped (cf. libraw exp_preserve_highlights).
+    @param buf: linear image, range 0..1
+    @type buf: ndarray, dtype=np.float32
+    @param scale: exposure correction
+    @type scale: float
+    @param preserve: highlight preservation, range 0..1
+    @type preserve: float
+    """
+    buf *= scale
+    knee = 1.0 - preserve / 2
+    if scale > 1:
+        mask = buf > knee
+        buf[mask] = knee + (1 - knee) * (1 - np.exp((knee - buf[mask]) / (1 - knee)))
+    np.clip(buf, 0, 1, out=buf)
+
+def camera2sRGBMatrix(XYZ2CameraMatrix):
+    """
+    Returns the matrix converting white balanced camera values
+    to linear sRGB (cf. dcraw cam_xyz_coeff) : camera white (1, 1, 1)
+    is mapped to sRGB white.
+    @param XYZ2CameraMatrix:
+    @type XYZ2CameraMatrix: ndarray, shape (3, 3)
+    @return:
+    @rtype: ndarray, shape (3, 3)
+    """
+    sRGB2Camera = XYZ2CameraMatrix @ np.array(sRGB_lin2XYZ)
+    sRGB2Camera /= np.sum(sRGB2Camera, axis=1)[:, np.newaxis]
+    return np.linalg.inv(sRGB2Camera)
+
+def developLinear(buf, multipliers, exposure, preserve, matrix, autoBright=False):
+    """
+    White balance, exposure correction and conversion
+    to linear RGB of a linear demosaiced image.
+    @param buf: linear demosaiced image, raw color space
+    @type buf: ndarray, dtype=np.uint16
+    @param multipliers: white balance multipliers (R, G, B)
+    @type multipliers: 3-uple of float
+    @param exposure: exposure correction
+    @type exposure: float
+    @param preserve: highlight preservation, range 0..1
+    @type preserve: float
+    @param matrix: raw to linear RGB matrix
+    @type matrix: ndarray, shape (3, 3)
+    @param autoBright: multiply the exposure correction by autoBrightness()
+    @type autoBright: boolean
+    @return: linear RGB image, range 0..1
+    @rtype: ndarray, dtype=np.float32
+    """
+    bufLinear = buf * (np.array(multipliers, dtype=np.float32) / 65535)
+    if autoBright:
+        exposure *= autoBrightness(bufLinear)
+    compressHighlights(bufLinear, exposure, preserve)
+    bufRGB = np.tensordot(bufLinear, np.asarray(matrix, dtype=np.float32), axes=(-1, -1))
+    M = np.max(bufRGB)
+    if M > 0:
+        bufRGB /= M
+    np.clip(bufRGB, 0, 1, out=bufRGB)
+    return bufRGB
+
+def developSample(buf, exposure, preserve, matrix, autoBright, sample):
+    """
+    Develops a sample of the white balance grid (cf. sampleGrid()).
+    @param sample: sample index, multipliers (R, G, B)
+    @type sample: 2-uple
+    @return: sample index, sRGB image
+    @rtype: 2-uple
+    """
+    i, multipliers = sample
+    bufRGB = developLinear(buf, multipliers, exposure, preserve, matrix, autoBright=autoBright)
+    return i, rgbLinear2rgbVec(bufRGB).astype(np.uint8)
+
+def sampleGrid(rawLayer, buf, samples, exposure, preserve, matrix, autoBright=False, pool=None):
+    """
+    Develops a 3x3 grid of thumbnails of a linear demosaiced image, one for
+    each set of multipliers in samples, and writes it to the current image of rawLayer.
+    Thumbnails are developed concurrently by the workers of pool (if any) and
+    each one is written to the layer as soon as it is done.
+    @param rawLayer: development layer
+    @type rawLayer: QRawLayer
+    @param buf: linear demosaiced image, raw color space
+    @type buf: ndarray, dtype=np.uint16
+    @param samples: 9 multipliers (R, G, B)
+    @type samples: list
+    @param exposure: exposure correction
+    @type exposure: float
+    @param preserve: highlight preservation, range 0..1
+    @type preserve: float
+    @param matrix: raw to linear RGB matrix
+    @type matrix: ndarray, shape (3, 3)
+    @param autoBright:
+    @type autoBright: boolean
+    @param pool: multi processing pool
+    @type pool: multiprocessing.pool
+    """
+    currentImage = rawLayer.getCurrentImage()
+    w, h = currentImage.width() // 3, currentImage.height() // 3
+    thumb = cv2.resize(buf, (w, h), interpolation=cv2.INTER_AREA)
+    bufOut = QImageBuffer(currentImage)
+    bufOut[:, :, :3] = 0
+    develop = partial(developSample, thumb, exposure, preserve, matrix, autoBright)
+    tiles = map(develop, enumerate(samples)) if pool is None else pool.imap_unordered(develop, enumerate(samples))
+    for i, tile in tiles:
+        row, col = i // 3, i % 3
+        bufOut[row * h:(row + 1) * h, col * w:(col + 1) * w, :3][:, :, ::-1] = tile
+        rawLayer.updatePixmap()
+
+def rawProxy(rawLayer):
+    """
+    Returns the resolution of the development of a raw layer, according
+    to the pyramid level of the rendered image : 'full' for export and 1:1 zoom,
+    'half' (libraw half size demosaic) for level 1 and 'quarter' (binned
+    sensor data, cf. binnedProxy()) for coarser levels.
+    @param rawLayer: development layer
+    @type rawLayer: QRawLayer
+    @return:
+    @rtype: str
+    """
+    if not rawLayer.thumbMode():
+        return 'full'
+    img = rawLayer.parentImage
+    level = img.pyramidLevel if img.pyramidLevel is not None else img.defaultThumbLevel()
+    return 'half' if level <= 1 else 'quarter'
+
+def binnedProxy(rawImage):
+    """
+    Returns a quarter size linear image in raw color space, binned from
+    the sensor data of rawImage (cf. bLUeCore.demosaicing.binBayer()) and
+    oriented as libraw postprocess output, or None if the sensor is not a Bayer sensor.
+    @param rawImage: unpacked raw image
+    @type rawImage: rawpy.RawPy
+    @return:
+    @rtype: ndarray, dtype=np.uint16, or None
+    """
+    buf = binBayer(rawImage.raw_image_visible, rawImage.raw_colors_visible, rawImage.black_level_per_channel,
+                   rawImage.white_level)
+    if buf is None:
+        return None
+    # libraw flip values
+    k = {3: 2, 5: 1, 6: -1}.get(rawImage.sizes.flip, 0)
+    return np.ascontiguousarray(np.rot90(buf, k=k))
 
 def rawPostProcess(rawLayer, pool=None):
     """
     raw layer development.
     Processing order is the following:
-         1 - postprocessing
-         2 - profile look table
-         3 - profile and user tone curve
-         2 - contrast correction
-         3 - saturation correction
+         1 - postprocessing (demosaic, unity multipliers)
+         2 - white balance, exposure and raw to sRGB matrix
+         3 - profile look table
+         4 - profile and user tone curve
+         5 - contrast correction
+         6 - saturation correction
+    The outputs of stages 1 to 4 are cached by the layer (cf. QRawLayer.getStage()),
+    keyed by a hash of the parameters each stage depends on, and of
+    the key of the previous stage. Only stages whose key changed are recomputed.
+    Previews are developed from half or quarter size proxies (cf. rawProxy()), which
+    are cached separately from the full size development : switching between preview
+    and full size reuses the cached stages.
     A pool of workers is used to apply the
     profile look table.
     An Exception AttributeError is raised if rawImage
@@ -52,21 +237,20 @@ def rawPostProcess(rawLayer, pool=None):
     @param pool: multi processing pool
     @type pool: multiprocessing.pool
     """
-    # postprocess output bits per channel
-    output_bpc = 8
-    max_ouput = 255 if output_bpc == 8 else 65535
     if rawLayer.parentImage.isHald:
         raise ValueError('Cannot build a 3D LUT from raw stack')
 
-    # get adjustment form and rawImage
-    adjustForm = rawLayer.getGraphicsForm()  # self.view.widget()
-    options = adjustForm.options
+    # show the Tone Curve form. Widgets are used from the GUI thread
+    # only : background renders read a snapshot of the form values.
+    toneCurveShowFirst = False
+    if isGUIThread():
+        form = rawLayer.getGraphicsForm()
+        if form.options['cpToneCurve']:
+            toneCurveShowFirst = form.showToneSpline()
 
-    # show the Tone Curve form
-    if options['cpToneCurve']:
-        toneCurveShowFirst = adjustForm.showToneSpline()
-    else:
-        toneCurveShowFirst = False
+    # get adjustment form values (cf. QLayer.getFormValues()) and rawImage
+    adjustForm = rawLayer.getFormValues()
+    options = adjustForm.options
 
     # get RawPy instance
     rawImage = getattr(rawLayer.parentImage, 'rawImage', None)
@@ -74,19 +258,9 @@ def rawPostProcess(rawLayer, pool=None):
         raise ValueError("rawPostProcessing : not a raw image")
     currentImage = rawLayer.getCurrentImage()
 
-    ##################
-    # Control flags
-    # postProcessCache is invalidated (reset to None) to by graphicsRaw.updateLayer (graphicsRaw.dataChanged event handler).
-    # bufCache_HSV_CV32 is invalidated (reset to None) by camera profile related events.
-    doALL = rawLayer.postProcessCache is None
-    if not doALL:
-        parentImage = rawLayer.parentImage
-        if (rawLayer.half and not parentImage.useThumb) or (not rawLayer.half and parentImage.useThumb):
-            rawLayer.postProcessCache, rawLayer.bufCache_HSV_CV32 = (None,) * 2
-            doALL = True
-    doCameraLookTable = options['cpLookTable'] and (doALL or rawLayer.bufCache_HSV_CV32 is None)
-    half_size = rawLayer.parentImage.useThumb
-    #################
+    # development resolution
+    proxy = rawProxy(rawLayer)
+    rawLayer.proxy = proxy
 
     ######################################################################################################################
     # process raw image (16 bits mode)                        camera ------diag(multipliers)----> camera
@@ -103,85 +277,74 @@ def rawPostProcess(rawLayer, pool=None):
     use_auto_wb = options['Auto WB']
     use_camera_wb = options['Camera WB']
     exp_preserve_highlights = 0.99 if options['Preserve Highlights'] else 0.2  # 0.6  # range 0.0..1.0 (1.0 = full preservation)
-    if doALL:
-        ##############################
-        # get postprocessing parameters
-        ##############################
-        # no_auto_scale = False  don't use : green shift
-        gamma = (2.222, 4.5)  # default REC BT 709 (exponent, slope)
-        #gamma = (2.4, 12.92)  # sRGB (exponent, slope) cf. https://en.wikipedia.org/wiki/SRGB#The_sRGB_transfer_function_("gamma")
-        exp_shift = adjustForm.expCorrection if not options['Auto Brightness'] else 0
-        no_auto_bright = (not options['Auto Brightness'])
-
-
-        bright = adjustForm.brCorrection  # default 1, should be > 0
-        hv = adjustForm.overexpValue
-        highlightmode = rawpy.HighlightMode.Clip if hv == 0 \
-            else rawpy.HighlightMode.Ignore if hv == 1 \
-            else rawpy.HighlightMode.Blend if hv == 2 \
-            else rawpy.HighlightMode.ReconstructDefault
-        dv = adjustForm.denoiseValue
-        fbdd_noise_reduction = rawpy.FBDDNoiseReductionMode.Off if dv == 0 \
-            else rawpy.FBDDNoiseReductionMode.Light if dv == 1 \
-            else rawpy.FBDDNoiseReductionMode.Full
-        #############################################
-        # build sample images for a set of multipliers
-        if adjustForm.sampleMultipliers:
-            bufpost16 = np.empty((rawLayer.height(), rawLayer.width(), 3), dtype=np.uint16)
-            m = adjustForm.rawMultipliers
-            co = np.array([0.85, 1.0, 1.2])
-            mults = itertools.product(m[0] * co, [m[1]], m[2] * co)
-            adjustForm.samples = []
-            for i, mult in enumerate(mults):
-                adjustForm.samples.append(mult)
-                mult = (mult[0], mult[1], mult[2], mult[1])
-                print(mult, '   ', m)
-                bufpost_temp = rawImage.postprocess(
-                    half_size=half_size,
-                    output_color=rawpy.ColorSpace.sRGB,
-                    output_bps=output_bpc,
-                    exp_shift=exp_shift,
-                    no_auto_bright=no_auto_bright,
-                    use_auto_wb=use_auto_wb,
-                    use_camera_wb=False,  # options['Camera WB'],
-                    user_wb=mult,
-                    gamma=gamma,
-                    exp_preserve_highlights=exp_preserve_highlights,
-                    bright=bright,
-                    hightlightmode=highlightmode,
-                    fbdd_noise_reduction=rawpy.FBDDNoiseReductionMode.Off
-                )
-                row = i // 3
-                col = i % 3
-                w, h = int(bufpost_temp.shape[1] / 3), int(bufpost_temp.shape[0] / 3)
-                bufpost_temp = cv2.resize(bufpost_temp, (w, h))
-                bufpost16[row * h:(row + 1) * h, col * w:(col + 1) * w, :] = bufpost_temp
-        # develop
-        else:
+    ##############################
+    # get postprocessing parameters
+    ##############################
+    exp_shift = adjustForm.expCorrection if not options['Auto Brightness'] else 0
+    no_auto_bright = (not options['Auto Brightness'])
+
+
+    bright = adjustForm.brCorrection  # default 1, should be > 0
+    # linear exposure correction
+    exposure = bright * (exp_shift if no_auto_bright else 1.0)
+    hv = adjustForm.overexpValue
+    highlightmode = rawpy.HighlightMode.Clip if hv == 0 \
+        else rawpy.HighlightMode.Ignore if hv == 1 \
+        else rawpy.HighlightMode.Blend if hv == 2 \
+        else rawpy.HighlightMode.ReconstructDefault
+    dv = adjustForm.denoiseValue
+    fbdd_noise_reduction = rawpy.FBDDNoiseReductionMode.Off if dv == 0 \
+        else rawpy.FBDDNoiseReductionMode.Light if dv == 1 \
+        else rawpy.FBDDNoiseReductionMode.Full
+    ##############################
+    # develop (stage 1). The image is demosaiced
+    # once, with unity multipliers, to a linear 16 bits
+    # buffer in raw color space : it depends neither
+    # on white balance nor on exposure.
+    # Quarter size proxies are binned from the
+    # sensor data, without demosaicing.
+    ##############################
+    demosaicKey = hash((proxy,)) if proxy == 'quarter' else hash((proxy, hv, dv))
+    bufpost16 = rawLayer.getStage('demosaic', demosaicKey, proxy=proxy)
+    if bufpost16 is None:
+        rawLayer.parentImage.unpackRaw()
+        if proxy == 'quarter':
+            bufpost16 = binnedProxy(rawImage)
+        # no Bayer sensor : fall back to a half size proxy
+        if bufpost16 is None:
             bufpost16 = rawImage.postprocess(
-                half_size = half_size,
+                half_size = proxy != 'full',
                 output_color=rawpy.ColorSpace.raw,#XYZ,#XYZ, #######################
-                output_bps=output_bpc,
-                exp_shift=exp_shift,
-                no_auto_bright=no_auto_bright,
-                use_auto_wb=use_auto_wb,
-                use_camera_wb=use_camera_wb,
-                user_wb=adjustForm.rawMultipliers,
+                output_bps=16,
+                no_auto_bright=True,
+                use_auto_wb=False,
+                use_camera_wb=False,
+                user_wb=[1.0, 1.0, 1.0, 1.0],
                 gamma=(1, 1),
-                exp_preserve_highlights=exp_preserve_highlights,
-                bright=bright,
                 highlight_mode=highlightmode,
                 fbdd_noise_reduction=fbdd_noise_reduction,
                 median_filter_passes=1
             )
-            # save image into post processing cache
-            rawLayer.postProcessCache = cv2.cvtColor(((bufpost16.astype(np.float32)) / max_ouput).astype(np.float32), cv2.COLOR_RGB2HSV)
-            rawLayer.half = half_size
-            rawLayer.bufpost16 = bufpost16
-    else:
-        pass
+        rawLayer.setStage('demosaic', demosaicKey, bufpost16, proxy=proxy)
+
+    #############################################
+    # build sample images for a set of multipliers.
+    # The 3x3 grid of samples replaces the layer image.
+    #############################################
+    if adjustForm.sampleMultipliers:
+        m = adjustForm.rawMultipliers
+        co = np.array([0.85, 1.0, 1.2])
+        rawLayer.samples = list(itertools.product(m[0] * co, [m[1]], m[2] * co))
+        sampleGrid(rawLayer, bufpost16, rawLayer.samples, exposure, exp_preserve_highlights,
+                   camera2sRGBMatrix(adjustForm.XYZ2CameraMatrix), autoBright=not no_auto_bright, pool=pool)
+        return
 
-    # postProcessCache is in raw color space.
+    ##############################
+    # white balance, exposure and color matrix (stage 2).
+    # Multipliers, exposure and highlight compression
+    # are applied to the linear buffer, as libraw does
+    # before demosaicing.
+    # The demosaiced image is in raw color space
     # and must be converted to linear RGB. We follow
     # the guidelines of Adobe dng spec. (chapter 6).
     # If we have a valid dng profile and valid ForwardMatrix1
@@ -189,80 +352,103 @@ def rawPostProcess(rawLayer, pool=None):
     # ForwardMatrix for T and next from XYZ_D50 to RGB.
     # If we have no valid dng profile, we reinit the multipliers and
     # apply a Bradford chromatic adaptation matrix.
-    m1,m2,m3 = adjustForm.asShotMultipliers[:3] if use_camera_wb else adjustForm.rawMultipliers[:3]
-    D = np.diag((1/m1,1/m2,1/m3))
+    # The camera profile (dngDict) is not part of the keys :
+    # changing it invalidates stages 2 to 4 (cf. graphicsRaw.cameraProfileUpdate).
+    ##############################
+    if use_auto_wb:
+        m1, m2, m3 = autoMultipliers(bufpost16)
+    else:
+        m1,m2,m3 = adjustForm.asShotMultipliers[:3] if use_camera_wb else adjustForm.rawMultipliers[:3]
     tempCorrection = adjustForm.asShotTemp if use_camera_wb else adjustForm.tempCorrection
-    MM = bradfordAdaptationMatrix(6500, tempCorrection)
-    MM1 = bradfordAdaptationMatrix(6500, 5000)
-    FM = None
     myHighlightPreservation = 0.8 if exp_preserve_highlights > 0.9 else 1.0
-    if adjustForm.dngDict:
-        try:
-            FM = interpolatedForwardMatrix(adjustForm.tempCorrection, adjustForm.dngDict)
-        except:
-            pass
-    raw2sRGBMatrix = sRGB_lin2XYZInverse @ MM1 @ FM * myHighlightPreservation if FM is not None else\
-                     sRGB_lin2XYZInverse @ MM @ adjustForm.XYZ2CameraInverseMatrix @ D
-    bufpost16 = np.tensordot(rawLayer.bufpost16, raw2sRGBMatrix, axes=(-1, -1))
-    M = np.max(bufpost16) / 255.0
-    bufpost16 = bufpost16 / M
-    np.clip(bufpost16, 0, 255, out=bufpost16)
-    rawLayer.postProcessCache = cv2.cvtColor(((bufpost16.astype(np.float32)) / max_ouput).astype(np.float32), cv2.COLOR_RGB2HSV)
+    matrixKey = hash((demosaicKey, m1, m2, m3, exp_shift, no_auto_bright, bright, exp_preserve_highlights,
+                      tempCorrection, adjustForm.tempCorrection, myHighlightPreservation))
+    bufHSV_CV32 = rawLayer.getStage('matrix', matrixKey, proxy=proxy)
+    if bufHSV_CV32 is None:
+        D = np.diag((1/m1,1/m2,1/m3))
+        MM = bradfordAdaptationMatrix(6500, tempCorrection)
+        MM1 = bradfordAdaptationMatrix(6500, 5000)
+        FM = None
+        if adjustForm.dngDict:
+            try:
+                FM = interpolatedForwardMatrix(adjustForm.tempCorrection, adjustForm.dngDict)
+            except:
+                pass
+        raw2sRGBMatrix = sRGB_lin2XYZInverse @ MM1 @ FM * myHighlightPreservation if FM is not None else\
+                         sRGB_lin2XYZInverse @ MM @ adjustForm.XYZ2CameraInverseMatrix @ D
+        bufpostF32 = developLinear(bufpost16, (m1, m2, m3), exposure, exp_preserve_highlights, raw2sRGBMatrix,
+                                   autoBright=not no_auto_bright)
+        bufHSV_CV32 = cv2.cvtColor(bufpostF32, cv2.COLOR_RGB2HSV)
+        rawLayer.setStage('matrix', matrixKey, bufHSV_CV32, proxy=proxy)
 
     # update histogram
-    s = rawLayer.postProcessCache.shape
-    tmp = bImage(s[1], s[0], QImage.Format_RGB32)
-    buf = QImageBuffer(tmp)
-    buf[:, :, :] = (rawLayer.postProcessCache[:, :, 2, np.newaxis] * 255).astype(np.uint8)
-    rawLayer.linearImg = tmp
-
-    if getattr(adjustForm, "toneForm", None) is not None:
-        rawLayer.histImg = tmp.histogram(size=adjustForm.toneForm.scene().axeSize,
-                                         bgColor=adjustForm.toneForm.scene().bgColor,
-                                         range=(0, 255), chans=channelValues.Br)  # mode='Luminosity')
-        adjustForm.toneForm.scene().quadricB.histImg = rawLayer.histImg
-        adjustForm.toneForm.scene().update()
-
-    # beginning of the camera profile phase : update buffers from the last post processed image
-    bufHSV_CV32 = rawLayer.postProcessCache.copy()
-    rawLayer.bufCache_HSV_CV32 = bufHSV_CV32.copy()
+    if rawLayer.linearImg is None or toneCurveShowFirst or rawLayer.linearKey != matrixKey:
+        s = bufHSV_CV32.shape
+        tmp = bImage(s[1], s[0], QImage.Format_RGB32)
+        buf = QImageBuffer(tmp)
+        buf[:, :, :] = (bufHSV_CV32[:, :, 2, np.newaxis] * 255).astype(np.uint8)
+        rawLayer.linearImg, rawLayer.linearKey = tmp, matrixKey
+
+        toneForm = rawLayer.getGraphicsForm().toneForm if isGUIThread() else None
+        if toneForm is not None:
+            rawLayer.histImg = tmp.histogram(size=toneForm.scene().axeSize,
+                                             bgColor=toneForm.scene().bgColor,
+                                             range=(0, 255), chans=channelValues.Br)  # mode='Luminosity')
+            toneForm.scene().quadricB.histImg = rawLayer.histImg
+            toneForm.scene().update()
+        elif not isGUIThread():
+            # the histogram of the tone curve form is updated by the next render in the GUI thread
+            rawLayer.linearKey = None
 
     ##########################
-    # Profile look table
+    # Profile look table (stage 3)
     # it must be applied to the linear buffer and
     # before tone curve (cf. Adobe dng spec. p. 65)
     ##########################
-    if doCameraLookTable:
-        hsvLUT = dngProfileLookTable(adjustForm.dngDict)
-        if hsvLUT.isValid:
-            divs = hsvLUT.divs
-            steps = tuple([360 / divs[0], 1.0 / divs[1], 1.0 / divs[2]])
-            coeffs = interpMulti(hsvLUT.data, steps, bufHSV_CV32, pool=pool, use_tetra=USE_TETRA, convert=False)
-            #coeffs = interpTriLinear(hsvLUT.data, steps, bufHSV_CV32, convert=False)  # TODO 13/11/18 don't forget to switch to interpmulti
-            bufHSV_CV32[:, :, 0] = np.mod(bufHSV_CV32[:, :, 0] + coeffs[:, :, 0], 360)
-            bufHSV_CV32[:, :, 1:] = bufHSV_CV32[:, :, 1:] * coeffs[:, :, 1:]
-            np.clip(bufHSV_CV32, (0, 0, 0), (360, 1, 1), out=bufHSV_CV32)
-            rawLayer.bufCache_HSV_CV32 = bufHSV_CV32.copy()
-    else:
-        pass
+    lookKey = hash((matrixKey, options['cpLookTable']))
+    bufLook = rawLayer.getStage('lookTable', lookKey, proxy=proxy)
+    if bufLook is None:
+        bufLook = bufHSV_CV32
+        if options['cpLookTable']:
+            hsvLUT = dngProfileLookTable(adjustForm.dngDict)
+            if hsvLUT.isValid:
+                divs = hsvLUT.divs
+                steps = tuple([360 / divs[0], 1.0 / divs[1], 1.0 / divs[2]])
+                coeffs = interpMulti(hsvLUT.data, steps, bufHSV_CV32, pool=pool, poolSize=POOL_SIZE, use_tetra=USE_TETRA,
+                                     convert=False)
+                #coeffs = interpTriLinear(hsvLUT.data, steps, bufHSV_CV32, convert=False)  # TODO 13/11/18 don't forget to switch to interpmulti
+                bufLook = np.empty_like(bufHSV_CV32)
+                bufLook[:, :, 0] = np.mod(bufHSV_CV32[:, :, 0] + coeffs[:, :, 0], 360)
+                bufLook[:, :, 1:] = bufHSV_CV32[:, :, 1:] * coeffs[:, :, 1:]
+                np.clip(bufLook, (0, 0, 0), (360, 1, 1), out=bufLook)
+        rawLayer.setStage('lookTable', lookKey, bufLook, proxy=proxy)
     #############
-    # tone curve
+    # tone curve (stage 4)
     ############
     buf = adjustForm.dngDict.get('ProfileToneCurve', [])
-    # apply profile tone curve, if any
-    if buf : # non empty list
-        LUTXY = dngProfileToneCurve(buf).toLUTXY(maxrange=255)
-        bufHSV_CV32[:, :, 2] = LUTXY[(bufHSV_CV32[:, :, 2] * 255).astype(np.uint16)] / 255.0
-    # apply user tone curve
-    toneForm = adjustForm.toneForm
-    if toneForm is not None:
-        if toneForm.isVisible():
-            userLUTXY = toneForm.scene().quadricB.LUTXY
-            bufHSV_CV32[:, :, 2] = userLUTXY[(bufHSV_CV32[:, :, 2] * 255).astype(np.uint16)] / 255
-    rawLayer.bufCache_HSV_CV32 = bufHSV_CV32.copy() # CAUTION : must be outside of if toneForm.
-
-    # beginning of the contrast-saturation phase : update buffer from the last camera profile applcation
-    bufHSV_CV32 = rawLayer.bufCache_HSV_CV32.copy()
+    userLUTXY = adjustForm.userLUTXY
+    toneKey = hash((lookKey, str(buf), None if userLUTXY is None else userLUTXY.tobytes()))
+    bufTone = rawLayer.getStage('toneCurve', toneKey, proxy=proxy)
+    if bufTone is None:
+        bufTone = bufLook
+        # apply profile tone curve, if any
+        if buf : # non empty list
+            LUTXY = dngProfileToneCurve(buf).toLUTXY(maxrange=255)
+            bufTone = bufTone.copy()
+            bufTone[:, :, 2] = LUTXY[(bufTone[:, :, 2] * 255).astype(np.uint16)] / 255.0
+        # apply user tone curve
+        if userLUTXY is not None:
+            if bufTone is bufLook:
+                bufTone = bufTone.copy()
+            bufTone[:, :, 2] = userLUTXY[(bufTone[:, :, 2] * 255).astype(np.uint16)] / 255
+        rawLayer.setStage('toneCurve', toneKey, bufTone, proxy=proxy)
+
+    # beginning of the contrast-saturation phase. Cached buffers
+    # are shared between stages and must not be modified in place.
+    if adjustForm.contCorrection > 0 or adjustForm.satCorrection != 0:
+        bufHSV_CV32 = bufTone.copy()
+    else:
+        bufHSV_CV32 = bufTone
     ###########
     # contrast and saturation correction (V channel).
     # We apply an automatic histogram equalization
@@ -278,7 +464,7 @@ def rawPostProcess(rawLayer, pool=None):
                                                          preserveHigh=options['Preserve Highlights'],
                                                          spline=None if rawLayer.autoSpline else rawLayer.getMmcSpline())  # preserveHigh=options['Preserve Highlights'])
         # show the spline
-        if rawLayer.autoSpline and options['manualCurve']:
+        if rawLayer.autoSpline and options['manualCurve'] and isGUIThread():
             rawLayer.getGraphicsForm().setContrastSpline(a, b, d, T)
             rawLayer.autoSpline = False  # mmcSpline = self.getGraphicsForm().scene().cubicItem # caution : misleading name for a quadratic s
     if adjustForm.satCorrection != 0:
@@ -288,9 +474,8 @@ def rawPostProcess(rawLayer, pool=None):
         LUT = np.power(np.arange(256) / 255, alpha)
         # convert saturation s to s**alpha
         bufHSV_CV32[:, :, 1] = LUT[(bufHSV_CV32[:, :, 1] * 255).astype(int)]
-    """proof of program assert : {postProcessCache contains the current post-processed image 
+    """proof of program assert : {the stage cache contains the current outputs of stages 1 to 4
                                      and bufHSV_CV32 contains the current HSV image
-                                     and bufCache_HSV_CV32 is a copy of bufHSV_CV32 after profile tone curve
                                      }"""
     # back to RGB
     bufpostF32_1 = cv2.cvtColor(bufHSV_CV32, cv2.COLOR_HSV2RGB) #* 65535 # .astype(np.uint16)  TODO 5/11/18 removed conversion removed * 65535validate
@@ -308,7 +493,7 @@ def rawPostProcess(rawLayer, pool=None):
     ###################################################
     #bufpostUI8 = (bufpost16/256).astype(np.uint8)
     #################################################
-    if rawLayer.parentImage.useThumb:
+    if bufpostUI8.shape[:2] != (currentImage.height(), currentImage.width()):
         bufpostUI8 = cv2.resize(bufpostUI8, (currentImage.width(), currentImage.height()))
 
     bufOut = QImageBuffer(currentImage)
@@ -0,0 +1,259 @@
+"""
+This File is part of bLUe software.
+
+Copyright (C) 2017  Bernard Virot <bernard.virot@libertysurf.fr>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as
+published by the Free Software Foundation, version 3.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Lesser Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+
+from PySide2 import QtCore
+from PySide2.QtCore import QObject
+
+from bLUeGui.dialog import dlgWarn
+from bLUeGui.memory import weakProxy
+
+
+class renderScheduler(QObject):
+    """
+    Background rendering of the layer stack of a mImage.
+    Requests are posted from the GUI thread (cf. QLayer.applyToStackAsync)
+    and rendered by a worker thread. A request posted while a render is in
+    progress cancels it (between two layers) and is merged with it : the stack
+    is re-rendered from the lowest modified layer, and the layers which are
+    already up to date are skipped (cf. QLayer.render). Thus, rapid slider
+    updates are coalesced and stale renders are never queued.
+    Renders are progressive : the stack is rendered at a coarse pyramid
+    level first, then refined up to the target level (cf. vImage.progressiveLevels()).
+    Levels are computed in the GUI thread, when the request is posted, and
+    the worker renders each of them as a parameter (cf. vImage.renderLevel()) :
+    the current pyramid level of the image is only changed in the GUI thread.
+    The worker never builds pixmaps : intermediate results are posted by the
+    signal progress, and, when the stack is up to date, the signal done is emitted.
+    Their slots build the pixmaps in the GUI thread (cf. QLayer.syncPixmap()), and
+    the thumbnails of the intermediate levels are parked in the tile store.
+    Exceptions raised by a render are posted by the signal failed.
+    GUI thread code reading or modifying the stack must call
+    mImage.waitForRender() first.
+    """
+    progress = QtCore.Signal(object)
+    done = QtCore.Signal(object)
+    failed = QtCore.Signal(str, str)
+
+    def __init__(self, img):
+        """
+        Must be called from the GUI thread.
+        @param img:
+        @type img: mImage
+        """
+        super().__init__()
+        self.img = weakProxy(img)
+        self.__lock = threading.Lock()
+        self.__cancel = threading.Event()
+        self.__idle = threading.Event()
+        self.__idle.set()
+        # pending request (layer, rect, levels)
+        self.__pending = None
+        self.__thread = None
+        # lowest stack index rendered since the last done signal
+        self.__lowest = None
+        # last completed level, as a 1-uple (None : no completed level)
+        self.__completed = None
+        # queued connections, as signals are emitted by the worker thread
+        self.progress.connect(self.onProgress)
+        self.done.connect(self.onDone)
+        self.failed.connect(self.onFailed)
+
+    def __merge(self, layer, rect, levels=None):
+        """
+        Merges a request with the pending one. The lock must be held.
+        If levels is None, the levels of the pending request are kept.
+        @param layer:
+        @type layer: QLayer
+        @param rect: changed region (full size coordinates), None for whole image
+        @type rect: QRect
+        @param levels: pyramid levels to render, from coarse to fine
+        @type levels: list
+        """
+        if self.__pending is not None:
+            pLayer, pRect, pLevels = self.__pending
+            if pLayer.getStackIndex() < layer.getStackIndex():
+                layer = pLayer
+            rect = None if (rect is None or pRect is None) else rect.united(pRect)
+            if levels is None:
+                levels = pLevels
+        self.__pending = (layer, rect, levels)
+
+    def request(self, layer, rect=None):
+        """
+        Posts a render request for the stack above layer (included).
+        The layer parameters version should already be updated.
+        @param layer:
+        @type layer: QLayer
+        @param rect: changed region (full size coordinates), None for whole image
+        @type rect: QRect
+        """
+        img = self.img
+        levels = img.progressiveLevels() or [img.pyramidLevel]
+        with self.__lock:
+            self.__merge(layer, rect, levels=levels)
+            # cancel the in-flight render, if any
+            self.__cancel.set()
+            if self.__thread is None:
+                self.__idle.clear()
+                self.__thread = threading.Thread(target=self.run, daemon=True)
+                self.__thread.start()
+
+    def wait(self):
+        """
+        Waits for the completion of all pending requests.
+        """
+        self.__idle.wait()
+
+    def isIdle(self):
+        return self.__idle.is_set()
+
+    def run(self):
+        """
+        Worker thread loop.
+        """
+        while True:
+            with self.__lock:
+                if self.__pending is None:
+                    self.__thread = None
+                    self.__idle.set()
+                    break
+                layer, rect, levels = self.__pending
+                self.__pending = None
+                self.__cancel.clear()
+                ind = layer.getStackIndex()
+                self.__lowest = ind if self.__lowest is None else min(ind, self.__lowest)
+            try:
+                if not self.renderLevels(layer, rect, levels):
+                    # cancelled : the new request must include the unfinished one.
+                    # Its levels, computed later, are kept.
+                    with self.__lock:
+                        self.__merge(layer, rect, levels=None if self.__pending is not None else levels)
+            except Exception as e:
+                self.failed.emit('Background render of %s failed' % layer.name, str(e))
+        self.done.emit(self.img.prLayer)
+
+    def renderLevels(self, layer, rect, levels):
+        """
+        Renders the stack above layer (included) and the presentation layer
+        at each progressive level, from coarse to fine.
+        Lower layers which are not up to date at some level (e.g. never rendered)
+        are rendered too.
+        @param layer:
+        @type layer: QLayer
+        @param rect: changed region (full size coordinates), None for whole image
+        @type rect: QRect
+        @param levels: pyramid levels, from coarse to fine
+        @type levels: list
+        @return: True if the render was completed, False if it was cancelled
+        @rtype: boolean
+        """
+        img = self.img
+        for i, level in enumerate(levels):
+            with img.renderLevel(level):
+                # viewport rendering
+                if img.useViewport and img.viewportRect is not None:
+                    if not img.renderViewport(layer, cancel=self.__cancel):
+                        return False
+                else:
+                    start, startRect = layer, rect
+                    mode = layer.renderMode()
+                    for l in img.layersStack[:layer.getStackIndex()]:
+                        if l.visible and not l.isUpToDate(mode):
+                            start, startRect = l, None
+                            break
+                    if not start.renderStack(rect=startRect, cancel=self.__cancel, updateForms=False):
+                        return False
+                    img.prLayer.execute(l=None, pool=None)
+            with self.__lock:
+                self.__completed = (level,)
+            if i < len(levels) - 1:
+                self.progress.emit(img.prLayer)
+        return True
+
+    def onProgress(self, prLayer):
+        """
+        progress signal slot (GUI thread) : shows an intermediate render.
+        The worker may be running : only the pixmaps of the presentation
+        layer, built from copied images, are updated.
+        @param prLayer: presentation layer
+        @type prLayer: QPresentationLayer
+        """
+        prLayer.syncPixmap()
+        self.img.onRenderProgress()
+
+    def onDone(self, prLayer):
+        """
+        done signal slot (GUI thread) : sets the current pyramid level of the image to
+        the last rendered level, builds the pixmaps of the rendered layers, and updates the
+        histograms displayed on their forms and the image views.
+        If a new render was started in the meantime, nothing is done : it will emit
+        its own done signal.
+        @param prLayer: presentation layer
+        @type prLayer: QPresentationLayer
+        """
+        if not self.isIdle():
+            return
+        img = self.img
+        with self.__lock:
+            lowest, self.__lowest = self.__lowest, None
+            completed, self.__completed = self.__completed, None
+        if completed is not None:
+            img.pyramidLevel = completed[0]
+        mode = img.layersStack[0].renderMode() if img.layersStack else None
+        for layer in img.layersStack:
+            # masked images built at another level are not synced
+            if layer.visible:
+                layer.refreshPixmap(mode)
+            layer.syncPixmap()
+        prLayer.syncPixmap()
+        if lowest is not None:
+            for layer in img.layersStack[lowest + 1:]:
+                grForm = layer.getGraphicsForm()
+                if grForm is not None:
+                    grForm.updateHists()
+        self.parkLevels()
+        img.setModified(True)
+        img.onImageChanged()
+
+    def onFailed(self, text, info):
+        """
+        failed signal slot (GUI thread) : reports a render failure.
+        @param text:
+        @type text: str
+        @param info: exception message
+        @type info: str
+        """
+        dlgWarn(text, info=info)
+
+    def parkLevels(self):
+        """
+        Parks the pyramid levels used by progressive
+        renders (cf. vImage.parkPyramidLevels()), except the current level,
+        and drops the corresponding thumbnail containers.
+        """
+        img = self.img
+        keep = (img.pyramidLevel,)
+        for layer in img.layersStack + [img.prLayer]:
+            layer.parkPyramidLevels(keep)
+            for level in [k for k in layer.thumbContainers if k not in keep]:
+                del layer.thumbContainers[level]
+            # pass-through outputs reference dropped containers : they must be rendered again
+            for mode in [m for m in layer.forwarded if m.startswith('level') and int(m[5:]) not in keep]:
+                del layer.forwarded[mode]
+                layer.renderFingerprints.pop(mode, None)
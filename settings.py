@@ -21,7 +21,8 @@ from json import load
 ########################
 # read configuration file
 ########################
-with open("config.json", "r") as fd:
+CONFIG_PATH = "config.json"
+with open(CONFIG_PATH, "r") as fd:
     CONFIG = load(fd)
 
 ############
@@ -46,14 +47,25 @@ DNG_PROFILES_DIR2 = CONFIG["DNG_PROFILES"]["DIR2"]
 #############
 # 3D LUT
 ############
-# use tetrahedral interpolation instead of trilinear; trilinear is faster
+# use tetrahedral interpolation instead of trilinear
 USE_TETRA = CONFIG["ENV"]["USE_TETRA"]  # False
+# use tetrahedral interpolation for full size images (preview mode off)
+USE_TETRA_FULLSIZE = CONFIG["ENV"]["USE_TETRA_FULLSIZE"]  # True
+# trilinear interpolation by row strips, writing directly to the output buffer
+USE_STRIPS = CONFIG["ENV"]["USE_STRIPS"]  # True
 
 ######################
 # parallel interpolation
 #######################
 USE_POOL = CONFIG["ENV"]["USE_POOL"] # True
 POOL_SIZE = CONFIG["ENV"]["POOL_SIZE"] # 4
+# use threads sharing image buffers instead of processes
+USE_THREADS = CONFIG["ENV"]["USE_THREADS"]  # True
+USE_VIEWPORT = CONFIG["ENV"]["USE_VIEWPORT"]  # False
+VIEWPORT_TILE_SIZE = CONFIG["ENV"]["VIEWPORT_TILE_SIZE"]  # 256
+TILE_STORE_BUDGET = CONFIG["ENV"]["TILE_STORE_BUDGET"]  # 512 (MB)
+TILE_STORE_SPILL = CONFIG["ENV"]["TILE_STORE_SPILL"]  # False
+FUSE_POINTWISE_LAYERS = CONFIG["ENV"]["FUSE_POINTWISE_LAYERS"]  # True
 
 ########
 # Theme
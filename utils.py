@@ -17,6 +17,7 @@ along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import ctypes
 import threading
+import weakref
 from os.path import isfile, basename
 from itertools import product
 
@@ -85,6 +86,15 @@ def inversion(m):
                     [m4 * m8 - m5 * m7, m2 * m7 - m1 * m8, m1 * m5 - m2 * m4]])
     return inv / multiply(inv[0], m[:, 0])
 
+def isGUIThread():
+    """
+    Returns True if the calling thread is the GUI (main) thread.
+    QPixmap objects and widgets must only be used from this thread.
+    @return:
+    @rtype: boolean
+    """
+    return threading.current_thread() is threading.main_thread()
+
 class UDict(object):
     """
     Union of dictionaries. The dictionaries are neither copied nor changed.
@@ -110,6 +120,45 @@ class UDict(object):
                 return self.__dictionaries[i][item]
         return None
 
+    def copy(self):
+        """
+        Returns the union of copies of the dictionaries.
+        @return:
+        @rtype: UDict
+        """
+        return UDict(tuple(dict(d) for d in self.__dictionaries))
+
+
+class formSnapshot(object):
+    """
+    Copy of the parameter values of a graphics form, taken in the GUI thread.
+    Widgets and graphics scenes must be read from the GUI thread only : background
+    renders read the snapshot instead of the form (cf. QLayer.getFormValues()).
+    Python values, numpy arrays, lists and dicts are copied (shallow copies), other
+    attributes (widgets...) are skipped. Options are copied to a dict or to a UDict.
+    Values read from the graphics scene of the form are recorded too :
+        - stackedLUTXY : LUT of the curves of a curve form (cf. activeSpline.getStackedLUTXY()),
+        - userLUTXY : LUT of the tone curve of a raw form, None if the curve is not shown.
+    """
+    def __init__(self, form):
+        for name, value in vars(form).items():
+            if type(value) in weakref.ProxyTypes:
+                continue
+            if isinstance(value, (bool, int, float, str, tuple, type(None))):
+                setattr(self, name, value)
+            elif isinstance(value, (np.ndarray, list, dict)):
+                setattr(self, name, value.copy())
+        options = getattr(form, 'options', None)
+        if isinstance(options, UDict):
+            self.options = options.copy()
+        scene = form.scene() if callable(getattr(form, 'scene', None)) else None
+        if getattr(scene, 'cubicItem', None) is not None:
+            self.stackedLUTXY = scene.cubicItem.getStackedLUTXY()
+        if hasattr(form, 'toneForm'):
+            toneForm = form.toneForm
+            self.userLUTXY = toneForm.scene().quadricB.LUTXY.copy() \
+                             if toneForm is not None and toneForm.isVisible() else None
+
 
 class QbLUeColorDialog(QColorDialog):
 
@@ -16,6 +16,10 @@ You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import threading
+import weakref
+from contextlib import contextmanager
+from itertools import count
 from os.path import isfile
 from time import time
 import numpy as np
@@ -32,28 +36,27 @@ from PySide2.QtCore import QRect
 
 from bLUeGui.bLUeImage import bImage, ndarrayToQImage
 from bLUeCore.tetrahedral import interpTetra
-from bLUeCore.trilinear import interpTriLinear
+from bLUeCore.trilinear import interpTriLinear, interpTriLinearStrips
 from bLUeCore.multi import interpMulti
+from bLUeCore.scheduler import isParallel
 
 from debug import tdec
 from graphicsBlendFilter import blendFilterIndex
 
-from graphicsFilter import filterIndex
-from bLUeGui.histogramWarping import warpHistogram
 from bLUeGui.bLUeImage import QImageBuffer
-from bLUeGui.colorCube import rgb2hspVec, hsp2rgbVec, hsv2rgbVec
+from bLUeGui.colorCube import rgb2hspVec
 from bLUeGui.graphicsSpline import channelValues
-from bLUeGui.blend import blendLuminosity
-from bLUeGui.colorCIE import sRGB2LabVec, Lab2sRGBVec, rgb2rgbLinearVec, \
-    rgbLinear2rgbVec, sRGB2XYZVec, sRGB_lin2XYZInverse, bbTemperature2RGB
-from bLUeGui.multiplier import temperatureAndTint2Multipliers
+from bLUeGui.colorCIE import sRGB2LabVec
 from bLUeGui.dialog import dlgWarn
-from bLUeCore.kernel import getKernel
-from lutUtils import LUT3DIdentity
+from lutUtils import LUT3DIdentity, LUT3D
 from rawProcessing import rawPostProcess
-from settings import USE_TETRA
-from utils import boundingRect, UDict, checkeredImage
-from bLUeCore.dwtDenoising import dwtDenoiseChan
+from settings import USE_TETRA, USE_TETRA_FULLSIZE, USE_STRIPS, TILE_STORE_BUDGET, TILE_STORE_SPILL, \
+    VIEWPORT_TILE_SIZE, POOL_SIZE
+from bLUeCore.tileStore import defaultStore
+from utils import boundingRect, UDict, checkeredImage, isGUIThread
+from adjustments import exposureParams, contrastParams, temperatureParams, lut1DParams, filterParams, \
+    noiseParams, exposure, contrast, temperature, rgbLUT, labLUT, hsvLUT, hspbLUT, filterMargin, filter2D, \
+    noiseMargin, denoise
 from bLUeCore.SavitskyGolay import SavitzkyGolayFilter
 
 class ColorSpace:
@@ -86,6 +89,35 @@ class vImage(bImage):
     ################
     thumbSize = 1500
 
+    ################
+    # image pyramid :
+    # the thumbnail of pyramid level k > 0 is the full size image reduced by 2**k,
+    # and level 0 is the full size image. The coarsest level
+    # has max(width, height) >= pyramidMinSize.
+    # Progressive renders (cf. renderScheduler) start progressiveSteps levels
+    # above their target level.
+    ################
+    pyramidMinSize = 128
+    progressiveSteps = 3
+    # pyramid levels of the renders running in the
+    # calling thread, by image id (cf. renderLevel())
+    __renderLevels = threading.local()
+
+    # owner ids of tile store entries (cf. getTileStore())
+    storeKeys = count()
+
+    @staticmethod
+    def getTileStore():
+        """
+        Returns the tile store shared by all images. It keeps
+        image buffers which are not currently displayed or used
+        as input (render caches, parked pyramid levels) within the memory
+        budget TILE_STORE_BUDGET (MB).
+        @return:
+        @rtype: tileStore
+        """
+        return defaultStore(budget=TILE_STORE_BUDGET * 2 ** 20, tileSize=VIEWPORT_TILE_SIZE, spill=TILE_STORE_SPILL)
+
     ###############
     # default base color, painted as background color and to display transparent pixels
     ###############
@@ -107,6 +139,15 @@ class vImage(bImage):
     defaultColor_Invalid = QColor(0, 99, 0, 128)  # TODO alpha changed from 255 to 128 29/11/18 for grabcut
     defaultColor_UnMasked_Invalid = QColor(128, 99, 0, 255)
 
+    ##############
+    # dirty rectangles of the current stack update (full size image coordinates, cf. QLayer.render).
+    # None means the whole image.
+    # The apply* methods supporting regions of interest get the region to recompute
+    # from dirtySlices(), which records the output dirty rectangle.
+    ##############
+    inputDirtyRect = None
+    outputDirtyRect = None
+
     @classmethod
     def color2OpacityMask(cls, mask):
         """
@@ -342,6 +383,10 @@ class vImage(bImage):
         self.hald = None
         self.isHald = False
         self.useThumb = False
+        # current pyramid level, None for the default thumbnail/full size modes
+        self.pyramidLevel = None
+        # level displayed by the paint event handler
+        self.displayLevel = None
 
         # Caching flag
         self.cachesEnabled = True
@@ -359,7 +404,15 @@ class vImage(bImage):
         # NOT synchronized : they are updated independently.
         # Thus, after initialization, the thumbnail should
         # NOT be calculated from the full size image.
+        # The thumbnails of all pyramid levels are kept in self.pyramid.
+        # Thumbnails of unused levels can be parked in the tile store (cf. parkPyramidLevels()).
+        self.storeKey = next(vImage.storeKeys)
+        # parked levels : level --> (format, width, height, parentImage)
+        self.parkedLevels = {}
+        self.pyramid = {}
         self.thumb = None
+        # release store entries with the image
+        weakref.finalize(self, self.getTileStore().purge, self.storeKey)
         self.onImageChanged = lambda: 0
         if meta is None:
             # init metadata container
@@ -430,6 +483,184 @@ class vImage(bImage):
         tmp = [value for key, value in self.meta.rawMetadata.items() if 'model' in key.lower()]
         return tmp[0] if tmp else ''  #  self.meta.rawMetadata.get('EXIF:Model', '')  # UniqueCameraModel works for dng
 
+    @property
+    def thumb(self):
+        """
+        Thumbnail of the current pyramid level (cf. getPyramidLevel()).
+        Parked levels are restored on demand.
+        Setting thumb to None purges all levels.
+        @return: thumbnail or None
+        @rtype: QImage
+        """
+        level = self.getPyramidLevel()
+        img = self.pyramid.get(level)
+        if img is None and level in self.parkedLevels:
+            img = self.restorePyramidLevel(level)
+        return img
+
+    @thumb.setter
+    def thumb(self, img):
+        if img is None:
+            self.pyramid = {}
+            if self.parkedLevels:
+                self.parkedLevels = {}
+                self.getTileStore().purge(self.storeKey)
+        else:
+            level = self.getPyramidLevel()
+            self.pyramid[level] = img
+            if self.parkedLevels.pop(level, None) is not None:
+                self.getTileStore().discard((self.storeKey, 'level', level))
+
+    def parkPyramidLevels(self, keep):
+        """
+        Moves the thumbnails of pyramid levels not in keep
+        to the tile store. They are restored when the level is used again.
+        The default thumbnail (level None) is never parked.
+        @param keep: levels to keep in memory
+        @type keep: container of int
+        """
+        store = self.getTileStore()
+        for level in list(self.pyramid):
+            img = self.pyramid[level]
+            if level is None or level in keep or img is None or img.depth() != 32:
+                continue
+            store.put((self.storeKey, 'level', level), QImageBuffer(img))
+            self.parkedLevels[level] = (img.format(), img.width(), img.height(), getattr(img, 'parentImage', None))
+            del self.pyramid[level]
+
+    def restorePyramidLevel(self, level):
+        """
+        Restores a parked pyramid level.
+        @param level:
+        @type level: int
+        @return: thumbnail or None
+        @rtype: QImage
+        """
+        fmt, w, h, parent = self.parkedLevels.pop(level)
+        key = (self.storeKey, 'level', level)
+        store = self.getTileStore()
+        buf = store.get(key)
+        store.discard(key)
+        if buf is None:
+            return None
+        img = QImage(w, h, fmt)
+        QImageBuffer(img)[...] = buf
+        if parent is not None:
+            img.parentImage = parent
+        self.pyramid[level] = img
+        return img
+
+    @property
+    def pyramidLevel(self):
+        """
+        Current pyramid level, None for the default thumbnail/full size modes.
+        In a thread rendering the image at a given level (cf. renderLevel()),
+        this is the level of the render.
+        @return:
+        @rtype: int or None
+        """
+        levels = getattr(vImage.__renderLevels, 'levels', None)
+        if levels and id(self) in levels:
+            return levels[id(self)]
+        return self.__dict__.get('_vImage__pyramidLevel')
+
+    @pyramidLevel.setter
+    def pyramidLevel(self, level):
+        self.__pyramidLevel = level
+
+    @contextmanager
+    def renderLevel(self, level):
+        """
+        Context manager : within the context, pyramidLevel is level for
+        the calling thread only. Background renders (cf. renderScheduler) use it to render
+        a pyramid level while the GUI thread keeps using the current level.
+        @param level:
+        @type level: int or None
+        """
+        levels = getattr(vImage.__renderLevels, 'levels', None)
+        if levels is None:
+            levels = vImage.__renderLevels.levels = {}
+        saved = levels.get(id(self), levels)
+        levels[id(self)] = level
+        try:
+            yield
+        finally:
+            if saved is levels:
+                del levels[id(self)]
+            else:
+                levels[id(self)] = saved
+
+    def getPyramidLevel(self):
+        """
+        Returns the current pyramid level, None for
+        the default thumbnail/full size modes.
+        The method is overridden in QLayer
+        @return:
+        @rtype: int or None
+        """
+        return self.pyramidLevel
+
+    def thumbMode(self):
+        """
+        Returns True if the current image is a thumbnail, i.e. if
+        the pyramid level is > 0, or if it is None and useThumb is True.
+        The method is overridden in QLayer
+        @return:
+        @rtype: boolean
+        """
+        level = self.pyramidLevel
+        return self.useThumb if level is None else level > 0
+
+    def coarsestLevel(self):
+        """
+        @return: coarsest pyramid level
+        @rtype: int
+        """
+        return max(int(np.log2(max(self.width(), self.height()) / self.pyramidMinSize)), 0)
+
+    def defaultThumbLevel(self):
+        """
+        @return: finest pyramid level fitting in thumbSize
+        @rtype: int
+        """
+        return min(max(int(np.ceil(np.log2(max(self.width(), self.height()) / self.thumbSize))), 0), self.coarsestLevel())
+
+    def densityLevel(self, r):
+        """
+        Returns the cheapest pyramid level displayed at
+        resizing coefficient r with at least one pixel per screen pixel.
+        @param r: resizing coefficient (cf. resize_coeff())
+        @type r: float
+        @return:
+        @rtype: int
+        """
+        if r >= 1.0:
+            return 0
+        return min(int(np.floor(np.log2(1.0 / r))), self.coarsestLevel())
+
+    def progressiveLevels(self):
+        """
+        Returns the sequence of pyramid levels rendered by progressive
+        renders : a coarse level, then finer levels, up to the target level.
+        In preview mode, the target level is the level matching the display
+        (cf. densityLevel()), but never the full size image. In viewport
+        rendering mode (cf. mImage.renderViewport()), it is the level matching the display.
+        Otherwise, it is the full size image.
+        @return:
+        @rtype: list of int
+        """
+        if self.useHald:
+            return []
+        if self.useThumb:
+            target = self.displayLevel if self.displayLevel is not None else self.defaultThumbLevel()
+            target = min(max(target, 1), self.coarsestLevel())
+        elif getattr(self, 'useViewport', False) and self.displayLevel is not None:
+            target = self.displayLevel
+        else:
+            target = 0
+        coarse = min(target + self.progressiveSteps, self.coarsestLevel())
+        return list(range(coarse, target - 1, -1))
+
     def initThumb(self):
         """
         Inits the image thumbnail as a QImage. In contrast to
@@ -438,8 +669,19 @@ class vImage(bImage):
         Layer thumbs own an attribute parentImage set by the overridden method QLayer.initThumb.
         For non adjustment layers, the thumbnail will never be updated. So, we
         perform a high quality scaling.
+        Pyramid levels are computed from the nearest finer level available.
         """
-        scImg = self.scaled(self.thumbSize, self.thumbSize, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        level = self.getPyramidLevel()
+        if level is None:
+            scImg = self.scaled(self.thumbSize, self.thumbSize, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        else:
+            src = self
+            for k in range(level - 1, 0, -1):
+                if self.pyramid.get(k) is not None:
+                    src = self.pyramid[k]
+                    break
+            scImg = src.scaled(max(self.width() >> level, 1), max(self.height() >> level, 1),
+                               Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
         # With the Qt.SmoothTransformation flag, the output image format is premultiplied
         self.thumb = scImg.convertToFormat(QImage.Format_ARGB32, Qt.DiffuseDither | Qt.DiffuseAlphaDither)
 
@@ -506,7 +748,7 @@ class vImage(bImage):
         """
         if self.useHald:
             return self.getHald()
-        if self.useThumb:
+        if self.thumbMode():
             return self.getThumb()
         else:
             return self
@@ -522,45 +764,60 @@ class vImage(bImage):
         @return:
         @rtype: 2uple of int
         """
-        if self.useThumb:
+        if self.thumbMode():
             currentImg = self.getThumb()
             x = (x * currentImg.width()) / self.width()
             y = (y * currentImg.height()) / self.height()
         return int(x), int(y)
 
-    def getHspbBuffer(self):
+    def getHspbBuffer(self, roi=None):
         """
         return the image buffer in color mode HSpB.
         The buffer is recalculated if needed and cached.
+        If roi is not None, only the region roi is converted (no caching).
+        @param roi: region of interest
+        @type roi: tuple of slices
         @return: HSPB buffer
         @rtype: ndarray
         """
+        if roi is not None:
+            return rgb2hspVec(QImageBuffer(self.getCurrentImage())[roi][:, :, :3][:, :, ::-1])
         #inputImage = self.inputImgFull().getCurrentImage()
         if self.hspbBuffer is None  or not self.cachesEnabled:
             currentImage = self.getCurrentImage()
             self.hspbBuffer = rgb2hspVec(QImageBuffer(currentImage)[:,:,:3][:,:,::-1])
         return self.hspbBuffer
 
-    def getLabBuffer(self):
+    def getLabBuffer(self, roi=None):
         """
         returns the image buffer in color mode Lab.
         The buffer is recalculated if needed and cached.
+        If roi is not None, only the region roi is converted (no caching).
+        @param roi: region of interest
+        @type roi: tuple of slices
         @return: Lab buffer, L range is 0..1, a, b ranges are -128..+128
         @rtype: numpy ndarray, dtype np.float
         """
+        if roi is not None:
+            return sRGB2LabVec(QImageBuffer(self.getCurrentImage())[roi][:, :, :3][:, :, ::-1])
         if self.LabBuffer is None  or not self.cachesEnabled:
             currentImage = self.getCurrentImage()
             self.LabBuffer = sRGB2LabVec(QImageBuffer(currentImage)[:, :, :3][:, :, ::-1])
         return self.LabBuffer
 
-    def getHSVBuffer(self):
+    def getHSVBuffer(self, roi=None):
         """
         returns the image buffer in color mode HSV.
         The buffer is calculated if needed and cached.
+        If roi is not None, only the region roi is converted (no caching).
         H,S,V ranges are 0..255 (opencv convention for 8 bits images)
+        @param roi: region of interest
+        @type roi: tuple of slices
         @return: HSV buffer
         @rtype: numpy ndarray, dtype np.float
         """
+        if roi is not None:
+            return cv2.cvtColor(QImageBuffer(self.getCurrentImage())[roi][:, :, :3], cv2.COLOR_BGR2HSV)
         if self.HSVBuffer is None  or not self.cachesEnabled:
             currentImage = self.getCurrentImage()
             self.HSVBuffer = cv2.cvtColor(QImageBuffer(currentImage)[:, :, :3], cv2.COLOR_BGR2HSV)
@@ -574,6 +831,39 @@ class vImage(bImage):
         """
         self.isModified = b
 
+    def dirtySlices(self, margin=0, record=True):
+        """
+        Returns the slices of the current image buffers which must be recomputed
+        by an apply* method : the input dirty rectangle (cf. QLayer.render) mapped to
+        current image coordinates and grown by margin pixels, or the whole image
+        if no dirty rectangle is set. Methods computing an output pixel from a neighbourhood
+        of the input pixel should set margin to the radius of the neighbourhood.
+        If record is True, the grown rectangle is recorded as output dirty rectangle,
+        to be propagated to the upper layers.
+        @param margin: margin (current image pixels)
+        @type margin: int
+        @param record: record the output dirty rectangle
+        @type record: boolean
+        @return: slices (rows, columns)
+        @rtype: tuple of slice objects
+        """
+        currentImage = self.getCurrentImage()
+        w, h = currentImage.width(), currentImage.height()
+        if self.inputDirtyRect is None:
+            return np.s_[0:h, 0:w]
+        rect = self.inputDirtyRect
+        r = w / self.width()
+        # one more pixel for rounding
+        margin += 1
+        x1, y1 = max(int(rect.left() * r) - margin, 0), max(int(rect.top() * r) - margin, 0)
+        x2, y2 = min(int(np.ceil((rect.right() + 1) * r)) + margin, w), min(int(np.ceil((rect.bottom() + 1) * r)) + margin, h)
+        x2, y2 = max(x1, x2), max(y1, y2)
+        if record:
+            # back to full size coordinates
+            xf1, yf1 = int(x1 / r), int(y1 / r)
+            self.outputDirtyRect = QRect(xf1, yf1, int(np.ceil(x2 / r)) - xf1, int(np.ceil(y2 / r)) - yf1)
+        return np.s_[y1:y2, x1:x2]
+
     def cacheInvalidate(self):
         """
         Invalidate cache buffers. The method is
@@ -686,10 +976,7 @@ class vImage(bImage):
         """
         Pass through
         """
-        bufIn = QImageBuffer(self.inputImg())
-        bufOut = QImageBuffer(self.getCurrentImage())
-        bufOut[:,:,:] = bufIn
-        self.updatePixmap()
+        self.forwardInput()
 
     def applyCloning(self, seamless=True):
         """
@@ -700,7 +987,6 @@ class vImage(bImage):
         # TODO 02/04/18 called multiple times by mouse events, cacheInvalidate should be called!!
         imgIn = self.inputImg()
         imgOut = self.getCurrentImage()
-        pxIn = QPixmap.fromImage(imgIn)
         ########################
         # hald pass through
         if self.parentImage.isHald:
@@ -714,19 +1000,22 @@ class vImage(bImage):
         # erase previous transformed image : reset imgOut to ImgIn
         qp = QPainter(imgOut)
         qp.setCompositionMode(QPainter.CompositionMode_Source)
-        qp.drawPixmap(QRect(0, 0, imgOut.width(), imgOut.height()), pxIn, pxIn.rect())
+        qp.drawImage(QRect(0, 0, imgOut.width(), imgOut.height()), imgIn, QImage.rect(imgIn))
         # get translation relative to current Image
         currentAltX, currentAltY = self.full2CurrentXY(self.xAltOffset, self.yAltOffset)
         # draw translated and zoomed input image (nothing is drawn outside of dest. image)
         qp.setCompositionMode(QPainter.CompositionMode_SourceOver)
         rect = QRectF(currentAltX, currentAltY, imgOut.width()*self.AltZoom_coeff, imgOut.height()*self.AltZoom_coeff)
-        qp.drawPixmap(rect, pxIn, pxIn.rect())
+        qp.drawImage(rect, imgIn, QImage.rect(imgIn))
         qp.end()
         # do seamless cloning
+        # background renders (cf. renderScheduler) must not touch the GUI
+        gui = isGUIThread()
         if seamless:
             try:
-                QApplication.setOverrideCursor(Qt.WaitCursor)
-                QApplication.processEvents()
+                if gui:
+                    QApplication.setOverrideCursor(Qt.WaitCursor)
+                    QApplication.processEvents()
                 imgInc = imgIn.copy()
                 src = imgOut
                 vImage.seamlessMerge(imgInc, src, self.mask, self.cloningMethod)
@@ -734,15 +1023,17 @@ class vImage(bImage):
                 bufOut[:, :, :3] = QImageBuffer(imgInc)[:,:,:3]
             finally:
                 self.parentImage.setModified(True)
-                QApplication.restoreOverrideCursor()
-                QApplication.processEvents()
+                if gui:
+                    QApplication.restoreOverrideCursor()
+                    QApplication.processEvents()
         # forward the alpha channel
         # TODO 23/06/18 should forward ?
         self.updatePixmap()
         # the presentation layer must be updated here because
         # applyCloning is called directly (mouse and Clone button events).
-        self.parentImage.prLayer.update()
-        self.parentImage.onImageChanged()
+        if gui:
+            self.parentImage.prLayer.update()
+            self.parentImage.onImageChanged()
 
     def applyKnitting(self):
         """
@@ -911,7 +1202,7 @@ class vImage(bImage):
     def applyExposure(self, exposureCorrection, options):
         """
         Applies exposure correction 2**exposureCorrection
-        to the linearized RGB channels.
+        to the linearized RGB channels (cf. adjustments.exposure()).
 
         @param exposureCorrection:
         @type exposureCorrection: float
@@ -920,25 +1211,16 @@ class vImage(bImage):
         @return:
         @rtype:
         """
+        params = exposureParams(exposureCorrection=exposureCorrection)
         # neutral point
-        if abs(exposureCorrection) < 0.05:
-            buf0 = QImageBuffer(self.getCurrentImage())
-            buf1 = QImageBuffer(self.inputImg())
-            buf0[:, :, :] = buf1
-            self.updatePixmap()
+        if params.isNeutral():
+            self.forwardInput()
             return
-        bufIn = QImageBuffer(self.inputImg())
-        buf = bufIn[:,:,:3][:,:,::-1]
-        buf = rgb2rgbLinearVec(buf)
-
-        buf[:,:,:] = buf * (2 ** exposureCorrection)
-
-        buf = rgbLinear2rgbVec(buf)
-
-        buf = np.clip(buf, 0.0, 255.0)
-        currentImage = self.getCurrentImage()
-        ndImg1a = QImageBuffer(currentImage)
-        ndImg1a[:, :, :3][:, :, ::-1] = buf
+        # point-wise correction : region of interest
+        s = self.dirtySlices()
+        bufIn = QImageBuffer(self.inputImg())[s]
+        ndImg1a = QImageBuffer(self.getCurrentImage())[s]
+        ndImg1a[:, :, :3] = exposure(bufIn, params)
         # forward the alpha channel
         ndImg1a[:, :, 3] = bufIn[:,:,3]
         self.updatePixmap()
@@ -997,21 +1279,24 @@ class vImage(bImage):
         self.applyTransForm(options)
 
     def applyNoiseReduction(self):
-        adjustForm = self.getGraphicsForm()
-        noisecorr = adjustForm.noiseCorrection
+        """
+        Noise reduction (cf. adjustments.denoise()).
+        """
+        adjustForm = self.getFormValues()
+        params = noiseParams.fromForm(adjustForm)
         currentImage = self.getCurrentImage()
         inputImage = self.inputImg()
         buf0 = QImageBuffer(inputImage)
         buf1 = QImageBuffer(currentImage)
         ########################
         # hald pass through and neutral point
-        if self.parentImage.isHald or noisecorr == 0:
-            buf1[...] = buf0
-            self.updatePixmap()
+        if self.parentImage.isHald or params.isNeutral():
+            self.forwardInput()
             return
         ########################
         w, h = self.width(), self.height()
         r = inputImage.width() / w
+        margin = noiseMargin(params, preview=self.thumbMode())
         if self.rect is not None:
             # slicing
             rect = self.rect
@@ -1022,36 +1307,22 @@ class vImage(bImage):
             # reset output image
             buf1[:, :, :] = buf0
             ROI1 = buf1[slices]
-        else:
+            inner = np.s_[:, :]
+        elif margin is None:
+            # wavelet denoising is not local : whole image
             ROI0 = buf0[:, :, :3]
             ROI1 = buf1[:, :, :3]
-        buf01 = ROI0[:, :, ::-1]
-        noisecorr *= currentImage.width() / self.width()
-        if adjustForm.options['Wavelets']:
-            noisecorr *= 100
-            bufLab = cv2.cvtColor(buf01, cv2.COLOR_RGB2Lab)
-            L = dwtDenoiseChan(bufLab, chan=0, thr=noisecorr, thrmode='wiener') #, level=8 if self.parentImage.useThumb else 11)
-            A = dwtDenoiseChan(bufLab, chan=1, thr=noisecorr, thrmode='wiener') # level=8 if self.parentImage.useThumb else 11)
-            B = dwtDenoiseChan(bufLab, chan=2, thr=noisecorr, thrmode='wiener') # level=8 if self.parentImage.useThumb else 11)
-            np.clip(L, 0, 255, out=L)
-            np.clip(A, 0, 255, out=A)
-            np.clip(B, 0, 255, out=B)
-            bufLab = np.dstack((L, A, B))
-            # back to RGB
-            ROI1[:,:,::-1] = cv2.cvtColor(bufLab.astype(np.uint8), cv2.COLOR_Lab2RGB)
-        elif adjustForm.options['Bilateral']:
-           ROI1[:,:,::-1] = cv2.bilateralFilter(buf01,
-                                         9 if self.parentImage.useThumb else 15,   # 21:5.5s, 15:3.5s, diameter of
-                                                                                   # (coordinate) pixel neighborhood,
-                                                                                   # 5 is the recommended value for fast processing
-                                         10 * adjustForm.noiseCorrection,          # std deviation sigma
-                                                                                   # in color space,  100 middle value
-                                         50 if self.parentImage.useThumb else 150, # std deviation sigma
-                                                                                   # in coordinate space,  100 middle value
-                                         )
-        elif adjustForm.options['NLMeans']:
-            ROI1[:,:,::-1] = cv2.fastNlMeansDenoisingColored(buf01, None, 1+noisecorr, 1+noisecorr, 7, 21) # hluminance, hcolor,  last params window sizes 7, 21 are recommended values
-
+            inner = np.s_[:, :]
+        else:
+            # region of interest : the output dirty rectangle is the input one grown by the
+            # filter reach (bilateral diameter or NLMeans template + search windows),
+            # and it is computed from the input grown by twice the reach.
+            sOut, sIn = self.dirtySlices(margin), self.dirtySlices(2 * margin, record=False)
+            ROI0 = buf0[sIn][:, :, :3]
+            ROI1 = buf1[sOut][:, :, :3]
+            inner = np.s_[sOut[0].start - sIn[0].start: sOut[0].stop - sIn[0].start,
+                          sOut[1].start - sIn[1].start: sOut[1].stop - sIn[1].start]
+        ROI1[:, :, :] = denoise(ROI0, params, scale=currentImage.width() / self.width(), preview=self.thumbMode())[inner]
         # forward the alpha channel
         buf1[:,:,3] = buf0[:,:,3]
         self.updatePixmap()
@@ -1075,109 +1346,46 @@ class vImage(bImage):
 
     def applyContrast(self, version='HSV'):
         """
-        Applies contrast saturation and brightness corrections.
+        Applies contrast saturation and brightness corrections
+        (cf. adjustments.contrast()).
         If version is 'HSV' (default), the
         image is converted to HSV and the correction is applied to
         the S and V channels. Otherwise, the Lab color space is used.
         @param version:
         @type version:
         """
-        adjustForm = self.getGraphicsForm()
+        adjustForm = self.getFormValues()
         options = adjustForm.options
-        contrastCorrection = adjustForm.contrastCorrection
-        satCorrection = adjustForm.satCorrection
-        brightnessCorrection = adjustForm.brightnessCorrection
-        inputImage = self.inputImg()
-        tmpBuf = QImageBuffer(inputImage)
-        currentImage = self.getCurrentImage()
-        ndImg1a = QImageBuffer(currentImage)
+        params = contrastParams.fromForm(adjustForm, version=version)
+        # brightness and saturation corrections are point-wise, but contrast corrections
+        # depend on the whole image (histogram warping, CLAHE)
+        s, roi = np.s_[:, :], None
+        if params.isPointWise():
+            s = self.dirtySlices()
+            roi = None if self.inputDirtyRect is None else s
         # neutral point : forward changes
-        if contrastCorrection == 0 and satCorrection == 0 and brightnessCorrection == 0:
-            ndImg1a[:, :, :] = tmpBuf
-            self.updatePixmap()
+        if params.isNeutral():
+            self.forwardInput()
             return
-        ##########################
-        # Lab mode, slower than HSV
-        ##########################
-        if version=='Lab':
-            # get l channel, range is 0..1
-            LBuf = inputImage.getLabBuffer().copy()
-            if brightnessCorrection != 0:
-                alpha = (-adjustForm.brightnessCorrection + 1.0)
-                # tabulate x**alpha
-                LUT = np.power(np.arange(256) / 255, alpha)
-                # convert L to L**alpha
-                LBuf[:, :, 0] = LUT[LBuf[:, :, 0]]
-            if contrastCorrection >0:
-                # CLAHE
-                if options['CLAHE']:
-                    if self.parentImage.isHald:
-                        raise ValueError('cannot build 3D LUT from CLAHE ')
-                    clahe = cv2.createCLAHE(clipLimit=contrastCorrection, tileGridSize=(8, 8))
-                    clahe.setClipLimit(contrastCorrection)
-                    res = clahe.apply((LBuf[:,:,0] * 255.0).astype(np.uint8)) /255
-                # warping
-                else:
-                    if self.parentImage.isHald and not options['manualCurve']:
-                        raise ValueError('Check option Show Contrast Curve in Cont/Bright/Sat layer')
-                    auto = self.autoSpline and not self.parentImage.isHald
-                    res,a,b,d,T = warpHistogram(LBuf[:,:,0], warp=contrastCorrection, preserveHigh=options['High'],
-                                                spline = None if auto else self.getMmcSpline())
-                    # show the spline viewer
-                    if self.autoSpline and options['manualCurve']:
-                        self.getGraphicsForm().setContrastSpline(a, b, d, T)
-                        self.autoSpline = False #mmcSpline = self.getGraphicsForm().scene().cubicItem # caution : misleading name for a quadratic spline !
-                LBuf[:,:,0] = res
-            if satCorrection != 0:
-                slope = max(0.1, adjustForm.satCorrection / 25 + 1)  # ran# show the splinege 0.1..3
-                # multiply a and b channels
-                LBuf[:, :, 1:3] *= slope
-                LBuf[:, :, 1:3] = np.clip(LBuf[:, :, 1:3], -127, 127)
-            # back to RGB
-            sRGBBuf = Lab2sRGBVec(LBuf)  # use opencv cvtColor
-        ###########
-        # HSV mode (default)
-        ###########
-        else:
-            # get HSV buffer, H, S, V are in range 0..255
-            HSVBuf = inputImage.getHSVBuffer().copy()
-            if brightnessCorrection != 0:
-                alpha = 1.0 / (0.501 + adjustForm.brightnessCorrection)  - 1.0  # approx. map -0.5...0.0...0.5 --> +inf...1.0...0.0
-                # tabulate x**alpha
-                LUT = np.power(np.arange(256) / 255, alpha) * 255
-                # convert V to V**alpha
-                HSVBuf[:, :, 2] = LUT[HSVBuf[:, :, 2]]  # faster than take
-            if contrastCorrection > 0:
-                # CLAHE
-                if options['CLAHE']:
-                    if self.parentImage.isHald:
-                        raise ValueError('cannot build 3D LUT from CLAHE ')
-                    clahe = cv2.createCLAHE(clipLimit=contrastCorrection, tileGridSize=(8, 8))
-                    clahe.setClipLimit(contrastCorrection)
-                    res = clahe.apply((HSVBuf[:, :, 2]))
-                # warping
-                else:
-                    if self.parentImage.isHald and not options['manualCurve']:
-                        raise ValueError('Check option Show Contrast Curve in Cont/Bright/Sat layer')
-                    buf32 = HSVBuf[:,:,2].astype(np.float)/255
-                    auto = self.autoSpline and not self.parentImage.isHald
-                    res,a,b,d,T = warpHistogram(buf32, warp=contrastCorrection, preserveHigh=options['High'],
-                                                spline=None if auto else self.getMmcSpline())
-                    res = (res*255.0).astype(np.uint8)
-                    # show the spline viewer
-                    if self.autoSpline and options['manualCurve']:
-                        self.getGraphicsForm().setContrastSpline(a, b, d, T)
-                        self.autoSpline = False # TODO added 18/07/18
-                HSVBuf[:, :, 2] = res
-            if satCorrection != 0:
-                alpha = 1.0 / (0.501 + adjustForm.satCorrection) - 1.0  # approx. map -0.5...0.0...0.5 --> +inf...1.0...0.0
-                # tabulate x**alpha
-                LUT = np.power(np.arange(256) / 255, alpha) * 255
-                # convert saturation s to s**alpha
-                HSVBuf[:, :, 1] = LUT[HSVBuf[:, :, 1]]  # faster than take
-            # back to RGB
-            sRGBBuf = cv2.cvtColor(HSVBuf, cv2.COLOR_HSV2RGB)
-        ndImg1a[:, :, :3][:,:,::-1] = sRGBBuf
+        if params.contrastCorrection > 0:
+            if options['CLAHE']:
+                if self.parentImage.isHald:
+                    raise ValueError('cannot build 3D LUT from CLAHE ')
+            # warping
+            else:
+                if self.parentImage.isHald and not options['manualCurve']:
+                    raise ValueError('Check option Show Contrast Curve in Cont/Bright/Sat layer')
+                auto = self.autoSpline and not self.parentImage.isHald
+                params.spline = None if auto else self.getMmcSpline()
+        inputImage = self.inputImg()
+        tmpBuf = QImageBuffer(inputImage)[s]
+        ndImg1a = QImageBuffer(self.getCurrentImage())[s]
+        converted = inputImage.getLabBuffer(roi=roi) if version == 'Lab' else inputImage.getHSVBuffer(roi=roi)
+        ndImg1a[:, :, :3] = contrast(tmpBuf, params, converted=converted)
+        # show the spline viewer (GUI thread only : background renders leave it to the next render)
+        if params.curve is not None and self.autoSpline and options['manualCurve'] and isGUIThread():
+            self.getGraphicsForm().setContrastSpline(*params.curve)
+            self.autoSpline = False
         # forward the alpha channel
         ndImg1a[:, :,3] = tmpBuf[:,:,3]
         self.updatePixmap()
@@ -1190,28 +1398,18 @@ class vImage(bImage):
         @param options: not used yet
         @type options : dictionary
         """
-        if options is None:
-            options = UDict()
+        params = lut1DParams(stackedLUT=stackedLUT)
         # neutral point
-        if not np.any(stackedLUT - np.arange(256)):  # last dims are equal : broadcast is working
-            buf1 = QImageBuffer(self.inputImg())
-            buf2 = QImageBuffer(self.getCurrentImage())
-            buf2[:, :, :] = buf1
-            self.updatePixmap()
+        if params.isNeutral():
+            self.forwardInput()
             return
+        # point-wise correction : region of interest
+        s = self.dirtySlices()
         inputImage = self.inputImg()
-        currentImage = self.getCurrentImage()
         # get image buffers (BGR order on intel arch.)
-        ndImg0a = QImageBuffer(inputImage)
-        ndImg1a = QImageBuffer(currentImage)
-        ndImg0 = ndImg0a[:,:,:3]
-        ndImg1 = ndImg1a[:, :, :3]
-        # apply LUTS to channels
-        #rList = np.array([2,1,0]) #BGR
-        s = ndImg0[:,:,0].shape
-        for c in range(3): # 0.36s for 15Mpx
-            ndImg1[:, :, c] = np.take(stackedLUT[2-c,:], ndImg0[:,:,c].reshape((-1,))).reshape(s)
-        # ndImg1[:, :, :] = stackedLUT[rList, ndImg0]  # last dims of index arrays are equal : broadcast works. slower 0.66s for 15Mpx
+        ndImg0a = QImageBuffer(inputImage)[s]
+        ndImg1a = QImageBuffer(self.getCurrentImage())[s]
+        ndImg1a[:, :, :3] = rgbLUT(ndImg0a, params)
         # forward the alpha channel
         ndImg1a[:,:,3] = ndImg0a[:,:,3]
         self.updatePixmap()
@@ -1223,49 +1421,21 @@ class vImage(bImage):
         @type stackedLUT: ndarray shape=(3,256) dtype=int or float
         @param options: not used yet
         """
-        if options is None:
-            options = UDict()
+        params = lut1DParams(stackedLUT=stackedLUT)
         # neutral point
-        if not np.any(stackedLUT - np.arange(256)):  # last dims are equal : broadcast is working
-            buf1 = QImageBuffer(self.inputImg())
-            buf2 = QImageBuffer(self.getCurrentImage())
-            buf2[:, :, :] = buf1
-            self.updatePixmap()
+        if params.isNeutral():
+            self.forwardInput()
             return
-        #from colorConv import Lab2sRGBVec
-        # convert LUT to float to speed up  buffer conversions
-        stackedLUT = stackedLUT.astype(np.float)
-        # get the Lab input buffer
-        Img0 = self.inputImg()
-        ndLabImg0 = Img0.getLabBuffer() #.copy()
-        # conversion functions
-        def scaleLabBuf(buf):
-            buf = buf + [0.0, 128.0, 128.0]  # copy is mandatory here to avoid the corruption of the cached Lab buffer
-            buf[:,:,0] *= 255.0
-            return buf
-        def scaleBackLabBuf(buf):
-            buf = buf - [0.0, 128.0, 128.0] # no copy needed here, but seems faster than in place operation!
-            buf[:,:,0] /= 255.0
-            return buf
-        ndLImg0 = scaleLabBuf(ndLabImg0).astype(np.uint8)
-        # apply LUTS to channels
-        s = ndLImg0[:, :, 0].shape
-        ndLabImg1 = np.zeros(ndLImg0.shape, dtype=np.uint8)
-        for c in range(3):  # 0.43s for 15Mpx
-            ndLabImg1[:, :, c] = np.take(stackedLUT[c, :], ndLImg0[:, :, c].reshape((-1,))).reshape(s)
-        #ndLabImg1 = stackedLUT[rList, ndLImg0] # last dims are equal : broadcast works
-        ndLabImg1 = scaleBackLabBuf(ndLabImg1)
-        # back sRGB conversion
-        ndsRGBImg1 = Lab2sRGBVec(ndLabImg1)
-        # in place clipping
-        np.clip(ndsRGBImg1, 0, 255, out=ndsRGBImg1)  # mandatory
-        currentImage = self.getCurrentImage()
-        ndImg1 = QImageBuffer(currentImage)
-        ndImg1[:, :, :3][:, :, ::-1] = ndsRGBImg1
+        # point-wise correction : region of interest
+        s = self.dirtySlices()
+        roi = None if self.inputDirtyRect is None else s
+        inputImage = self.inputImg()
+        # get image buffers (BGR order on intel arch.)
+        ndImg0a = QImageBuffer(inputImage)[s]
+        ndImg1a = QImageBuffer(self.getCurrentImage())[s]
+        ndImg1a[:, :, :3] = labLUT(ndImg0a, params, converted=inputImage.getLabBuffer(roi=roi))
         # forward the alpha channel
-        ndImg0 = QImageBuffer(Img0)
-        ndImg1[:,:,3] = ndImg0[:,:,3]
-        # update
+        ndImg1a[:,:,3] = ndImg0a[:,:,3]
         self.updatePixmap()
 
     def applyHSPB1DLUT(self, stackedLUT, options=None, pool=None):
@@ -1278,37 +1448,21 @@ class vImage(bImage):
         @param pool: multiprocessing pool : unused
         @type pool: muliprocessing.Pool
         """
-        if options is None:
-            options = UDict()
+        params = lut1DParams(stackedLUT=stackedLUT)
         # neutral point
-        if not np.any(stackedLUT - np.arange(256)):  # last dims are equal : broadcast is working
-            buf1 = QImageBuffer(self.inputImg())
-            buf2=QImageBuffer(self.getCurrentImage())
-            buf2[:,:,:] = buf1
-            self.updatePixmap()
+        if params.isNeutral():
+            self.forwardInput()
             return
-        Img0 = self.inputImg()
-        ndHSPBImg0 = Img0.getHspbBuffer()   # time 2s with cache disabled for 15 Mpx
-        # apply LUTS to normalized channels (range 0..255)
-        ndLImg0 = (ndHSPBImg0 * [255.0/360.0, 255.0, 255.0]).astype(np.uint8)
-        #rList = np.array([0,1,2]) # H,S,B
-        ndHSBPImg1 = np.zeros(ndLImg0.shape, dtype=np.uint8)
-        s = ndLImg0[:, :, 0].shape
-        for c in range(3):  # 0.36s for 15Mpx
-            ndHSBPImg1[:, :, c] = np.take(stackedLUT[c, :], ndLImg0[:, :, c].reshape((-1,))).reshape(s)
-        # ndHSBPImg1 = stackedLUT[rList, ndLImg0] * [360.0/255.0, 1/255.0, 1/255.0]
-        # back to sRGB
-        ndRGBImg1 = hsp2rgbVec(ndHSBPImg1)  # time 4s for 15 Mpx
-        # in place clipping
-        np.clip(ndRGBImg1, 0, 255, out=ndRGBImg1)  # mandatory
-        # set current image to modified image
-        currentImage = self.getCurrentImage()
-        ndImg1a = QImageBuffer(currentImage)
-        ndImg1a[:, :, :3][:,:,::-1] = ndRGBImg1
+        # point-wise correction : region of interest
+        s = self.dirtySlices()
+        roi = None if self.inputDirtyRect is None else s
+        inputImage = self.inputImg()
+        # get image buffers (BGR order on intel arch.)
+        ndImg0a = QImageBuffer(inputImage)[s]
+        ndImg1a = QImageBuffer(self.getCurrentImage())[s]
+        ndImg1a[:, :, :3] = hspbLUT(ndImg0a, params, converted=inputImage.getHspbBuffer(roi=roi))
         # forward the alpha channel
-        ndImg0 = QImageBuffer(Img0)
-        ndImg1a[:,:,3] = ndImg0[:,:,3]
-        # update
+        ndImg1a[:,:,3] = ndImg0a[:,:,3]
         self.updatePixmap()
 
     def applyHSV1DLUT(self, stackedLUT, options=None, pool=None):
@@ -1321,59 +1475,52 @@ class vImage(bImage):
         @param pool: multiprocessing pool : unused
         @type pool: muliprocessing.Pool
         """
+        params = lut1DParams(stackedLUT=stackedLUT)
         # neutral point
-        if options is None:
-            options = UDict()
-        if not np.any(stackedLUT - np.arange(256)):  # last dims are equal : broadcast is working
-            buf1 = QImageBuffer(self.inputImg())
-            buf2=QImageBuffer(self.getCurrentImage())
-            buf2[:,:,:] = buf1
-            self.updatePixmap()
+        if params.isNeutral():
+            self.forwardInput()
             return
-        # convert LUT to float to speed up  buffer conversions
-        stackedLUT = stackedLUT.astype(np.float)
-        # get HSV buffer, range H: 0..180, S:0..255 V:0..255
-        Img0 = self.inputImg()
-        HSVImg0 = Img0.getHSVBuffer()
-        #HSVImg0 = self.getMaskedCurrentContainer().getHSVBuffer()
-        HSVImg0 = HSVImg0.astype(np.uint8)
-        # apply LUTS
-        HSVImg1 = np.zeros(HSVImg0.shape, dtype=np.uint8)
-        #rList = np.array([0,1,2]) # H,S,V
-        s = HSVImg0[:, :, 0].shape
-        for c in range(3):  # 0.43s for 15Mpx
-            HSVImg1[:, :, c] = np.take(stackedLUT[c, :], HSVImg0[:, :, c].reshape((-1,))).reshape(s)
-        #HSVImg1 = stackedLUT[rList, HSVImg0]
-        # back to sRGB
-        RGBImg1 = hsv2rgbVec(HSVImg1, cvRange=True)
-        # in place clipping
-        np.clip(RGBImg1, 0, 255, out=RGBImg1)  # mandatory
-        # set current image to modified image
-        currentImage = self.getCurrentImage()
-        ndImg1a = QImageBuffer(currentImage)
-        ndImg1a[:, :, :3][:,:,::-1] = RGBImg1
+        # point-wise correction : region of interest
+        s = self.dirtySlices()
+        roi = None if self.inputDirtyRect is None else s
+        inputImage = self.inputImg()
+        # get image buffers (BGR order on intel arch.)
+        ndImg0a = QImageBuffer(inputImage)[s]
+        ndImg1a = QImageBuffer(self.getCurrentImage())[s]
+        ndImg1a[:, :, :3] = hsvLUT(ndImg0a, params, converted=inputImage.getHSVBuffer(roi=roi))
         # forward the alpha channel
-        ndImg0 = QImageBuffer(Img0)
-        ndImg1a[:,:,3] = ndImg0[:,:,3]
-        # update
+        ndImg1a[:,:,3] = ndImg0a[:,:,3]
         self.updatePixmap()
 
-    def apply3DLUT(self, LUT, LUTSTEP, options=None, pool=None):
+    def apply3DLUT(self, LUT, LUTSTEP, options=None, pool=None, lut3D=None, inputImage=None):
         """
         Apply a 3D LUT to the current view of the image (self or self.thumb).
-        If pool is not None and the size of the current view is > 3000000,
-        parallel interpolation on image slices is used.
+        If pool is not None and the size of the current view is above the calibrated
+        threshold (cf. bLUeCore.scheduler), parallel interpolation on image slices is used.
         If options['keep alpha'] is False, alpha channel is interpolated too.
         The order of LUT axes, LUT channels and image channels must be BGR.
+        lut3D is the (optional) LUT3D object owning LUT. It should be given only
+        for LUTs which are not edited (e.g. imported .cube files) : its baked table
+        is used instead of interpolation when it is already built. When the current view
+        has more than LUT3D.bakeMinPixels pixels, a missing table is built in background
+        and the LUT is interpolated until it is ready. Its shaper curves, if any, are
+        applied to the input.
         @param LUT: LUT3D array (cf. colorCube.py)
         @type LUT: 3d ndarray, dtype = int
         @param options:
         @type options: UDict
+        @param pool: multiprocessing pool
+        @type pool: multiprocessing.Pool
+        @param lut3D: LUT3D object
+        @type lut3D: LUT3D
+        @param inputImage: input image, defaults to self.inputImg()
+        @type inputImage: QImage
         """
         if options is None:
             options = UDict()
         # get buffers
-        inputImage = self.inputImg()
+        if inputImage is None:
+            inputImage = self.inputImg()
         currentImage = self.getCurrentImage()
         # get selection
         w1, w2, h1, h2 = (0.0,) * 4
@@ -1389,9 +1536,10 @@ class vImage(bImage):
             if w1>=w2 or h1>=h2:
                 dlgWarn("Empty selection\nSelect a region with the marquee tool")
                 return
-        # use image
+        # use image, or the region of interest
         else:
-            w1, w2, h1, h2 = 0, self.inputImg().width(), 0, self.inputImg().height()
+            s = self.dirtySlices()
+            h1, h2, w1, w2 = s[0].start, s[0].stop - 1, s[1].start, s[1].stop - 1
         inputBuffer = QImageBuffer(inputImage)[h1:h2 + 1, w1:w2 + 1, :]
         imgBuffer = QImageBuffer(currentImage)[:, :, :]
         interpAlpha = not options['keep alpha']
@@ -1402,13 +1550,27 @@ class vImage(bImage):
         else:
             ndImg0 = inputBuffer[:, :, :3]
             ndImg1 = imgBuffer[:, :, :3]
-        # choose the right interpolation method
-        if (pool is not None) and (inputImage.width() * inputImage.height() > 3000000):
-            interp = lambda x,y,z : interpMulti(x, y, z, pool=pool, use_tetra=USE_TETRA)
+        # choose the right interpolation method and apply LUT.
+        # Full size images (export) use the higher quality tetrahedral interpolation
+        use_tetra = USE_TETRA or (USE_TETRA_FULLSIZE and not (self.thumbMode() or self.parentImage.useHald))
+        # no temporary image : the output buffer is written in place
+        outBuffer = ndImg1[h1:h2 + 1, w1:w2 + 1, :]
+        pixelCount = outBuffer.shape[0] * outBuffer.shape[1]
+        if lut3D is not None and lut3D.getBaked(use_tetra=use_tetra, build=pixelCount > LUT3D.bakeMinPixels) is not None:
+            # single lookup per pixel
+            lut3D.applyBaked(ndImg0, out=outBuffer, use_tetra=use_tetra)
         else:
-            interp = interpTetra if USE_TETRA else interpTriLinear
-        # apply LUT
-        ndImg1[h1:h2 + 1, w1:w2 + 1, :] = interp(LUT, LUTSTEP, ndImg0)
+            if lut3D is not None:
+                # apply the 1D shaper curves, if any
+                ndImg0 = lut3D.shapeInput(ndImg0)
+            if isParallel(pixelCount, pool):
+                interpMulti(LUT, LUTSTEP, ndImg0, pool=pool, poolSize=POOL_SIZE, use_tetra=use_tetra, out=outBuffer)
+            elif use_tetra:
+                interpTetra(LUT, LUTSTEP, ndImg0, out=outBuffer)
+            elif USE_STRIPS:
+                interpTriLinearStrips(LUT, LUTSTEP, ndImg0, out=outBuffer)
+            else:
+                outBuffer[...] = interpTriLinear(LUT, LUTSTEP, ndImg0)
         if not interpAlpha:
             # forward the alpha channel
             imgBuffer[h1:h2 + 1, w1:w2 + 1, 3] = inputBuffer[:, :, 3]
@@ -1524,9 +1686,10 @@ class vImage(bImage):
 
     def applyFilter2D(self):
         """
-        Apply 2D kernel.
+        Apply 2D kernel (cf. adjustments.filter2D()).
         """
-        adjustForm = self.getGraphicsForm()
+        adjustForm = self.getFormValues()
+        params = filterParams.fromForm(adjustForm)
         inputImage = self.inputImg()
         currentImage = self.getCurrentImage()
         buf0 = QImageBuffer(inputImage)
@@ -1534,7 +1697,7 @@ class vImage(bImage):
         ########################
         # hald pass through
         if self.parentImage.isHald:
-            buf1[...] = buf0
+            self.forwardInput()
             return
         ########################
         w, h = self.width(), self.height()
@@ -1549,21 +1712,17 @@ class vImage(bImage):
             # reset output image
             buf1[:,:,:] = buf0
             ROI1 = buf1[slices]
+            inner = np.s_[:, :]
         else:
-            ROI0 = buf0[:,:,:3]
-            ROI1 = buf1[:,:,:3]
-        # kernel based filtering
-        if adjustForm.kernelCategory in [filterIndex.IDENTITY, filterIndex.UNSHARP, filterIndex.SHARPEN, filterIndex.BLUR1, filterIndex.BLUR2]:
-            # correct radius for preview if needed
-            radius = int(adjustForm.radius * r)
-            kernel = getKernel(adjustForm.kernelCategory, radius, adjustForm.amount)
-            ROI1[:,:,:] = cv2.filter2D(ROI0, -1, kernel)
-        else:
-            # bilateral filtering
-            radius = int(adjustForm.radius * r)
-            sigmaColor = 2 * adjustForm.tone
-            sigmaSpace = sigmaColor
-            ROI1[:,:,::-1] = cv2.bilateralFilter( ROI0[:,:,::-1], radius, sigmaColor, sigmaSpace)
+            # region of interest : the output dirty rectangle is the input one grown by the
+            # filter radius, and it is computed from the input grown by twice the radius.
+            margin = filterMargin(params, scale=r)
+            sOut, sIn = self.dirtySlices(margin), self.dirtySlices(2 * margin, record=False)
+            ROI0 = buf0[sIn][:, :, :3]
+            ROI1 = buf1[sOut][:, :, :3]
+            inner = np.s_[sOut[0].start - sIn[0].start: sOut[0].stop - sIn[0].start,
+                          sOut[1].start - sIn[1].start: sOut[1].stop - sIn[1].start]
+        ROI1[:, :, :] = filter2D(ROI0, params, scale=r)[inner]
         # forward the alpha channel
         buf1[:,:,3] = buf0[:,:,3]
         self.updatePixmap()
@@ -1572,7 +1731,7 @@ class vImage(bImage):
         """
         Apply a gradual neutral density filter
         """
-        adjustForm = self.getGraphicsForm()
+        adjustForm = self.getFormValues()
         inputImage = self.inputImg()
         currentImage = self.getCurrentImage()
         buf0 = QImageBuffer(inputImage)
@@ -1580,7 +1739,7 @@ class vImage(bImage):
         ########################
         # hald pass through
         if self.parentImage.isHald:
-            buf1[...] = buf0
+            self.forwardInput()
             return
         ########################
         r = inputImage.width() / self.width()
@@ -1630,78 +1789,20 @@ class vImage(bImage):
 
     def applyTemperature(self):
         """
-        The method implements two algorithms for the correction of color temperature.
+        The method implements two algorithms for the correction of color temperature
+        (cf. adjustments.temperature()).
         - Chromatic adaptation : multipliers in linear sRGB.
         - Photo filter : Blending using mode multiply, plus correction of luminosity
         """
-        adjustForm = self.getGraphicsForm()
-        options = adjustForm.options
-        temperature = adjustForm.tempCorrection
-        tint = adjustForm.tintCorrection # range -1..1
-        inputImage = self.inputImg()
-        buf1 = QImageBuffer(inputImage)
-        currentImage = self.getCurrentImage()
+        adjustForm = self.getFormValues()
+        params = temperatureParams.fromForm(adjustForm)
         # neutral point : forward input image and return
-        if abs(temperature - 6500) < 200 and tint == 0:
-            buf0 = QImageBuffer(currentImage)
-            buf0[:, :, :] = buf1
-            self.updatePixmap()
+        if params.isNeutral():
+            self.forwardInput()
             return
-        #from bLUeGui.blend import blendLuminosity
-        #from colorConv import bbTemperature2RGB, conversionMatrix, rgb2rgbLinearVec, rgbLinear2rgbVec
-        ################
-        # photo filter
-        ################
-        if options['Photo Filter']:
-            # get black body color
-            r, g, b = bbTemperature2RGB(temperature)
-            filter = QImage(inputImage.size(), inputImage.format())
-            filter.fill(QColor(r, g, b, 255))
-            # draw image on filter using mode multiply
-            qp = QPainter(filter)
-            qp.setCompositionMode(QPainter.CompositionMode_Multiply)
-            qp.drawImage(0, 0, inputImage)
-            qp.end()
-            # correct the luminosity of the resulting image,
-            # by blending it with the inputImage, using mode luminosity.
-            # We use a tuning coeff to control the amount of correction.
-            # Note that using perceptual brightness gives better results, unfortunately slower
-            resImg = blendLuminosity(filter, inputImage)
-            bufOutRGB = QImageBuffer(resImg)[:,:,:3][:,:,::-1]
-        #####################
-        # Chromatic adaptation
-        #####################
-        elif options['Chromatic Adaptation']:
-            """
-            tint = 2**tint
-            m1, m2, m3 = (1.0, tint, 1.0,) if tint >=1 else (1.0/tint, 1.0, 1.0/tint,)
-            # get conversion matrix in XYZ color space
-            M = conversionMatrix(temperature, sRGBWP)  # source is input image : sRGB, ref WP D65
-            buf = QImageBuffer(inputImage)[:, :, :3]
-            # convert to XYZ
-            bufXYZ = sRGB2XYZVec(buf[:,:,::-1])             #np.tensordot(bufLinear, sRGB_lin2XYZ, axes=(-1, -1))
-            # apply conversion matrix
-            bufXYZ = np.tensordot(bufXYZ, M, axes=(-1, -1))
-            """
-            # get RGB multipliers
-            m1, m2, m3, _ = temperatureAndTint2Multipliers(temperature, 2 ** tint, sRGB_lin2XYZInverse)
-            buf = QImageBuffer(inputImage)[:, :, :3]
-            bufXYZ = sRGB2XYZVec(buf[:, :, ::-1])
-            bufsRGBLinear = np.tensordot(bufXYZ, sRGB_lin2XYZInverse, axes=(-1, -1))
-            # apply multipliers
-            bufsRGBLinear *= [m1, m2, m3]
-            # brightness correction
-            M = np.max(bufsRGBLinear)
-            bufsRGBLinear /= M
-            bufOutRGB = rgbLinear2rgbVec(bufsRGBLinear)
-            np.clip(bufOutRGB, 0, 255, out=bufOutRGB)
-            bufOutRGB = bufOutRGB.astype(np.uint8)
-        else:
-            raise ValueError('applyTemperature : wrong option')
-        # set output image
-        bufOut0 = QImageBuffer(currentImage)
-        bufOut = bufOut0[:,:,:3]
-        bufOut[:, :, ::-1] = bufOutRGB
+        buf1 = QImageBuffer(self.inputImg())
+        bufOut0 = QImageBuffer(self.getCurrentImage())
+        bufOut0[:, :, :3] = temperature(buf1, params)
         # forward the alpha channel
         bufOut0[:,:,3] = buf1[:,:,3]
         self.updatePixmap()
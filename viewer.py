@@ -16,20 +16,24 @@ You should have received a copy of the GNU Lesser General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import gc
+import threading
+import numpy as np
 from os import walk, path, listdir
 from os.path import basename, isfile
 from re import search
 from time import sleep
 
 from PySide2.QtCore import Qt, QUrl, QMimeData, QByteArray, QPoint, QSize
-from PySide2.QtGui import QKeySequence, QImage, QDrag
+from PySide2.QtGui import QKeySequence, QImage, QDrag, QPixmap, QIcon
 from PySide2.QtWidgets import QMainWindow, QLabel, QSizePolicy, QAction, QMenu, QListWidget, QAbstractItemView, \
-    QApplication
+    QApplication, QListWidgetItem
 
 import exiftool
 from QtGui1 import app, window
 from utils import loader, stateAwareQDockWidget
-from bLUeGui.dialog import IMAGE_FILE_EXTENSIONS, RAW_FILE_EXTENSIONS
+from bLUeGui.dialog import IMAGE_FILE_EXTENSIONS, RAW_FILE_EXTENSIONS, dlgWarn
+from bLUeGui.bLUeImage import QImageBuffer, ndarrayToQImage
+from bLUeCore.lutLibrary import lutLibrary
 
 # global variable recording diaporama state
 isSuspended = False
@@ -406,4 +410,135 @@ To <b>open an image</b> drag it onto the main window.<br>
         self.newWin.showMaximized()
         # launch loader instance
         thr = loader(fileListGen, self.listWdg)
-        thr.start()
\ No newline at end of file
+        thr.start()
+
+class lutLoader(threading.Thread):
+    """
+    Thread class for (re-)indexing a LUT library and
+    loading the previews in a QListWidget object.
+    """
+    def __init__(self, library, thumb, wdg):
+        """
+
+        @param library:
+        @type library: lutLibrary
+        @param thumb: image used for previews, BGR order
+        @type thumb: ndarray, dtype=np.uint8
+        @param wdg:
+        @type wdg: QListWidget
+        """
+        super().__init__()
+        self.library = library
+        self.thumb = thumb
+        self.wdg = wdg
+
+    def run(self):
+        # Only new or modified files are parsed.
+        # As for utils.loader, a RuntimeError is raised
+        # if the form was closed, causing thread termination.
+        try:
+            self.library.scan()
+            for name in self.library.names():
+                entry = self.library.index[name]
+                if self.thumb is None:
+                    item = QListWidgetItem(name)
+                else:
+                    buf = self.library.preview(name, self.thumb)
+                    img = ndarrayToQImage(np.ascontiguousarray(buf[:, :, ::-1]), format=QImage.Format_RGB888)
+                    item = QListWidgetItem(QIcon(QPixmap.fromImage(img)), name)
+                item.setToolTip('%s\n%s\nsize %d' % (name, entry['title'], entry['size']))
+                item.setData(Qt.UserRole, (self.library.path(name),))
+                self.wdg.addItem(item)
+        except RuntimeError:
+            pass
+
+class lutViewer:
+    """
+    3D LUT library browser. Double clicking an icon
+    calls onActivate(lut, name).
+    """
+    # current instance
+    instance = None
+    iconSize = 100
+
+    @classmethod
+    def getViewerInstance(cls, mainWin=None, onActivate=None):
+        """
+        Returns a unique lutViewer instance : a new instance
+        is created only if there exists no instance yet.
+        @param mainWin: should be the app main window
+        @type mainWin: QMainWindow
+        @param onActivate: called with arguments (lut, name) on double click
+        @type onActivate: function
+        @return: viewer instance
+        @rtype: lutViewer
+        """
+        if cls.instance is None:
+            cls.instance = lutViewer(mainWin=mainWin, onActivate=onActivate)
+        elif cls.instance.mainWin is not mainWin:
+            raise ValueError("getViewer: wrong main form")
+        return cls.instance
+
+    def __init__(self, mainWin=None, onActivate=None):
+        self.mainWin = mainWin
+        self.onActivate = onActivate
+        self.library = None
+        self.initWins()
+
+    def initWins(self):
+        newWin = QMainWindow(self.mainWin)
+        newWin.setAttribute(Qt.WA_DeleteOnClose)
+        self.newWin = newWin
+        listWdg = QListWidget()
+        listWdg.setWrapping(False)
+        listWdg.setSelectionMode(QAbstractItemView.SingleSelection)
+        listWdg.setViewMode(QListWidget.IconMode)
+        listWdg.setIconSize(QSize(self.iconSize, self.iconSize))
+        listWdg.setMaximumSize(160000, self.iconSize + 40)
+        listWdg.itemDoubleClicked.connect(self.activate)
+        # dock the form
+        dock = stateAwareQDockWidget(window)
+        dock.setWidget(newWin)
+        dock.setWindowFlags(newWin.windowFlags())
+        dock.setAttribute(Qt.WA_DeleteOnClose)
+        self.dock = dock
+        window.addDockWidget(Qt.BottomDockWidgetArea, dock)
+        newWin.setCentralWidget(listWdg)
+        self.listWdg = listWdg
+        self.newWin.setWhatsThis(
+"""<b>3D LUT Library</b><br>
+Previews show the LUTs applied to the current image.<br>
+To <b>add a 3D LUT layer</b> double click on an icon.<br>
+"""
+        )  # end setWhatsThis
+
+    def activate(self, item):
+        name = item.text()
+        try:
+            lut = self.library.getLUT(name)
+        except (ValueError, IOError) as e:
+            dlgWarn('Unable to load 3D LUT : ', info=str(e))
+            return
+        if self.onActivate is not None:
+            self.onActivate(lut, name)
+
+    def playViewer(self, folder, thumb=None):
+        """
+        Opens the library of 3D LUTs from folder. The index is
+        updated and the previews are computed by a separate thread.
+        @param folder: path to folder
+        @type folder: str
+        @param thumb: image used for previews, BGR order
+        @type thumb: ndarray, dtype=np.uint8
+        """
+        if self.dock.isClosed:
+            # reinit form
+            self.initWins()
+        else:
+            self.listWdg.clear()
+        if self.library is None or self.library.folder != path.abspath(folder):
+            self.library = lutLibrary(folder)
+        self.dock.setWindowTitle(folder)
+        self.newWin.showMaximized()
+        thr = lutLoader(self.library, thumb, self.listWdg)
+        thr.start()